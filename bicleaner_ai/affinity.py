@@ -0,0 +1,124 @@
+'''
+CPU affinity of classify and noise generation workers
+
+The CPUs the process is allowed to run on (os.sched_getaffinity) are
+grouped by NUMA node, read from /sys/devices/system/node, and split
+in contiguous sets, one per worker. Workers are spread over the nodes
+according to their number of CPUs and only span several nodes
+when there are less workers than nodes.
+A pinned process and the threads it starts afterwards, like the
+TensorFlow intra-op pool, run only on its set of CPUs.
+'''
+import argparse
+import logging
+import glob
+import os
+import re
+
+NODE_DIR = "/sys/devices/system/node"
+
+# Parse a CPU list like "0-3,8,10-11"
+def parse_cpulist(value):
+    cpus = set()
+    for part in value.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    if not cpus:
+        raise ValueError(f"Empty CPU list '{value}'")
+    return sorted(cpus)
+
+# Argument type of CPU lists
+def cpulist(value):
+    try:
+        return parse_cpulist(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def numa_nodes():
+    '''CPUs of each NUMA node by node number, a single node if unknown'''
+    nodes = {}
+    for path in glob.glob(os.path.join(NODE_DIR, "node*", "cpulist")):
+        match = re.search(r"node(\d+)", path)
+        with open(path) as f:
+            text = f.read().strip()
+        if match and text:
+            nodes[int(match.group(1))] = parse_cpulist(text)
+    return nodes or {0: list(range(os.cpu_count()))}
+
+def split(items, n):
+    '''Split in n contiguous parts of sizes that differ at most by one'''
+    if n > len(items):
+        # More parts than items, parts share the items
+        return [[items[i % len(items)]] for i in range(n)]
+    size, extra = divmod(len(items), n)
+    parts, start = [], 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+def apportion(n, sizes):
+    '''Distribute n workers, at least one per group, proportionally to sizes'''
+    counts = [1] * len(sizes)
+    for _ in range(n - len(sizes)):
+        i = max(range(len(sizes)), key=lambda i: sizes[i] / counts[i])
+        counts[i] += 1
+    return counts
+
+def partition(n, cpus=None, nodes=None):
+    '''Split the available CPUs in n sets, each one in a NUMA node if possible'''
+    if cpus is None:
+        cpus = available_cpus()
+    if nodes is None:
+        nodes = numa_nodes()
+    allowed = set(cpus)
+    groups = [[c for c in node_cpus if c in allowed]
+                for _, node_cpus in sorted(nodes.items())]
+    # CPUs missing from the node information make a group of their own
+    listed = set(c for g in groups for c in g)
+    groups.append([c for c in sorted(allowed) if c not in listed])
+    groups = [g for g in groups if g]
+
+    if n >= len(groups):
+        parts = []
+        for group, count in zip(groups, apportion(n, [len(g) for g in groups])):
+            parts.extend(split(group, count))
+        return parts
+    return [sum(part, []) for part in split(groups, n)]
+
+def describe(cpus, nodes=None):
+    '''CPU list and the NUMA nodes it spans'''
+    if nodes is None:
+        nodes = numa_nodes()
+    cpus = set(cpus)
+    spanned = [str(n) for n, node_cpus in sorted(nodes.items()) if cpus & set(node_cpus)]
+    return f"CPUs {format_cpulist(cpus)} (NUMA node {','.join(spanned) or '?'})"
+
+def pin(cpus):
+    '''Restrict the current process to cpus, returns False if not supported'''
+    if not hasattr(os, "sched_setaffinity"):
+        logging.warning("CPU affinity is not supported in this platform")
+        return False
+    os.sched_setaffinity(0, cpus)
+    logging.info(f"Pinned process {os.getpid()} to {describe(cpus)}")
+    return True
@@ -0,0 +1,220 @@
+from multiprocessing import cpu_count
+import numpy as np
+import math
+import argparse
+import logging
+import yaml
+import sys
+import os
+
+#Allows to load modules while inside or outside the package
+try:
+    from .util import check_positive, check_positive_between_zero_and_one, get_model
+except (ImportError, SystemError):
+    from util import check_positive, check_positive_between_zero_and_one, get_model
+
+__author__ = "Jaume Zaragoza"
+__version__ = "Version 1.0.1 # 16/06/2021 #"
+
+
+# Create an argument parser for document alignment
+def argument_parser():
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]), formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Score all the sentence pairs of a document pair to align them")
+    parser.add_argument('source', type=argparse.FileType('rt'), help="Source document, one sentence per line")
+    parser.add_argument('target', type=argparse.FileType('rt'), help="Target document, one sentence per line")
+    parser.add_argument('metadata', type=argparse.FileType('r'), help="Training metadata (YAML file)")
+    parser.add_argument('output', nargs='?', type=argparse.FileType('w'), default=sys.stdout, help="Output of the alignment")
+
+    groupO = parser.add_argument_group('Optional')
+    groupO.add_argument('--mode', choices=['matrix', 'dp'], default='matrix', help="'matrix' writes the score of every sentence pair, one row per source sentence. 'dp' only scores pairs close to the diagonal and writes a monotonic alignment as 'src_lines trg_lines score src trg'")
+    groupO.add_argument('--top_k', type=check_positive, default=None, help="Instead of the full matrix, write the k best target sentences for each source sentence as 'src_line trg_line score src trg'")
+    groupO.add_argument('--threshold', type=check_positive_between_zero_and_one, default=None, help="Minimum score of the pairs written with --top_k (default 0.0) or aligned in dp mode (default 0.5)")
+    groupO.add_argument('--band', type=check_positive, default=10, help="Number of target sentences at each side of the diagonal that are scored in dp mode")
+    groupO.add_argument('--many_to_one', action='store_true', default=False, help="Allow 1-2 and 2-1 alignments in dp mode")
+    groupO.add_argument('-b', '--block_size', type=int, default=10000, help="Candidate pairs scored per block in dp mode")
+    groupO.add_argument('-p', '--processes', type=int, default=max(1, cpu_count()-1), help="Number of processes to use")
+    groupO.add_argument('--batch_size', type=int, default=None, help="Sentence pairs per batch, model batch size if not set")
+    groupO.add_argument('--calibrated', action='store_true', help="Output calibrated scores", default=False)
+
+    groupL = parser.add_argument_group('Logging')
+    groupL.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    groupL.add_argument('--debug', action='store_true', help='Debug logging mode')
+    groupL.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    groupL.add_argument('-v', '--version', action='version', version="%(prog)s " + __version__, help="show version of this script and exit")
+
+    return parser
+
+# Load the classifier of a model pack
+def load_classifier(metadata_file):
+    metadata = yaml.safe_load(metadata_file)
+    yamlpath = os.path.dirname(os.path.abspath(metadata_file.name))
+    clf = get_model(metadata["classifier_type"])(yamlpath,
+                                                 metadata["classifier_settings"])
+    clf.load()
+    return clf
+
+# Read a document, one sentence per line
+def read_document(document):
+    return [line.rstrip('\r\n') for line in document]
+
+# Best k target indexes for each source row of a score matrix
+# returns a list of [(trg_index, score), ...] sorted by descending score
+def top_k(matrix, k):
+    k = min(k, matrix.shape[1])
+    if k == 0:
+        return [[] for _ in range(matrix.shape[0])]
+    idx = np.argpartition(-matrix, k-1, axis=1)[:, :k]
+    scores = np.take_along_axis(matrix, idx, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    return [list(zip(i.tolist(), s.tolist())) for i, s in zip(idx, scores)]
+
+def write_matrix(output, matrix):
+    for row in matrix:
+        output.write('\t'.join(f"{s:.3f}" for s in row) + '\n')
+
+# Write aligned pairs as 'src_line trg_line score src trg', lines start in 1
+def write_pairs(output, pairs, src, trg, threshold=0.0):
+    for i, j, score in pairs:
+        if score < threshold:
+            continue
+        output.write(f"{i+1}\t{j+1}\t{score:.3f}\t{src[i]}\t{trg[j]}\n")
+
+# Write alignments as 'src_lines trg_lines score src trg'
+# line numbers start in 1 and are joined by commas in 1-2 and 2-1 alignments
+def write_alignments(output, alignments, src, trg):
+    for src_idx, trg_idx, score in alignments:
+        src_lines = ','.join(str(i+1) for i in src_idx)
+        trg_lines = ','.join(str(j+1) for j in trg_idx)
+        src_text = ' '.join(src[i] for i in src_idx)
+        trg_text = ' '.join(trg[j] for j in trg_idx)
+        output.write(f"{src_lines}\t{trg_lines}\t{score:.3f}\t{src_text}\t{trg_text}\n")
+
+
+class BandedAligner(object):
+    '''
+    Monotonic sentence aligner for a document pair
+    Only the pairs in a band around the length-normalized diagonal are scored,
+    so the cost is linear in the document length.
+    A dynamic programming search finds the alignment that maximizes
+    the sum of score minus threshold of the aligned pairs,
+    unaligned sentences do not add to it.
+    '''
+
+    def __init__(self, clf, band=10, many_to_one=False, threshold=0.5,
+                 batch_size=None, calibrated=False, block_size=10000):
+        self.clf = clf
+        self.band = band
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.calibrated = calibrated
+        self.block_size = block_size
+        # Moves as (source sentences, target sentences)
+        self.moves = [(1, 0), (0, 1), (1, 1)]
+        if many_to_one:
+            self.moves += [(1, 2), (2, 1)]
+
+    def band_range(self, i, n, m):
+        '''
+        Target positions of the band at source position i
+        Each row reaches the start of the next so the end is always reachable
+        '''
+        lo = math.floor(i * m / n) - self.band
+        hi = math.ceil((i + 1) * m / n) + self.band
+        return max(0, lo), min(m, hi)
+
+    def in_band(self, i, j, n, m):
+        lo, hi = self.band_range(i, n, m)
+        return lo <= j <= hi
+
+    def candidates(self, n, m):
+        '''Alignments (i, j, di, dj) that link sentences inside the band'''
+        cands = []
+        for i in range(n):
+            lo, hi = self.band_range(i, n, m)
+            for j in range(lo, min(hi, m - 1) + 1):
+                for di, dj in self.moves:
+                    if di == 0 or dj == 0 or i + di > n or j + dj > m:
+                        continue
+                    if self.in_band(i + di, j + dj, n, m):
+                        cands.append((i, j, di, dj))
+        return cands
+
+    def score(self, src, trg, cands):
+        '''Score candidates in blocks, joining sentences of 1-2 and 2-1 alignments'''
+        scores = np.zeros(len(cands), dtype=np.float32)
+        for start in range(0, len(cands), self.block_size):
+            block = cands[start:start+self.block_size]
+            x1 = [' '.join(src[i:i+di]) for i, _, di, _ in block]
+            x2 = [' '.join(trg[j:j+dj]) for _, j, _, dj in block]
+            y_pred = self.clf.predict(x1, x2, self.batch_size, self.calibrated)
+            scores[start:start+len(block)] = np.reshape(y_pred, -1)
+        return dict(zip(cands, scores.tolist()))
+
+    def align(self, src, trg):
+        '''Returns a list of (source indexes, target indexes, score)'''
+        n, m = len(src), len(trg)
+        if n == 0 or m == 0:
+            return []
+        cands = self.candidates(n, m)
+        logging.info(f"Scoring {len(cands)} candidate pairs of {n}x{m} sentences")
+        scores = self.score(src, trg, cands)
+
+        # Forward pass over the states (sentences consumed) in the band
+        best = {(0, 0): (0.0, None)}
+        for i in range(n + 1):
+            lo, hi = self.band_range(i, n, m)
+            for j in range(lo, hi + 1):
+                if (i, j) not in best:
+                    continue
+                total = best[(i, j)][0]
+                for di, dj in self.moves:
+                    ni, nj = i + di, j + dj
+                    if ni > n or nj > m or not self.in_band(ni, nj, n, m):
+                        continue
+                    if di and dj:
+                        gain = scores[(i, j, di, dj)] - self.threshold
+                    else:
+                        gain = 0.0
+                    if (ni, nj) not in best or total + gain > best[(ni, nj)][0]:
+                        best[(ni, nj)] = (total + gain, (i, j, di, dj))
+
+        # Backtrack from the end keeping links above the threshold
+        alignments = []
+        state = best[(n, m)][1]
+        while state is not None:
+            i, j, di, dj = state
+            if di and dj and scores[state] >= self.threshold:
+                alignments.append((list(range(i, i + di)),
+                                   list(range(j, j + dj)),
+                                   scores[state]))
+            state = best[(i, j)][1]
+        alignments.reverse()
+        return alignments
+
+
+def align(args):
+    src = read_document(args.source)
+    trg = read_document(args.target)
+
+    if args.mode == 'dp':
+        threshold = 0.5 if args.threshold is None else args.threshold
+        aligner = BandedAligner(args.clf, args.band, args.many_to_one,
+                                threshold, args.batch_size,
+                                args.calibrated, args.block_size)
+        alignments = aligner.align(src, trg)
+        write_alignments(args.output, alignments, src, trg)
+        logging.info(f"Aligned {len(alignments)} pairs")
+        return len(src) + len(trg)
+
+    logging.info(f"Scoring {len(src)}x{len(trg)} sentence pairs")
+    matrix = args.clf.predict_matrix(src, trg, args.batch_size, args.calibrated)
+    if args.top_k is None:
+        write_matrix(args.output, matrix)
+    else:
+        threshold = 0.0 if args.threshold is None else args.threshold
+        pairs = [(i, j, score) for i, row in enumerate(top_k(matrix, args.top_k))
+                                    for j, score in row]
+        write_pairs(args.output, pairs, src, trg, threshold)
+    return len(src) * len(trg)
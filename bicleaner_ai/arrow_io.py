@@ -0,0 +1,193 @@
+from hardrules.hardrules import Hardrules
+from time import perf_counter
+import numpy as np
+import logging
+import sys
+
+try:
+    from .classify import discard_reasons
+    from .stats import ScoreStats
+    from .perf import timers
+except (ImportError, SystemError):
+    from classify import discard_reasons
+    from stats import ScoreStats
+    from perf import timers
+
+# Input/output formats by file extension
+COLUMNAR_EXTENSIONS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+}
+STDIO_NAMES = ("<stdin>", "<stdout>", "-")
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise Exception("Arrow and Parquet formats need pyarrow, install it with 'pip install pyarrow'")
+    return pyarrow
+
+# Guess file format from its name
+def guess_format(filename, default="tsv"):
+    for ext, file_format in COLUMNAR_EXTENSIONS.items():
+        if filename.endswith(ext):
+            return file_format
+    return default
+
+# Resolve 'auto' input and output formats in the arguments
+def resolve_formats(args):
+    if args.input_format == "auto":
+        args.input_format = guess_format(args.input.name)
+    if args.output_format == "auto":
+        if args.input_format == "tsv":
+            args.output_format = "tsv"
+        elif args.output.name in STDIO_NAMES:
+            args.output_format = "arrow"
+        else:
+            args.output_format = guess_format(args.output.name, args.input_format)
+
+    if (args.input_format == "tsv") != (args.output_format == "tsv"):
+        raise Exception("Columnar output needs columnar input and vice versa")
+    if args.input_format == "parquet" and args.input.name in STDIO_NAMES:
+        raise Exception("Parquet input cannot be read from stdin, use Arrow IPC stream format")
+    if args.output_format == "parquet" and args.output.name in STDIO_NAMES:
+        raise Exception("Parquet output cannot be written to stdout, use Arrow IPC stream format")
+    return args.input_format != "tsv"
+
+# Iterate over the record batches of a Parquet or Arrow file
+def read_batches(args):
+    pa = import_pyarrow()
+    if args.input_format == "parquet":
+        yield from pa.parquet.ParquetFile(args.input.name).iter_batches(
+                                            batch_size=args.block_size)
+    elif args.input.name in STDIO_NAMES:
+        yield from pa.ipc.open_stream(sys.stdin.buffer)
+    else:
+        try:
+            reader = pa.ipc.open_file(args.input.name)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+        except pa.ArrowInvalid:
+            with pa.OSFile(args.input.name) as source:
+                yield from pa.ipc.open_stream(source)
+
+def open_writer(args, schema):
+    pa = import_pyarrow()
+    if args.output_format == "parquet":
+        return pa.parquet.ParquetWriter(args.output.name, schema)
+    elif args.output.name in STDIO_NAMES:
+        return pa.ipc.new_stream(sys.stdout.buffer, schema)
+    else:
+        return pa.ipc.new_file(args.output.name, schema)
+
+# Obtain column index from --scol/--tcol
+# positions starting in 1, or names if --header is set
+def column_index(schema, col):
+    if isinstance(col, str):
+        if col not in schema.names:
+            raise Exception(f"The provided column '{col}' is not in the input schema")
+        return schema.get_field_index(col)
+    if col > len(schema.names):
+        raise Exception(f"Column {col} above column number ({len(schema.names)})")
+    return col - 1
+
+# Classify a Parquet or Arrow file
+# record batches are scored in blocks and written with an extra score column
+# the rest of the columns are passed through without copying
+def classify_arrow(args):
+    if args.kept_tus or args.discarded_tus or args.discarded_reasons_dir or args.paired_output:
+        raise Exception("Routing to kept or discarded files is not supported with columnar formats")
+    pa = import_pyarrow()
+    hardrules = Hardrules(args)
+    stats = ScoreStats.from_args(args)
+    writer = None
+    nline = 0
+
+    for batch in read_batches(args):
+        scol = column_index(batch.schema, args.scol)
+        tcol = column_index(batch.schema, args.tcol)
+        # Block size can change between blocks with --max_memory
+        start = 0
+        while start < batch.num_rows:
+            block = batch.slice(start, args.block_size)
+            start += block.num_rows
+            columns = classify_block(args, hardrules, block, scol, tcol, stats)
+            if args.score_only:
+                arrays = list(columns.values())
+                names = list(columns.keys())
+            else:
+                arrays = block.columns + list(columns.values())
+                names = block.schema.names + list(columns.keys())
+            out = pa.RecordBatch.from_arrays(arrays, names=names)
+            if writer is None:
+                schema = out.schema
+                if batch.schema.metadata:
+                    schema = schema.with_metadata(batch.schema.metadata)
+                writer = open_writer(args, schema)
+            writer.write_batch(out)
+            nline += block.num_rows
+            timers.maybe_log()
+            if getattr(args, "profiler", None) is not None:
+                args.profiler.step()
+            if getattr(args, "memory", None) is not None:
+                args.memory.step(args)
+
+    if writer is not None:
+        writer.close()
+    if stats is not None:
+        stats.save(args.stats)
+        logging.info(stats.report())
+    return nline
+
+# Score a block of rows, returns the new columns by name
+def classify_block(args, hardrules, block, scol, tcol, stats=None):
+    pa = import_pyarrow()
+    src = block.column(scol).to_pylist()
+    trg = block.column(tcol).to_pylist()
+
+    t_start = perf_counter()
+    idx = []
+    reasons = []
+    buf_sent_sl = []
+    buf_sent_tl = []
+    for i, (sl_sentence, tl_sentence) in enumerate(zip(src, trg)):
+        # Null cells are empty sentences, also scored with raw output
+        sl_sentence = sl_sentence.strip() if sl_sentence else ""
+        tl_sentence = tl_sentence.strip() if tl_sentence else ""
+        reason = discard_reasons(args, hardrules, sl_sentence, tl_sentence)
+        reasons.append(reason)
+        if reason is None:
+            idx.append(i)
+            buf_sent_sl.append(sl_sentence)
+            buf_sent_tl.append(tl_sentence)
+    timers.add("hardrules", perf_counter() - t_start, block.num_rows)
+    timers.count("lines", block.num_rows)
+
+    # Raw output has a score per class
+    ncols = args.clf.settings["n_classes"] if args.raw_output else 1
+    scores = np.zeros((block.num_rows, ncols), dtype=np.float32)
+    depths = np.zeros(block.num_rows, dtype=np.int32)
+    if idx:
+        predictions = args.clf.predict(buf_sent_sl, buf_sent_tl,
+                                       args.batch_size,
+                                       args.calibrated,
+                                       args.raw_output)
+        scores[idx] = predictions
+        if args.early_exit_threshold is not None:
+            depths[idx] = args.clf.exit_depths
+    # Same precision as TSV output
+    scores = np.round(scores, 3)
+    if stats is not None:
+        stats.update(scores[:, 0].tolist(), reasons)
+
+    columns = {"bicleaner_ai_score": pa.array(scores[:, 0])}
+    for i in range(1, ncols):
+        columns[f"bicleaner_ai_score_{i}"] = pa.array(scores[:, i])
+    if args.early_exit_threshold is not None:
+        columns["bicleaner_ai_exit_layer"] = pa.array(depths)
+    return columns
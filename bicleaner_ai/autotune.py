@@ -0,0 +1,313 @@
+'''
+Autotuning of classify for the current host
+
+A sample of the input is classified by subprocesses with different
+block sizes, batch sizes, TensorFlow thread counts and number of workers,
+searching one parameter at a time from the current configuration.
+Trials that exceed the memory cap are stopped, the whole search
+is bounded by a time budget.
+The fastest configuration of each model is saved to a tuning file
+of the host, loaded by later runs for the options not given explicitly.
+'''
+from multiprocessing import cpu_count
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+import subprocess
+import platform
+import datetime
+import logging
+import psutil
+import random
+import json
+import time
+import yaml
+import sys
+import os
+
+try:
+    from .lineindex import LineIndex
+except (ImportError, SystemError):
+    from lineindex import LineIndex
+
+# Options set by the tuning file and their command line flags
+TUNED_OPTIONS = {
+    "block_size": ("-b", "--block_size"),
+    "batch_size": ("--batch_size",),
+    "intra_threads": ("--intra_threads",),
+    "inter_threads": ("--inter_threads",),
+}
+BLOCK_SIZES = (1000, 5000, 10000, 50000)
+BATCH_SIZES = (16, 32, 64, 128, 256, 512)
+XLMR_BATCH_SIZES = (4, 8, 16, 32, 64)
+
+def default_tuning_file():
+    cache = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache, "bicleaner-ai", f"tuning-{platform.node()}.yaml")
+
+def model_key(metadata):
+    return os.path.abspath(metadata)
+
+# Tuned configuration of a model, None if there is none
+def load_tuning(tuning_file, metadata):
+    if not tuning_file or not os.path.isfile(tuning_file):
+        return None
+    with open(tuning_file) as f:
+        tuning = yaml.safe_load(f) or {}
+    return tuning.get(model_key(metadata))
+
+def save_tuning(tuning_file, metadata, config):
+    tuning = {}
+    if os.path.isfile(tuning_file):
+        with open(tuning_file) as f:
+            tuning = yaml.safe_load(f) or {}
+    tuning[model_key(metadata)] = config
+    os.makedirs(os.path.dirname(os.path.abspath(tuning_file)), exist_ok=True)
+    # Replace the file at once, other processes may be reading it
+    tmp_file = f"{tuning_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        yaml.dump(tuning, f)
+    os.replace(tmp_file, tuning_file)
+
+# Options of TUNED_OPTIONS given in the command line
+def explicit_options(argv):
+    explicit = set()
+    for name, flags in TUNED_OPTIONS.items():
+        for arg in argv:
+            for flag in flags:
+                if arg == flag or arg.startswith(flag + "=") \
+                        or (not flag.startswith("--") and arg.startswith(flag)):
+                    explicit.add(name)
+    return explicit
+
+def apply_tuning(args, argv):
+    '''Set the tuned options of the model that are not in the command line'''
+    if args.no_tuning:
+        return
+    config = load_tuning(args.tuning_file, args.metadata.name)
+    if config is None:
+        return
+    explicit = explicit_options(argv)
+    applied = []
+    for name in TUNED_OPTIONS:
+        if name not in explicit and config.get(name) is not None:
+            setattr(args, name, config[name])
+            applied.append(f"{name}={config[name]}")
+    if applied:
+        logging.info(f"Using tuned {', '.join(applied)} from {args.tuning_file}")
+
+# Number of classify workers of the tuned configuration of a model
+# and the classify options of each worker
+def tuned_workers(tuning_file, metadata):
+    config = load_tuning(tuning_file, metadata)
+    if config is None or "workers" not in config:
+        return 1, ""
+    workers = config["workers"]
+    return workers["workers"], (f"--intra_threads {workers['intra_threads']}"
+                                f" --inter_threads {workers['inter_threads']}")
+
+# Write a uniform random sample of the input lines
+def write_sample(args, filename):
+    if args.input.name in ("<stdin>", "-"):
+        raise Exception("--autotune needs an input file, not stdin")
+    if args.paired is not None:
+        raise Exception("--autotune needs a TSV input file, not --paired files")
+    index = LineIndex.open(args.input.name)
+    skip = 1 if args.header else 0
+    if len(index) <= skip:
+        raise Exception("Input file has no lines to sample")
+    rng = random.Random(1)
+    n = min(args.autotune_lines, len(index) - skip)
+    lines = sorted(rng.sample(range(skip, len(index)), n))
+    with open(args.input.name, 'rb') as f, open(filename, 'wb') as out:
+        if args.header:
+            out.write(index.read_lines(f, 0)[0])
+        for i in lines:
+            line = index.read_lines(f, i)[0]
+            out.write(line if line.endswith(b"\n") else line + b"\n")
+    return n
+
+# Classify options of the run that are passed to the trials
+def passthrough_options(args):
+    options = ["--scol", str(args.scol), "--tcol", str(args.tcol)]
+    if args.header:
+        options.append("--header")
+    if args.source_tokenizer_command:
+        options += ["-S", args.source_tokenizer_command]
+    if args.target_tokenizer_command:
+        options += ["-T", args.target_tokenizer_command]
+    if args.rules_config is not None:
+        options += ["--rules_config", args.rules_config.name]
+    if args.max_line_bytes:
+        options += ["--max_line_bytes", str(args.max_line_bytes)]
+    if args.cpu_affinity is not None:
+        options += ["--cpu_affinity", ",".join(map(str, args.cpu_affinity))]
+    for flag in ("disable_hardrules", "disable_lm_filter", "disable_porn_removal",
+                 "disable_minimal_length", "run_all_rules", "score_only",
+                 "calibrated", "raw_output", "fold_embeddings"):
+        if getattr(args, flag):
+            options.append("--" + flag)
+    return options
+
+def trial_command(args, sample, config, perf_file):
+    return [sys.executable, "-m", "bicleaner_ai.bicleaner_ai_classifier",
+            sample, os.devnull, args.metadata.name,
+            "-b", str(config["block_size"]),
+            "--batch_size", str(config["batch_size"]),
+            "--intra_threads", str(config["intra_threads"]),
+            "--inter_threads", str(config["inter_threads"]),
+            "--perf_output", perf_file, "--no_tuning", "-q",
+            *passthrough_options(args)]
+
+# RSS of a process and its children in MiB, 0 if it has exited
+def tree_rss_mib(process):
+    try:
+        procs = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0.0
+    rss = 0
+    for p in procs:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 2**20
+
+def run_trial(args, sample, config, tmp_dir, max_memory, timeout):
+    '''
+    Classify the sample with config in config["workers"] concurrent processes
+    returns the rows/s of all the workers and the peak RSS,
+    None if a worker fails or the trial exceeds the memory cap or the timeout
+    '''
+    perf_files = [os.path.join(tmp_dir, f"perf.{i}.json") for i in range(config["workers"])]
+    workers = [subprocess.Popen(trial_command(args, sample, config, perf_file),
+                                stdin=subprocess.DEVNULL)
+                    for perf_file in perf_files]
+    processes = [psutil.Process(w.pid) for w in workers]
+    start = default_timer()
+    peak_rss = 0.0
+    failure = None
+    try:
+        while any(w.poll() is None for w in workers):
+            peak_rss = max(peak_rss, sum(tree_rss_mib(p) for p in processes))
+            if peak_rss > max_memory:
+                failure = f"exceeded {max_memory:.0f} MiB"
+                break
+            if default_timer() - start > timeout:
+                failure = f"exceeded {timeout:.0f}s"
+                break
+            time.sleep(0.2)
+    finally:
+        for w in workers:
+            if w.poll() is None:
+                w.kill()
+                w.wait()
+    if failure is None and any(w.returncode != 0 for w in workers):
+        failure = "a worker failed"
+    if failure is not None:
+        logging.info(f"Trial {config} {failure}")
+        return None
+
+    rows_per_second = 0.0
+    for perf_file in perf_files:
+        with open(perf_file) as f:
+            rows_per_second += json.load(f).get("lines_per_second", 0.0)
+    return {"rows_per_second": round(rows_per_second, 1),
+            "peak_rss_mib": round(peak_rss, 1)}
+
+def better(result, best_result):
+    return result is not None and (best_result is None
+            or result["rows_per_second"] > best_result["rows_per_second"])
+
+# Candidate values of each parameter, searched in this order
+def search_space(model_type, cpus, sample_lines):
+    threads = sorted({t for t in (1, 2, 4, 8, 16, 32, 64, 128) if t < cpus} | {cpus})
+    blocks = [b for b in BLOCK_SIZES if b <= sample_lines] or [sample_lines]
+    return [
+        ("batch_size", XLMR_BATCH_SIZES if model_type == "xlmr" else BATCH_SIZES),
+        ("block_size", blocks),
+        ("intra_threads", threads),
+        ("inter_threads", [t for t in (1, 2, 4) if t <= cpus]),
+    ]
+
+# Scale threads per worker to share the cores between workers
+def with_workers(config, workers, cpus):
+    intra = max(1, min(config["intra_threads"], cpus // workers))
+    return {**config, "workers": workers,
+            "intra_threads": intra,
+            "inter_threads": min(config["inter_threads"], intra)}
+
+def autotune(args):
+    '''
+    Search the fastest configuration of the model for this host
+    within the memory cap and the time budget and save it to the tuning file
+    '''
+    with open(args.metadata.name) as f:
+        model_type = yaml.safe_load(f)["classifier_type"]
+    cpus = len(args.cpu_affinity) if args.cpu_affinity else cpu_count()
+    max_memory = args.autotune_max_memory
+    if max_memory is None:
+        max_memory = 0.8 * psutil.virtual_memory().total / 2**20
+    deadline = default_timer() + args.autotune_time
+
+    with TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        sample = os.path.join(tmp_dir, "sample")
+        sample_lines = write_sample(args, sample)
+        logging.info(f"Autotuning {model_type} on {sample_lines} lines,"
+                     f" {cpus} CPUs, memory cap {max_memory:.0f} MiB,"
+                     f" time budget {args.autotune_time}s")
+
+        best = {"block_size": min(args.block_size, sample_lines),
+                "batch_size": args.batch_size,
+                "intra_threads": args.intra_threads or args.processes,
+                "inter_threads": args.inter_threads or args.processes,
+                "workers": 1}
+        trials = {}
+        def trial(config):
+            key = tuple(sorted(config.items()))
+            if key not in trials:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    return None
+                trials[key] = run_trial(args, sample, config, tmp_dir,
+                                        max_memory, remaining)
+                if trials[key] is not None:
+                    logging.info(f"Trial {config}: {trials[key]['rows_per_second']} rows/s,"
+                                 f" {trials[key]['peak_rss_mib']} MiB")
+            return trials[key]
+
+        best_result = trial(best)
+        for name, values in search_space(model_type, cpus, sample_lines):
+            for value in values:
+                if name == "inter_threads" and value > best["intra_threads"]:
+                    continue
+                config = {**best, name: value}
+                result = trial(config)
+                if better(result, best_result):
+                    best, best_result = config, result
+
+        # Several workers (coordinator --local_workers) sharing the cores
+        parallel, parallel_result = best, best_result
+        for workers in [w for w in (2, 4, 8, 16, 32) if w <= cpus]:
+            config = with_workers(best, workers, cpus)
+            result = trial(config)
+            if better(result, parallel_result):
+                parallel, parallel_result = config, result
+
+    if best_result is None:
+        raise Exception("No autotune trial finished within the memory cap and the time budget")
+    if default_timer() > deadline:
+        logging.warning("Autotune time budget exhausted, keeping the best configuration so far")
+    config = {name: best[name] for name in TUNED_OPTIONS}
+    config.update(best_result)
+    config["workers"] = {"workers": parallel["workers"],
+                         "intra_threads": parallel["intra_threads"],
+                         "inter_threads": parallel["inter_threads"],
+                         **parallel_result}
+    config.update({"cpus": cpus,
+                   "trials": len(trials),
+                   "date": datetime.datetime.now().isoformat(timespec='seconds')})
+    save_tuning(args.tuning_file, args.metadata.name, config)
+    logging.info(f"Best configuration {best}: {best_result['rows_per_second']} rows/s,"
+                 f" {parallel['workers']} workers: {parallel_result['rows_per_second']} rows/s,"
+                 f" saved to {args.tuning_file}")
+    return config
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+'''
+Offline classification throughput benchmark
+
+Generates a synthetic parallel corpus with a log-normal sentence length
+distribution and a rate of duplicated pairs, builds tiny randomly
+initialized packs of each model type and measures rows/s,
+p50/p99 block latency and peak RSS for every block and batch size,
+along with encoding time and id buffer allocations per batch.
+Only the classifier is measured (encoding and prediction),
+hard rules do not depend on the model.
+Results are written as JSON and can be compared with a baseline:
+    python -m bicleaner_ai.benchmark -o base.json
+    python -m bicleaner_ai.benchmark --baseline base.json -o new.json
+'''
+from tensorflow.keras.preprocessing.sequence import pad_sequences
+from timeit import default_timer
+import sentencepiece as sp
+import tensorflow as tf
+import numpy as np
+import argparse
+import platform
+import resource
+import tempfile
+import logging
+import shutil
+import random
+import json
+import math
+import yaml
+import sys
+import os
+
+try:
+    from .util import get_model, logging_setup
+    from .weights import rss_mib
+    from .datagen import IdBuffers, pad_ids
+    from .perf import timers
+except (ImportError, SystemError):
+    from util import get_model, logging_setup
+    from weights import rss_mib
+    from datagen import IdBuffers, pad_ids
+    from perf import timers
+
+MODEL_TYPES = ("dec_attention", "transformer", "xlmr")
+
+# Classifier settings of the tiny packs
+PACK_SETTINGS = {
+    "dec_attention": {
+        "vocab_size": 2000,
+        "emb_dim": 32,
+        "n_hidden": 32,
+    },
+    "transformer": {
+        "vocab_size": 2000,
+        "emb_dim": 32,
+        "n_hidden": 32,
+        "n_heads": 2,
+    },
+    "xlmr": {
+        "n_hidden": 32,
+    },
+}
+# Shape of the XLMR encoder, keeps the layers of the full model small
+XLMR_CONFIG = {
+    "hidden_size": 32,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "intermediate_size": 64,
+    "type_vocab_size": 1,
+}
+METADATA = "metadata.yaml"
+
+# Pseudo-words of a synthetic language
+def make_lexicon(rng, size):
+    words = set()
+    while len(words) < size:
+        length = rng.randint(2, 10)
+        words.add("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length)))
+    return np.array(sorted(words, key=len))
+
+# Write a synthetic TSV corpus of source and target sentences
+# lengths in words follow a log-normal distribution with the given mean
+# and word frequencies follow Zipf's law, shorter words are more frequent
+def generate_corpus(filename, lines, length_mean=15, length_sigma=0.5,
+                    duplicate_rate=0.1, seed=1, vocab_size=5000):
+    rng = np.random.default_rng(seed)
+    pyrng = random.Random(seed)
+    src_words = make_lexicon(pyrng, vocab_size)
+    trg_words = make_lexicon(pyrng, vocab_size)
+    cdf = np.cumsum(1.0 / np.arange(1, vocab_size + 1))
+    cdf /= cdf[-1]
+    mu = math.log(length_mean) - length_sigma ** 2 / 2
+
+    pairs = []
+    with open(filename, 'w') as f:
+        for _ in range(lines):
+            if pairs and rng.random() < duplicate_rate:
+                src, trg = pairs[rng.integers(len(pairs))]
+            else:
+                n = max(1, int(round(rng.lognormal(mu, length_sigma))))
+                ids = np.minimum(np.searchsorted(cdf, rng.random(n)), vocab_size - 1)
+                # Target is a word by word translation with some words changed
+                changed = np.minimum(np.searchsorted(cdf, rng.random(n)), vocab_size - 1)
+                trg_ids = np.where(rng.random(n) < 0.2, changed, ids)
+                src = " ".join(src_words[ids])
+                trg = " ".join(trg_words[trg_ids])
+                pairs.append((src, trg))
+            f.write(f"{src}\t{trg}\n")
+
+def read_corpus(filename):
+    src, trg = [], []
+    with open(filename) as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            src.append(parts[0])
+            trg.append(parts[1])
+    return src, trg
+
+def train_spm(sentences, prefix, vocab_size, **kwargs):
+    sp.SentencePieceTrainer.train(sentence_iterator=iter(sentences),
+                                  model_prefix=prefix,
+                                  vocab_size=vocab_size,
+                                  hard_vocab_limit=False,
+                                  minloglevel=1,
+                                  **kwargs)
+
+# Build a randomly initialized pack of a model type in directory
+def build_pack(model_type, directory, sentences, seed=1):
+    os.makedirs(directory, exist_ok=True)
+    settings = dict(PACK_SETTINGS[model_type])
+    clf = get_model(model_type)(directory, settings)
+    tf.random.set_seed(seed)
+
+    if model_type == "xlmr":
+        build_xlmr_pack(clf, sentences)
+    else:
+        train_spm(sentences, directory + '/' + clf.spm_prefix,
+                  clf.settings["vocab_size"],
+                  pad_id=clf.settings["pad_id"],
+                  unk_id=clf.settings["unk_id"],
+                  bos_id=clf.settings["bos_id"],
+                  eos_id=clf.settings["eos_id"],
+                  user_defined_symbols=clf.settings["separator"])
+        clf.load_spm()
+        # SentencePiece can produce less pieces than requested
+        settings["vocab_size"] = clf.settings["vocab_size"] = len(clf.vocab)
+        clf.wv = np.random.default_rng(seed).normal(
+                    0, 0.1, (len(clf.vocab), clf.settings["emb_dim"])).astype(np.float32)
+        clf.model = clf.build_model(compile=False)
+        # Weights only, load() builds the model when the file has no config
+        clf.model.save_weights(directory + '/' + clf.settings["model_file"])
+
+    with open(os.path.join(directory, METADATA), 'w') as f:
+        yaml.dump({"source_lang": "xx",
+                   "target_lang": "yy",
+                   "classifier_type": model_type,
+                   "classifier_settings": settings}, f, sort_keys=False)
+    logging.info(f"Built {model_type} pack in {directory}")
+
+def build_xlmr_pack(clf, sentences):
+    from transformers import XLMRobertaTokenizerFast, XLMRobertaConfig
+    try:
+        from .models import BCXLMRobertaForSequenceClassification
+    except (ImportError, SystemError):
+        from models import BCXLMRobertaForSequenceClassification
+
+    settings = clf.settings
+    # Default special ids of SentencePiece are the ones of XLM-R
+    prefix = clf.dir + '/spm'
+    train_spm(sentences, prefix, 2000)
+    tokenizer = XLMRobertaTokenizerFast(vocab_file=prefix + ".model")
+    tokenizer.save_pretrained(clf.dir + '/' + settings["vocab_file"])
+
+    # Positions start after the padding index
+    config = XLMRobertaConfig(vocab_size=len(tokenizer),
+                              max_position_embeddings=settings["maxlen"] + 2,
+                              num_labels=settings["n_classes"],
+                              **XLMR_CONFIG)
+    model = BCXLMRobertaForSequenceClassification(config,
+                        head_hidden_size=settings["n_hidden"],
+                        head_dropout=settings["dropout"],
+                        head_activation=settings["activation"])
+    model(model.dummy_inputs, training=False)
+    model.save_pretrained(clf.dir + '/' + settings["model_file"])
+
+def load_pack(directory):
+    with open(os.path.join(directory, METADATA)) as f:
+        metadata = yaml.safe_load(f)
+    clf = get_model(metadata["classifier_type"])(directory,
+                                                 metadata["classifier_settings"])
+    clf.load()
+    return clf
+
+def encode_cache(clf):
+    spm = getattr(clf, "spm", None)
+    return None if spm is None else spm.cache
+
+# Classify the corpus in blocks, returns the measures of the run
+def run_config(clf, src, trg, block_size, batch_size, warmup=1000):
+    cache = encode_cache(clf)
+    # Trace the model before timing
+    clf.predict(src[:warmup], trg[:warmup], batch_size)
+    if cache is not None:
+        cache.clear()
+
+    latencies = []
+    peak_rss = rss_mib()
+    timers.reset()
+    start = default_timer()
+    for i in range(0, len(src), block_size):
+        block_start = default_timer()
+        clf.predict(src[i:i+block_size], trg[i:i+block_size], batch_size)
+        latencies.append(default_timer() - block_start)
+        peak_rss = max(peak_rss, rss_mib())
+    elapsed = default_timer() - start
+
+    result = {
+        "rows": len(src),
+        "blocks": len(latencies),
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(len(src) / elapsed, 1),
+        "p50_block_seconds": round(float(np.percentile(latencies, 50)), 4),
+        "p99_block_seconds": round(float(np.percentile(latencies, 99)), 4),
+        "peak_rss_mib": round(peak_rss, 1),
+    }
+    snap = timers.snapshot()
+    if "encode_ms_per_batch" in snap:
+        result["encode_ms_per_batch"] = snap["encode_ms_per_batch"]
+    if "id_buffer_allocations" in snap["counters"]:
+        result["id_buffer_allocations"] = snap["counters"]["id_buffer_allocations"]
+    if cache is not None:
+        result["cache_hit_rate"] = round(cache.hit_rate(), 4)
+    return result
+
+# Time per batch of padding SentencePiece ids with pad_sequences
+# and with pad_ids into reused buffers, None for models without SentencePiece
+def padding_comparison(clf, sentences, batch_size, repeats=3):
+    spm = getattr(clf, "spm", None)
+    if spm is None:
+        return None
+    maxlen = clf.settings["maxlen"]
+    batches = [spm.spm_encode(sentences[i:i+batch_size])
+                for i in range(0, len(sentences), batch_size)]
+    buffers = IdBuffers()
+
+    def time_batches(pad):
+        best = math.inf
+        for _ in range(repeats):
+            start = default_timer()
+            for ids in batches:
+                pad(ids)
+            best = min(best, default_timer() - start)
+        return 1000 * best / len(batches)
+
+    legacy = time_batches(lambda ids: pad_sequences(ids, padding="post",
+                                                    truncating="post", maxlen=maxlen))
+    current = time_batches(lambda ids: pad_ids(ids, maxlen,
+                                               buffers.get("text", len(ids), maxlen)))
+    return {"pad_sequences_ms_per_batch": round(legacy, 4),
+            "pad_ids_ms_per_batch": round(current, 4),
+            "padding_ms_saved_per_batch": round(legacy - current, 4),
+            "id_buffers": len(buffers.buffers)}
+
+# Metrics compared with the baseline and whether higher values are better
+COMPARED = (("rows_per_second", True),
+            ("p99_block_seconds", False),
+            ("peak_rss_mib", False))
+
+# Compare results with a baseline, returns the regressions
+# beyond a relative tolerance in the configurations present in both
+def compare(results, baseline, tolerance):
+    def key(r):
+        return (r["model_type"], r["block_size"], r["batch_size"])
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        for metric, higher_better in COMPARED:
+            if not b.get(metric):
+                continue
+            change = r[metric] / b[metric] - 1
+            logging.info(f"{'/'.join(map(str, key(r)))} {metric}:"
+                         f" {b[metric]} -> {r[metric]} ({change:+.1%})")
+            if (higher_better and change < -tolerance) \
+                    or (not higher_better and change > tolerance):
+                regressions.append({"model_type": r["model_type"],
+                                    "block_size": r["block_size"],
+                                    "batch_size": r["batch_size"],
+                                    "metric": metric,
+                                    "baseline": b[metric],
+                                    "value": r[metric],
+                                    "change": round(change, 4)})
+    return regressions
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Offline classification throughput benchmark with synthetic corpora and tiny model packs")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Results in JSON")
+    parser.add_argument('--baseline', type=argparse.FileType('r'), default=None, help="Results of a previous run to compare with, exits with error if there are regressions")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Relative change of a metric over the baseline considered a regression")
+    parser.add_argument('--model_types', nargs='+', choices=MODEL_TYPES, default=list(MODEL_TYPES), help="Model types to benchmark")
+    parser.add_argument('--block_sizes', nargs='+', type=int, default=[1000, 10000], help="Block sizes to benchmark")
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[32, 256], help="Batch sizes to benchmark")
+    parser.add_argument('--lines', type=int, default=20000, help="Lines of the synthetic corpus")
+    parser.add_argument('--length_mean', type=float, default=15, help="Mean sentence length in words")
+    parser.add_argument('--length_sigma', type=float, default=0.5, help="Standard deviation of the log-normal sentence length")
+    parser.add_argument('--duplicate_rate', type=float, default=0.1, help="Fraction of repeated sentence pairs")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the corpus and the model weights")
+    parser.add_argument('--work_dir', default=None, help="Directory for the corpus and the packs, reused across runs if given. A temporary directory by default")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    return parser
+
+def benchmark(args, work_dir):
+    corpus_file = os.path.join(work_dir, f"corpus.{args.lines}.{args.seed}.tsv")
+    if not os.path.isfile(corpus_file):
+        generate_corpus(corpus_file, args.lines, args.length_mean, args.length_sigma,
+                        args.duplicate_rate, args.seed)
+    src, trg = read_corpus(corpus_file)
+
+    results = {
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "corpus": {"lines": args.lines,
+                   "length_mean": args.length_mean,
+                   "length_sigma": args.length_sigma,
+                   "duplicate_rate": args.duplicate_rate,
+                   "seed": args.seed},
+        "results": [],
+        "padding": [],
+    }
+    for model_type in args.model_types:
+        pack_dir = os.path.join(work_dir, model_type)
+        if not os.path.isfile(os.path.join(pack_dir, METADATA)):
+            build_pack(model_type, pack_dir, src + trg, args.seed)
+        clf = load_pack(pack_dir)
+        for block_size in args.block_sizes:
+            for batch_size in args.batch_sizes:
+                result = run_config(clf, src, trg, block_size, batch_size)
+                logging.info(f"{model_type} block {block_size} batch {batch_size}:"
+                             f" {result['rows_per_second']} rows/s,"
+                             f" p50 {result['p50_block_seconds']}s,"
+                             f" p99 {result['p99_block_seconds']}s,"
+                             f" RSS {result['peak_rss_mib']} MiB")
+                results["results"].append({"model_type": model_type,
+                                           "block_size": block_size,
+                                           "batch_size": batch_size,
+                                           **result})
+        for batch_size in args.batch_sizes:
+            padding = padding_comparison(clf, src, batch_size)
+            if padding is not None:
+                logging.info(f"{model_type} batch {batch_size} padding:"
+                             f" pad_sequences {padding['pad_sequences_ms_per_batch']} ms,"
+                             f" pad_ids {padding['pad_ids_ms_per_batch']} ms per batch")
+                results["padding"].append({"model_type": model_type,
+                                           "batch_size": batch_size,
+                                           **padding})
+    # Peak of the whole process, in KiB on Linux
+    results["max_rss_mib"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return results
+
+def main():
+    args = argument_parser().parse_args()
+    logging_setup(args)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bicleaner-ai-benchmark.")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = benchmark(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(results, json.load(args.baseline), args.tolerance)
+        results["regressions"] = regressions
+        for r in regressions:
+            logging.warning(f"Regression in {r['model_type']} block {r['block_size']}"
+                            f" batch {r['batch_size']}: {r['metric']}"
+                            f" {r['baseline']} -> {r['value']} ({r['change']:+.1%})")
+    json.dump(results, args.output, indent=1)
+    args.output.write("\n")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
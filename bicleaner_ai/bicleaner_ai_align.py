@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import os
+# Suppress Tenssorflow logging messages unless log level is explictly set
+if 'TF_CPP_MIN_LOG_LEVEL' not in os.environ:
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import sys
+import logging
+import traceback
+
+from timeit import default_timer
+
+#Allows to load modules while inside or outside the package
+try:
+    from .alignment import align, argument_parser, load_classifier
+    from .util import logging_setup
+except (ImportError, SystemError):
+    from alignment import align, argument_parser, load_classifier
+    from util import logging_setup
+
+def initialization():
+    # Validating & parsing arguments
+    parser = argument_parser()
+    args = parser.parse_args()
+
+    # Set up logging
+    logging_setup(args)
+    import tensorflow as tf
+
+    # Set number of processes to be used by TensorFlow
+    tf.config.threading.set_intra_op_parallelism_threads(args.processes)
+    tf.config.threading.set_inter_op_parallelism_threads(args.processes)
+
+    args.clf = load_classifier(args.metadata)
+    return args
+
+def main(args):
+    time_start = default_timer()
+    logging.info("Starting process")
+
+    npairs = align(args)
+
+    elapsed_time = default_timer() - time_start
+    logging.info("Total: {0} pairs".format(npairs))
+    logging.info("Elapsed time {0:.2f} s".format(elapsed_time))
+    logging.info("Troughput: {0} pairs/s".format(int((npairs*1.0)/elapsed_time)))
+    logging.info("Program finished")
+
+if __name__ == '__main__':
+    try:
+        logging_setup()
+        args = initialization() # Parsing parameters
+        main(args)  # Running main program
+    except Exception:
+        tb = traceback.format_exc()
+        logging.error(tb)
+        sys.exit(1)
@@ -8,16 +8,37 @@ import logging
 import traceback
 
 from timeit import default_timer
+from functools import partial
 
 #Allows to load modules while inside or outside the package
 try:
     from .classify import classify, argument_parser, load_metadata
+    from .arrow_io import classify_arrow, resolve_formats
+    from .coordinator import run_worker
+    from .sampling import estimate
+    from .perf import timers
+    from .profiling import Profiler
+    from .memory import MemoryMonitor
+    from .paired import paired_input
+    from .autotune import autotune, apply_tuning
+    from .affinity import pin, describe
     from .util import logging_setup
     from .tokenizer import Tokenizer
+    from .stats import ScoreStats
 except (ImportError, SystemError):
     from classify import classify, argument_parser, load_metadata
+    from arrow_io import classify_arrow, resolve_formats
+    from coordinator import run_worker
+    from sampling import estimate
+    from perf import timers
+    from profiling import Profiler
+    from memory import MemoryMonitor
+    from paired import paired_input
+    from autotune import autotune, apply_tuning
+    from affinity import pin, describe
     from util import logging_setup
     from tokenizer import Tokenizer
+    from stats import ScoreStats
 
 logging_level = 0
 
@@ -32,11 +53,20 @@ def initialization():
     # Set up logging
     logging_setup(args)
     logging_level = logging.getLogger().level
+
+    # Trials run in subprocesses, before TensorFlow is initialized here
+    if args.autotune:
+        autotune(args)
+    apply_tuning(args, sys.argv[1:])
+    # Before TensorFlow starts its thread pools, that inherit the affinity
+    if args.cpu_affinity is not None and pin(args.cpu_affinity):
+        if args.intra_threads is None:
+            args.intra_threads = len(args.cpu_affinity)
     import tensorflow as tf
 
     # Set number of processes to be used by TensorFlow
-    tf.config.threading.set_intra_op_parallelism_threads(args.processes)
-    tf.config.threading.set_inter_op_parallelism_threads(args.processes)
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_threads or args.processes)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_threads or args.processes)
 
     # Load metadata YAML
     args = load_metadata(args, parser)
@@ -47,16 +77,58 @@ def initialization():
 def perform_classification(args):
     time_start = default_timer()
     logging.info("Starting process")
+    timers.reset()
+    timers.labels["placement"] = "unpinned" if args.cpu_affinity is None else describe(args.cpu_affinity)
+    timers.interval = args.perf_interval
+    timers.install_signal_handler()
+    args.profiler = Profiler.from_args(args)
+    if args.profiler is not None:
+        args.profiler.start()
+    args.memory = MemoryMonitor.from_args(args)
+
+    # Raw scores are not probabilities, --threshold does not apply to them
+    if args.raw_output and (args.kept_tus or args.discarded_tus or args.discarded_reasons_dir or args.paired_output):
+        raise Exception("Routing to kept or discarded files is not supported with --raw_output")
+    if args.raw_output and args.stats:
+        raise Exception("--stats is not supported with --raw_output")
 
     # Score sentences
-    nline = classify(args, args.input, args.output)
+    if args.paired is not None:
+        nline = classify(args, paired_input(args), args.output)
+    elif args.estimate is not None:
+        nline = estimate(args, args.input, args.output)
+    elif args.coordinator is not None:
+        if args.kept_tus or args.discarded_tus or args.discarded_reasons_dir or args.paired_output:
+            raise Exception("Routing to kept or discarded files is not supported with --coordinator")
+        # Statistics of all the ranges classified by this worker
+        # Ranges are served out of order, rolling means would mix them
+        args.stats_window = None
+        stats = ScoreStats.from_args(args)
+        nline = run_worker(args, partial(classify, merge_stats=stats))
+        if stats is not None:
+            stats.save(args.stats)
+            logging.info(stats.report())
+    elif resolve_formats(args):
+        nline = classify_arrow(args)
+    else:
+        nline = classify(args, args.input, args.output)
+
+    if args.profiler is not None:
+        args.profiler.stop()
 
     # Stats
     logging.info("Finished")
     elapsed_time = default_timer() - time_start
     logging.info("Total: {0} rows".format(nline))
     logging.info("Elapsed time {0:.2f} s".format(elapsed_time))
-    logging.info("Troughput: {0} rows/s".format(int((nline*1.0)/elapsed_time)))
+    logging.info("Troughput: {0} rows/s, {1}".format(int((nline*1.0)/elapsed_time), timers.labels["placement"]))
+    spm = getattr(args.clf, "spm", None)
+    if spm is not None and spm.cache is not None:
+        logging.info(spm.cache.report())
+    logging.info(timers.report())
+    logging.info(args.memory.report())
+    if args.perf_output is not None:
+        timers.save(args.perf_output)
 
 def main(args):
     perform_classification(args)
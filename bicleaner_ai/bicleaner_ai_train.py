@@ -21,12 +21,18 @@ try:
     from .util import *
     from .training import build_noise, write_metadata
     from .tokenizer import Tokenizer
+    from .profiling import Profiler
+    from .paired import parallel_input
+    from .encoded import encoded_dataset, encoded_dataset_exists
 except (SystemError, ImportError):
     from word_freqs_zipf import WordZipfFreqDist
     from word_freqs_zipf_double_linked import WordZipfFreqDistDoubleLinked
     from util import *
     from training import build_noise, write_metadata
     from tokenizer import Tokenizer
+    from profiling import Profiler
+    from paired import parallel_input
+    from encoded import encoded_dataset, encoded_dataset_exists
 
 logging_level = 0
 
@@ -41,22 +47,29 @@ def initialization():
     groupM.add_argument('-s', '--source_lang', required=True, help="Source language")
     groupM.add_argument('-t', '--target_lang', required=True, help="Target language")
     groupM.add_argument('--mono_train', type=argparse.FileType('r'), default=None, required=False, help="File containing monolingual sentences of both languages shuffled together, used to train SentencePiece embeddings. Not required for XLMR.")
-    groupM.add_argument('--parallel_train', type=argparse.FileType('r'), default=None, required=True, help="TSV file containing parallel sentences to train the classifier")
-    groupM.add_argument('--parallel_valid', type=argparse.FileType('r'), default=None, required=True, help="TSV file containing parallel sentences for validation")
+    groupM.add_argument('--parallel_train', nargs='+', default=None, required=True, help="TSV file containing parallel sentences to train the classifier, or source and target files aligned line by line. Files can be compressed (.gz, .bz2, .xz)")
+    groupM.add_argument('--parallel_valid', nargs='+', default=None, required=True, help="TSV file containing parallel sentences for validation, or source and target files aligned line by line. Files can be compressed (.gz, .bz2, .xz)")
 
     groupO = parser.add_argument_group('Options')
     groupO.add_argument('-S', '--source_tokenizer_command', help="Source language tokenizer full command")
     groupO.add_argument('-T', '--target_tokenizer_command', help="Target language tokenizer full command")
+    groupO.add_argument('--tokenizer_processes', type=check_positive, default=1, help="Number of processes of the tokenizer command started by each noise generation worker")
+    groupO.add_argument('--tokenizer_timeout', type=check_positive, default=600, help="Seconds to wait for the output of the tokenizer command before restarting it")
     #groupO.add_argument('-f', '--source_word_freqs', type=argparse.FileType('r'), default=None, required=False, help="L language gzipped list of word frequencies")
     groupO.add_argument('-F', '--target_word_freqs', type=argparse.FileType('r'), default=None, required=False, help="R language gzipped list of word frequencies (needed for frequence based noise)")
     groupO.add_argument('--block_size', type=check_positive, default=10000, help="Sentence pairs per block when apliying multiprocessing in the noise function")
     groupO.add_argument('-p', '--processes', type=check_positive, default=max(1, cpu_count()-1), help="Number of process to use")
+    groupO.add_argument('--pin_workers', action='store_true', default=False, help="Pin each noise generation worker to its own set of the available CPUs, within a NUMA node when possible")
     groupO.add_argument('-g', '--gpu', type=check_positive_or_zero, help="Which GPU use, starting from 0. Will set the CUDA_VISIBLE_DEVICES.")
     groupO.add_argument('--mixed_precision', action='store_true', default=False, help="Use mixed precision float16 for training")
     groupO.add_argument('--save_train', type=str, default=None, help="Save the generated training dataset into a file. If the file already exists the training dataset will be loaded from there.")
     groupO.add_argument('--save_valid', type=str, default=None, help="Save the generated validation dataset into a file. If the file already exists the validation dataset will be loaded from there.")
+    groupO.add_argument('--encode_dataset', type=str, default=None, help="Directory where the training and validation datasets are saved encoded with the SentencePiece model, so they are not tokenized in each epoch. If it already has them they are used instead of building new ones. Not available for XLMR.")
     groupO.add_argument('--distilled', action='store_true', help='Enable Knowledge Distillation training. It needs pre-built training set with raw scores from a teacher model.')
     groupO.add_argument('--seed', default=None, type=int, help="Seed for random number generation. By default, no seeed is used.")
+    groupO.add_argument('--profile', type=str, default=None, help="Directory where a cProfile of the run, a TensorFlow profiler trace of --profile_steps training steps and a summary of the hotspots are written")
+    groupO.add_argument('--profile_start', type=check_positive_or_zero, default=10, help="Training step where the TensorFlow trace of --profile starts")
+    groupO.add_argument('--profile_steps', type=check_positive, default=5, help="Number of training steps traced with the TensorFlow profiler")
 
     # Classifier training options
     groupO.add_argument('--classifier_type', choices=model_classes.keys(), default="dec_attention", help="Neural network architecture of the classifier")
@@ -64,6 +77,7 @@ def initialization():
     groupO.add_argument('--steps_per_epoch', type=check_positive, default=None, help="Number of batch updates per epoch during training. If None, default architecture value will be used or the full dataset size.")
     groupO.add_argument('--epochs', type=check_positive, default=None, help="Number of epochs for training. If None, default architecture value will be used.")
     groupO.add_argument('--patience', type=check_positive, default=None, help="Stop training when validation has stopped improving after PATIENCE number of epochs")
+    groupO.add_argument('--early_exit_layers', type=check_positive, nargs='+', default=None, help="XLMR only. Encoder layers (starting in 1) where early exit classification heads are attached and trained after fine-tuning.")
 
     # Negative sampling options
     groupO.add_argument('--pos_ratio', default=1, type=int, help="Ratio of positive samples used to oversample on validation and test sets")
@@ -96,11 +110,17 @@ def initialization():
     groupL.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
 
     args = parser.parse_args()
+    args.parallel_train = parallel_input(args.parallel_train)
+    args.parallel_valid = parallel_input(args.parallel_valid)
 
     if args.freq_ratio > 0 and args.target_word_freqs is None:
         raise Exception("Frequence based noise needs target language word frequencies")
     if args.mono_train is None and args.classifier_type != 'xlmr':
         raise Exception("Argument --mono_train not found, required when not training XLMR classifier")
+    if args.early_exit_layers is not None and args.classifier_type != 'xlmr':
+        raise Exception("Argument --early_exit_layers is only supported by XLMR classifier")
+    if args.encode_dataset is not None and args.classifier_type == 'xlmr':
+        raise Exception("Argument --encode_dataset is not supported by XLMR classifier")
 
     if args.seed is not None:
         np.random.seed(args.seed)
@@ -160,9 +180,18 @@ def perform_training(args):
         from hardrules.training import train_porn_removal
         train_porn_removal(args)
 
+    # Pre-encoded datasets are used instead of building new ones
+    encoded_train = encoded_valid = None
+    if args.encode_dataset is not None:
+        encoded_train = os.path.join(args.encode_dataset, "train")
+        encoded_valid = os.path.join(args.encode_dataset, "valid")
+
     # If save_train is not provided or empty build new train set
     # otherwise use the prebuilt training set
-    if (args.save_train is None
+    if encoded_train is not None and encoded_dataset_exists(encoded_train):
+        train_sentences = None
+        logging.info("Using pre-encoded training set: " + encoded_train)
+    elif (args.save_train is None
             or not os.path.isfile(args.save_train)
             or os.stat(args.save_train).st_size == 0):
         logging.info("Building training set")
@@ -174,7 +203,10 @@ def perform_training(args):
         logging.info("Using pre-built training set: " + train_sentences)
 
     # Same for valid set
-    if (args.save_valid is None
+    if encoded_valid is not None and encoded_dataset_exists(encoded_valid):
+        valid_sentences = None
+        logging.info("Using pre-encoded validation set: " + encoded_valid)
+    elif (args.save_valid is None
             or not os.path.isfile(args.save_valid)
             or os.stat(args.save_valid).st_size == 0):
         logging.info("Building validation set")
@@ -203,7 +235,8 @@ def perform_training(args):
     model_settings = {
         "batch_size": args.batch_size,
         "epochs": args.epochs,
-        "steps_per_epoch": args.steps_per_epoch
+        "steps_per_epoch": args.steps_per_epoch,
+        "early_exit_layers": args.early_exit_layers,
     }
     # Avoid overriding settings with None
     model_settings = {k:v for k,v in model_settings.items() if v is not None }
@@ -217,13 +250,28 @@ def perform_training(args):
             classifier.load_spm()
             classifier.load_embed()
         except:
-            classifier.train_vocab(args.mono_train, args.processes)
-
-    y_true, y_pred = classifier.train(train_sentences, valid_sentences)
-
-    if args.save_train is not None and train_sentences != args.save_train:
+            classifier.train_vocab(args.mono_train, args.processes,
+                                   sample_file_lines(args.mono_train, classifier.spm_input_sentences))
+
+    train_set, valid_set = train_sentences, valid_sentences
+    if args.encode_dataset is not None:
+        # Encoded with the generator the classifier trains with
+        generator = classifier.get_generator(classifier.settings["batch_size"], shuffle=False)
+        train_set = encoded_dataset(generator, train_sentences, encoded_train)
+        valid_set = encoded_dataset(generator, valid_sentences, encoded_valid)
+
+    profiler = Profiler.from_args(args)
+    if profiler is not None:
+        classifier.callbacks.append(profiler.keras_callback())
+        profiler.start()
+    y_true, y_pred = classifier.train(train_set, valid_set)
+    if profiler is not None:
+        profiler.stop()
+
+    if train_sentences is not None and args.save_train is not None and train_sentences != args.save_train:
         os.unlink(train_sentences)
-    os.unlink(valid_sentences)
+    if valid_sentences is not None:
+        os.unlink(valid_sentences)
     logging.info("End training")
 
     args.metadata = open(args.model_dir + '/metadata.yaml', 'w+')
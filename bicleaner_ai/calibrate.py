@@ -26,6 +26,8 @@ parser.add_argument('-p', '--processes', type=check_positive, default=max(1, cpu
 parser.add_argument('--block_size', type=check_positive, default=10000, help="Sentence pairs per block when apliying multiprocessing in the noise function")
 parser.add_argument('-S', '--source_tokenizer_command', help="Source language tokenizer full command")
 parser.add_argument('-T', '--target_tokenizer_command', help="Target language tokenizer full command")
+parser.add_argument('--tokenizer_processes', type=check_positive, default=1, help="Number of processes of the tokenizer command started by each noise generation worker")
+parser.add_argument('--tokenizer_timeout', type=check_positive, default=600, help="Seconds to wait for the output of the tokenizer command before restarting it")
 parser.add_argument('-s', '--source_lang', required=True, help="Source language")
 parser.add_argument('-t', '--target_lang', required=True, help="Target language")
 # Negative sampling options
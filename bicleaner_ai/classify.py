@@ -1,7 +1,8 @@
 from hardrules.hardrules import Hardrules
 from multiprocessing import cpu_count
 from tempfile import gettempdir
-import tensorflow as tf
+from itertools import repeat
+from time import perf_counter
 import numpy as np
 import traceback
 import argparse
@@ -10,13 +11,22 @@ import logging
 import yaml
 import sys
 import os
-import gc
 
 #Allows to load modules while inside or outside the package
 try:
     from .util import check_positive, check_positive_or_zero, check_positive_between_zero_and_one, logging_setup, get_model
+    from .router import OutputRouter, hardrules_reasons, WRONG_COLUMNS, INVALID_UTF8, LINE_TOO_LONG, EMPTY_SENTENCE
+    from .stats import ScoreStats
+    from .perf import timers
+    from .autotune import default_tuning_file
+    from .affinity import cpulist
 except (ImportError, SystemError):
     from util import check_positive, check_positive_or_zero, check_positive_between_zero_and_one, logging_setup, get_model
+    from router import OutputRouter, hardrules_reasons, WRONG_COLUMNS, INVALID_UTF8, LINE_TOO_LONG, EMPTY_SENTENCE
+    from stats import ScoreStats
+    from perf import timers
+    from autotune import default_tuning_file
+    from affinity import cpulist
 
 __author__ = "Jaume Zaragoza"
 __version__ = "Version 1.0 # 14/06/2021 #"
@@ -44,12 +54,43 @@ def argument_parser():
     groupO.add_argument('-b', '--block_size', type=int, default=1000, help="Sentence pairs per block")
     groupO.add_argument('-p', '--processes', type=int, default=max(1, cpu_count()-1), help="Number of processes to use")
     groupO.add_argument('--batch_size', type=int, default=32, help="Sentence pairs per block")
+    groupO.add_argument('--intra_threads', type=check_positive, default=None, help="TensorFlow threads to run each operation, --processes by default")
+    groupO.add_argument('--inter_threads', type=check_positive, default=None, help="TensorFlow threads to run independent operations, --processes by default")
+    groupO.add_argument('--cpu_affinity', type=cpulist, default=None, help="Pin the process and its TensorFlow threads to a list of CPUs like '0-7,16-23'. --intra_threads is the number of CPUs by default")
+    groupO.add_argument('--autotune', action='store_true', help="Before classifying, search the fastest block size, batch size, TensorFlow threads and number of workers for this model and host on a sample of the input, and save them to --tuning_file")
+    groupO.add_argument('--autotune_lines', type=check_positive, default=20000, help="Lines of the input sample classified in each --autotune trial")
+    groupO.add_argument('--autotune_time', type=check_positive, default=1800, help="Time budget in seconds of --autotune")
+    groupO.add_argument('--autotune_max_memory', type=check_positive, default=None, help="Memory cap in MiB of --autotune trials, configurations above it are discarded. 80%% of the system memory by default")
+    groupO.add_argument('--tuning_file', type=str, default=default_tuning_file(), help="File with the configuration found by --autotune for each model in this host. Its block size, batch size and threads are used unless given in the command line")
+    groupO.add_argument('--no_tuning', action='store_true', help="Do not use the configuration of --tuning_file")
+    groupO.add_argument('--input_format', choices=['auto', 'tsv', 'parquet', 'arrow'], default='auto', help="Input file format. 'auto' guesses it from the file extension (.parquet, .pq, .arrow, .feather, .ipc). With Parquet or Arrow input --scol and --tcol are column positions, or column names if --header is set")
+    groupO.add_argument('--output_format', choices=['auto', 'tsv', 'parquet', 'arrow'], default='auto', help="Output file format. 'auto' guesses it from the file extension, Arrow IPC stream for standard output with columnar input")
+    groupO.add_argument('--paired', type=str, default=None, help="Target language file aligned line by line with the input, that is the source language file. Both files can be compressed (.gz, .bz2, .xz). Output has source, target and score columns")
+    groupO.add_argument('--paired_output', type=str, nargs=2, default=None, metavar=('SOURCE', 'TARGET'), help="Source and target files where the sentences of TUs scored above or equal to --threshold are written, compressed according to their extension")
+    groupO.add_argument('--coordinator', type=str, default=None, help="Address of a coordinator (python -m bicleaner_ai.coordinator) to classify the input ranges it serves instead of the input file. Use '-' as input and output")
+    groupO.add_argument('--max_memory', type=check_positive, default=None, help="Memory cap in MiB. Block size and encoding cache are reduced when RSS gets close to it")
+    groupO.add_argument('--max_line_bytes', type=check_positive_or_zero, default=0, help="Lines longer than this number of bytes are scored 0 without parsing them. 0 means no limit")
 
     groupO.add_argument('--tmp_dir', default=gettempdir(), help="Temporary directory where creating the temporary files of this program")
-    groupO.add_argument('-d', '--discarded_tus', type=argparse.FileType('w'), default=None, help="TSV file with discarded TUs. Discarded TUs by the classifier are written in this file in TSV file.")
+    groupO.add_argument('-d', '--discarded_tus', type=str, default=None, help="TSV file with discarded TUs. TUs discarded by hard rules or scored below --threshold are written in this file in TSV format.")
+    groupO.add_argument('--kept_tus', type=str, default=None, help="TSV file with kept TUs. TUs scored above or equal to --threshold are written in this file in TSV format.")
+    groupO.add_argument('--discarded_reasons_dir', type=str, default=None, help="Directory where TUs discarded by hard rules are written, one TSV file per rule.")
+    groupO.add_argument('--threshold', type=check_positive_between_zero_and_one, default=0.5, help="Score threshold to route TUs to --kept_tus or --discarded_tus")
+    groupO.add_argument('--estimate', type=check_positive, default=None, help="Instead of classifying the whole input, score this number of lines sampled at random offsets and write a JSON report with estimated score quantiles and kept fraction at --threshold, with confidence intervals. Needs an input file")
+    groupO.add_argument('--estimate_seed', type=int, default=None, help="Random seed for --estimate")
+    groupO.add_argument('--stats', type=str, default=None, help="JSON file where score quantiles, histogram, discarded TUs by reason and rolling mean scores are written. Files of several shards can be merged with 'python -m bicleaner_ai.stats'")
+    groupO.add_argument('--stats_bins', type=check_positive, default=100, help="Number of bins of the score histogram in --stats")
+    groupO.add_argument('--stats_window', type=check_positive, default=100000, help="Number of lines of each rolling mean score in --stats, not computed with --coordinator")
+    groupO.add_argument('--perf_interval', type=check_positive_or_zero, default=0, help="Log time spent in each stage (read, parse, hardrules, encode, model, format) and counters every this number of seconds. 0 logs them only at the end. Also logged when receiving SIGUSR1")
+    groupO.add_argument('--perf_output', type=str, default=None, help="File where stage timers and counters are written at exit, in Prometheus text format if it ends in .prom or JSON otherwise")
+    groupO.add_argument('--profile', type=str, default=None, help="Directory where a cProfile of the run, a TensorFlow profiler trace of --profile_steps blocks and a summary of the hotspots are written")
+    groupO.add_argument('--profile_start', type=check_positive_or_zero, default=2, help="Block where the TensorFlow trace of --profile starts, after the warm-up")
+    groupO.add_argument('--profile_steps', type=check_positive, default=5, help="Number of blocks traced with the TensorFlow profiler")
     groupO.add_argument('--score_only',action='store_true', help="Only output one column which is the bicleaner score", default=False)
     groupO.add_argument('--calibrated',action='store_true', help="Output calibrated scores", default=False)
-    groupO.add_argument('--raw_output',action='store_true', help="Return raw output without computing positive class probability.", default=False)
+    groupO.add_argument('--raw_output',action='store_true', help="Return raw output without computing positive class probability. Not compatible with --kept_tus, --discarded_tus, --discarded_reasons_dir, --paired_output and --stats", default=False)
+    groupO.add_argument('--early_exit_threshold', type=check_positive_between_zero_and_one, default=None, help="Enable early exit for XLMR models trained with --early_exit_layers. Samples whose intermediate confidence passes the threshold skip the remaining layers. The exit layer is written as an extra column.")
+    groupO.add_argument('--fold_embeddings', action='store_true', default=False, help="Lite models only. Rebuild the model for inference with the embedding projection folded into the embedding tables, without Dropout and with fused softmax. Kept only if its outputs match the original model.")
     groupO.add_argument('--lm_threshold',type=check_positive_between_zero_and_one, default=0.5, help="Threshold for language model fluency scoring. All TUs whose LM fluency score falls below the threshold will are removed (classifier score set to 0), unless the option --keep_lm_result set.")
 
     groupO.add_argument('--disable_hardrules',action = 'store_true', help = "Disables the bicleaner_hardrules filtering (only bicleaner_classify is applied)")
@@ -94,7 +135,15 @@ def load_metadata(args, parser):
             cal_params = None
         args.clf = get_model(metadata_yaml["classifier_type"])(yamlpath,
                                                 metadata_yaml["classifier_settings"])
+        if args.early_exit_threshold is not None:
+            if not args.clf.settings.get("early_exit_layers"):
+                raise Exception("--early_exit_threshold needs a model trained with early exit layers")
+            args.clf.settings["early_exit_threshold"] = args.early_exit_threshold
         args.clf.load()
+        if args.fold_embeddings:
+            if not hasattr(args.clf, "fold_embeddings"):
+                raise Exception("--fold_embeddings is only available for lite (dec_attention) models")
+            args.clf.fold_embeddings()
 
         if "disable_lang_ident" in metadata_yaml:
             args.disable_lang_ident = metadata_yaml["disable_lang_ident"]
@@ -143,20 +192,55 @@ def load_metadata(args, parser):
     return args
 
 
+# Returns the reasons to discard a sentence pair without scoring it
+# or None if it has to be scored
+def discard_reasons(args, hardrules, sl_sentence, tl_sentence):
+    if args.raw_output:
+        return None
+    if not (sl_sentence and tl_sentence):
+        return [EMPTY_SENTENCE]
+    if not args.disable_hardrules:
+        wrong_tu = hardrules.wrong_tu(sl_sentence, tl_sentence)
+        if wrong_tu != False:
+            return hardrules_reasons(wrong_tu)
+    return None
+
+# Strip a line read as bytes like str.strip() does with the decoded line
+# only lines with non ASCII or separator characters at the ends need decoding
+def strip_line(line):
+    line = line.strip()
+    if line and (line[0] >= 0x80 or 0x1c <= line[0] <= 0x1f
+                 or line[-1] >= 0x80 or 0x1c <= line[-1] <= 0x1f):
+        line = line.decode("utf-8", errors="surrogateescape").strip() \
+                   .encode("utf-8", errors="surrogateescape")
+    return line
+
 # Classify sentences from input and place them at output
 # that can be either files or stdin/stdout
-def classify(args, input, output):
+# Input is read as bytes, only source and target columns are decoded
+# Score statistics are saved to --stats, or merged into merge_stats
+# when the caller classifies several ranges and saves them at the end
+def classify(args, input, output, merge_stats=None):
     nline = 0
     buf_sent = []
     buf_sent_sl = []
     buf_sent_tl = []
     buf_score = []
+    buf_reason = []
     hardrules = Hardrules(args)
+    router = OutputRouter.from_args(args)
+    stats = ScoreStats.from_args(args)
+    profiler = getattr(args, "profiler", None)
+    memory = getattr(args, "memory", None)
+
+    # Use the underlying binary streams of text files
+    input = getattr(input, "buffer", input)
+    output = getattr(output, "buffer", output)
 
     # Process input and output headers
     if args.header:
         args.header = False # We only need to execute the following code once
-        header = next(input).strip().split("\t")
+        header = strip_line(next(input)).decode("utf-8").split("\t")
 
         # Transform fields to idxs
         if args.scol not in header:
@@ -166,64 +250,121 @@ def classify(args, input, output):
 
         args.scol = int(header.index(args.scol)) + 1
         args.tcol = int(header.index(args.tcol)) + 1
+        if router is not None and router.kept_paired is not None:
+            router.kept_paired.columns = (args.scol, args.tcol)
 
-        output_header = header
+        output_header = header + ["bicleaner_ai_score"]
+        if args.early_exit_threshold is not None:
+            output_header.append("bicleaner_ai_exit_layer")
+        if router is not None:
+            router.write_header(('\t'.join(output_header) + '\n').encode("utf-8"))
 
         if args.score_only:
-            output_header = ["bicleaner_ai_score"]
-        else:
-            output_header.append("bicleaner_ai_score")
+            output_header = output_header[len(header):]
 
         # Write the output header once
-        output.write('\t'.join(output_header) + '\n')
+        output.write(('\t'.join(output_header) + '\n').encode("utf-8"))
+
+    # Lines are only needed to write them back
+    if args.score_only and router is None:
+        buf_sent = None
+    # Columns after the last sentence column are never split
+    maxsplit = max(args.scol, args.tcol)
+
+    # Stage times are accumulated per line and added once per block
+    t_read = t_parse = t_hardrules = 0.0
+    t_end = perf_counter()
 
     # Read from input file/stdin
     for line in input:
         nline += 1
-        parts = line.split("\t")
+        t_start = perf_counter()
+        t_read += t_start - t_end
 
         # Parse fields and buffer sentences
         sl_sentence=None
         tl_sentence=None
-        if len(parts) >= max(args.scol, args.tcol):
-            sl_sentence=parts[args.scol -1].strip()
-            tl_sentence=parts[args.tcol -1].strip()
+        reason = None
+        if args.max_line_bytes and len(line) > args.max_line_bytes:
+            logging.debug(f"Line {nline} longer than {args.max_line_bytes} bytes")
+            reason = [LINE_TOO_LONG]
         else:
-            logging.error("ERROR: scol ({}) or tcol ({}) indexes above column number ({}) on line {}".format(args.scol, args.tcol, len(parts), nline))
+            parts = line.split(b"\t", maxsplit)
+            if len(parts) >= maxsplit:
+                try:
+                    sl_sentence=parts[args.scol -1].decode("utf-8").strip()
+                    tl_sentence=parts[args.tcol -1].decode("utf-8").strip()
+                except UnicodeDecodeError:
+                    logging.error(f"ERROR: invalid UTF-8 on line {nline}")
+                    reason = [INVALID_UTF8]
+            else:
+                logging.error("ERROR: scol ({}) or tcol ({}) indexes above column number ({}) on line {}".format(args.scol, args.tcol, len(parts), nline))
+                reason = [WRONG_COLUMNS]
 
-        buf_sent.append(line)
+        if buf_sent is not None:
+            buf_sent.append(line)
+        t_parsed = perf_counter()
+        t_parse += t_parsed - t_start
 
         # Buffer sentences that are not empty and pass hardrules
         # buffer all sentences in raw mode
-        if args.raw_output or (sl_sentence and tl_sentence \
-                and (args.disable_hardrules or hardrules.wrong_tu(sl_sentence, tl_sentence) == False)):
+        if reason is None:
+            reason = discard_reasons(args, hardrules, sl_sentence, tl_sentence)
+        t_end = perf_counter()
+        t_hardrules += t_end - t_parsed
+
+        if reason is None:
             buf_score.append(1)
             buf_sent_sl.append(sl_sentence)
             buf_sent_tl.append(tl_sentence)
         else:
             buf_score.append(0)
+        buf_reason.append(reason)
 
         # Score batch and empty buffers
-        if (nline % args.block_size) == 0:
-            classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score)
-            buf_sent = []
+        # block size can change between blocks with --max_memory
+        if len(buf_score) >= args.block_size:
+            add_line_timers(len(buf_score), t_read, t_parse, t_hardrules)
+            t_read = t_parse = t_hardrules = 0.0
+            classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score, buf_reason, router, stats)
+            if buf_sent is not None:
+                buf_sent = []
             buf_sent_sl = []
             buf_sent_tl = []
             buf_score = []
-
-        # Avoid memory not beeing freed too late
-        if (nline % 1e6) == 0:
-            gc.collect()
-            tf.keras.backend.clear_session()
+            buf_reason = []
+            timers.maybe_log()
+            if profiler is not None:
+                profiler.step()
+            if memory is not None:
+                memory.step(args)
+            t_end = perf_counter()
 
     # Score remaining sentences
-    if len(buf_sent) > 0:
-        classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score)
-
+    add_line_timers(len(buf_score), t_read, t_parse, t_hardrules)
+    if len(buf_score) > 0:
+        classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score, buf_reason, router, stats)
+
+    if router is not None:
+        router.close()
+    if stats is not None and merge_stats is not None:
+        merge_stats.merge(stats)
+    elif stats is not None:
+        stats.save(args.stats)
+        logging.info(stats.report())
     return nline
 
+def add_line_timers(nlines, t_read, t_parse, t_hardrules):
+    timers.add("read", t_read, nlines)
+    timers.add("parse", t_parse, nlines)
+    timers.add("hardrules", t_hardrules, nlines)
+    timers.count("lines", nlines)
+
 # Score a batch of sentences
-def classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score):
+# buf_sent can be None when only scores are written
+# lines are also written to the router sinks if there is one
+# and their scores added to the statistics
+def classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score, buf_reason, router=None, stats=None):
     # Classify predictions
     if len(buf_sent_tl) > 0 and len(buf_sent_sl) > 0:
         predictions = args.clf.predict(buf_sent_sl, buf_sent_tl,
@@ -233,28 +374,45 @@ def classify_batch(args, output, buf_sent, buf_sent_sl, buf_sent_tl, buf_score):
     else:
         predictions = []
     p = iter(predictions)
+    # Layer where each prediction exited with early exit
+    depths = getattr(args.clf, "exit_depths", None)
+    if args.early_exit_threshold is None or not len(predictions):
+        depths = None
+    d = iter(depths) if depths is not None else None
+    if buf_sent is None:
+        buf_sent = repeat(None)
 
     # Print sentences and scores to output
-    for score, sent in zip(buf_score, buf_sent):
+    t_format = perf_counter()
+    out = []
+    values = []
+    for score, sent, reason in zip(buf_score, buf_sent, buf_reason):
         if score == 1:
             clf_score = next(p)
+            value = clf_score[0]
             # Print 2 scores if raw output is enabled
             if args.raw_output and len(clf_score) == 2:
                 outscore = f"{clf_score[0]:.3f}\t{clf_score[1]:.3f}"
             else:
                 outscore = f"{clf_score[0]:.3f}"
+            if d is not None:
+                outscore += f"\t{next(d)}"
+        else:
+            value = 0.0
+            outscore = "0"
+            if args.early_exit_threshold is not None:
+                outscore += "\t0"
 
-            if args.score_only:
-                output.write(outscore)
-            else:
-                output.write(sent.strip())
-                output.write("\t")
-                output.write(outscore)
-            output.write("\n")
+        if sent is not None:
+            outline = strip_line(sent) + b"\t" + outscore.encode() + b"\n"
+        if args.score_only:
+            out.append(outscore.encode() + b"\n")
         else:
-            if args.score_only:
-                output.write("0")
-            else:
-                output.write(sent.rstrip("\n"))
-                output.write("\t0")
-            output.write("\n")
+            out.append(outline)
+        if router is not None:
+            router.route(outline, value, reason)
+        values.append(value)
+    output.write(b"".join(out))
+    if stats is not None:
+        stats.update(values, buf_reason)
+    timers.add("format", perf_counter() - t_format)
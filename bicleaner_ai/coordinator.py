@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+'''
+Work-stealing classification coordinator
+
+The coordinator splits the input file in newline-aligned byte ranges
+and serves them to classify workers (bicleaner-ai-classify --coordinator),
+that can run in any node and pull a new range each time they finish one.
+Output of each range is written in input order.
+
+Ranges of workers that disconnect before sending their output are queued
+again. When the queue is empty, idle workers also get a copy of ranges that
+have been running for a long time, the first output received is kept.
+
+Protocol, over TCP (host:port) or Unix sockets (unix:/path):
+ worker: {"op": "get"}
+   coordinator: {"id": id, "header": h, "size": n} + h header bytes + n input bytes
+                {"wait": seconds} if all the ranges are assigned
+                {"done": true} when all the output has been written
+ worker: {"op": "result", "id": id, "header": h, "size": n}
+            + h output header bytes + n output bytes
+   coordinator: {"ok": true}
+'''
+from tempfile import SpooledTemporaryFile, gettempdir
+from timeit import default_timer
+from collections import deque
+import socketserver
+import subprocess
+import threading
+import argparse
+import logging
+import shlex
+import shutil
+import socket
+import json
+import time
+import sys
+import io
+import os
+
+try:
+    from .util import logging_setup
+    from .lineindex import LineIndex
+    from .autotune import tuned_workers, default_tuning_file
+    from .affinity import partition, format_cpulist, describe
+except (ImportError, SystemError):
+    from util import logging_setup
+    from lineindex import LineIndex
+    from autotune import tuned_workers, default_tuning_file
+    from affinity import partition, format_cpulist, describe
+
+# Parse an address, 'unix:/path' for Unix sockets or 'host:port' for TCP
+def parse_address(address):
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise Exception(f"Invalid address '{address}', use host:port or unix:/path")
+    return socket.AF_INET, (host, int(port))
+
+def format_address(family, address):
+    if family == socket.AF_UNIX:
+        return "unix:" + address
+    return f"{address[0]}:{address[1]}"
+
+# Split a file in ranges of about chunk_bytes that end after a newline
+# using the line index of the file if there is one
+def newline_ranges(filename, chunk_bytes, start=0):
+    index = LineIndex.load(filename)
+    if index is not None:
+        return index.ranges(chunk_bytes, start)
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size) - 1)
+            # Byte before the cut is a newline or the cut is moved after the next one
+            if f.read(1) != b"\n":
+                f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def send_message(wfile, message, *payloads):
+    wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+    for payload in payloads:
+        wfile.write(payload)
+    wfile.flush()
+
+def receive_message(rfile):
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+def read_exactly(rfile, size):
+    data = rfile.read(size)
+    if len(data) != size:
+        raise ConnectionError(f"Connection closed, received {len(data)} of {size} bytes")
+    return data
+
+
+class Coordinator(object):
+    '''
+    Queue of input ranges and ordered writer of their output
+    Outputs received out of order are kept in spooled temporary files
+    '''
+
+    def __init__(self, input_file, output, chunk_bytes=16*1024*1024,
+                 header=False, steal_after=60.0, max_attempts=3,
+                 tmp_dir=gettempdir()):
+        self.input_file = input_file
+        self.output = output
+        self.steal_after = steal_after
+        self.max_attempts = max_attempts
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+        self.input_header = b""
+        start = 0
+        if header:
+            with open(input_file, 'rb') as f:
+                self.input_header = f.readline()
+            start = len(self.input_header)
+        self.ranges = newline_ranges(input_file, chunk_bytes, start)
+
+        self.cond = threading.Condition()
+        self.pending = deque(range(len(self.ranges)))
+        self.running = {} # id -> [first assignment time, running copies]
+        self.attempts = [0] * len(self.ranges)
+        self.results = {}
+        self.lines = 0
+        self.output_header = None
+        self.next_id = 0
+        self.error = None
+        self.done = threading.Event()
+        if not self.ranges:
+            self.done.set()
+
+    def assign(self):
+        '''Returns a range id to process, None if finished or -1 to wait'''
+        with self.cond:
+            if self.done.is_set():
+                return None
+            if self.pending:
+                i = self.pending.popleft()
+                if self.attempts[i] >= self.max_attempts:
+                    self.fail(f"Range {i} failed {self.attempts[i]} times")
+                    return None
+                self.attempts[i] += 1
+                self.running.setdefault(i, [default_timer(), 0])[1] += 1
+                return i
+            # Steal the longest running range that has a single copy
+            now = default_timer()
+            for i, (started, copies) in sorted(self.running.items(),
+                                                key=lambda r: r[1][0]):
+                if copies == 1 and now - started > self.steal_after:
+                    logging.info(f"Range {i} running for {now-started:.0f}s, assigning a copy")
+                    self.running[i][1] += 1
+                    return i
+            return -1
+
+    def release(self, i):
+        '''Queue again a range whose worker failed'''
+        with self.cond:
+            if i not in self.running:
+                return
+            self.running[i][1] -= 1
+            if self.running[i][1] == 0:
+                del self.running[i]
+                self.pending.appendleft(i)
+                logging.warning(f"Worker failed, range {i} queued again")
+
+    def complete(self, i, header, data):
+        '''Store the output of a range and write the ready ones in order'''
+        with self.cond:
+            # Workers only send the header with their first output
+            if header and self.output_header is None:
+                self.output_header = header
+            if i not in self.running:
+                # Output of a copy that finished later
+                return
+            del self.running[i]
+            self.lines += data.count(b"\n")
+            spool = SpooledTemporaryFile(max_size=self.chunk_bytes, dir=self.tmp_dir)
+            spool.write(data)
+            self.results[i] = spool
+            self.write_ready()
+
+    def write_ready(self):
+        if self.next_id == 0 and self.output_header and self.next_id in self.results:
+            self.output.write(self.output_header)
+        while self.next_id in self.results:
+            spool = self.results.pop(self.next_id)
+            spool.seek(0)
+            shutil.copyfileobj(spool, self.output)
+            spool.close()
+            self.next_id += 1
+        if self.next_id == len(self.ranges):
+            self.output.flush()
+            self.done.set()
+
+    def fail(self, message):
+        self.error = message
+        self.done.set()
+
+    def read_range(self, i):
+        start, end = self.ranges[i]
+        with open(self.input_file, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    '''Serves ranges to a worker connection until it closes'''
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        assigned = set()
+        try:
+            while True:
+                message = receive_message(self.rfile)
+                if message is None:
+                    break
+                if message["op"] == "get":
+                    i = coordinator.assign()
+                    if i is None:
+                        send_message(self.wfile, {"done": True})
+                        break
+                    elif i < 0:
+                        send_message(self.wfile, {"wait": 1.0})
+                        continue
+                    assigned.add(i)
+                    header = coordinator.input_header
+                    data = coordinator.read_range(i)
+                    send_message(self.wfile,
+                                 {"id": i, "header": len(header), "size": len(data)},
+                                 header, data)
+                elif message["op"] == "result":
+                    i = message["id"]
+                    header = read_exactly(self.rfile, message["header"])
+                    data = read_exactly(self.rfile, message["size"])
+                    coordinator.complete(i, header, data)
+                    assigned.discard(i)
+                    send_message(self.wfile, {"ok": True})
+        except (ConnectionError, OSError, ValueError) as e:
+            logging.warning(f"Worker connection error: {e}")
+        finally:
+            for i in assigned:
+                coordinator.release(i)
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def start_server(coordinator, address):
+    '''Start serving in a background thread, returns the server'''
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixServer(addr, WorkerHandler)
+    else:
+        server = TCPServer(addr, WorkerHandler)
+    server.coordinator = coordinator
+    server.address = format_address(family, server.server_address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Coordinator listening on {server.address}")
+    return server
+
+def connect(address, timeout=60.0):
+    '''Connect to a coordinator, retrying until it is listening'''
+    family, addr = parse_address(address)
+    start = default_timer()
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            return sock
+        except OSError:
+            sock.close()
+            if default_timer() - start > timeout:
+                raise
+            time.sleep(0.5)
+
+# Process ranges served by a coordinator with classify function
+# header lines written by classify are sent apart from the output
+def run_worker(args, classify):
+    sock = connect(args.coordinator)
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+    expects_header = args.header
+    nline = 0
+    try:
+        while True:
+            send_message(wfile, {"op": "get"})
+            message = receive_message(rfile)
+            if message is None:
+                logging.warning("Coordinator closed the connection")
+                break
+            if message.get("done"):
+                break
+            if "wait" in message:
+                time.sleep(message["wait"])
+                continue
+
+            header = read_exactly(rfile, message["header"])
+            data = read_exactly(rfile, message["size"])
+            if expects_header != bool(header):
+                raise Exception("--header has to be set in both the coordinator and the workers")
+            write_header = args.header
+            output = io.BytesIO()
+            nline += classify(args, io.BytesIO(header + data if write_header else data), output)
+            result = output.getvalue()
+            out_header = b""
+            if write_header:
+                end = result.index(b"\n") + 1
+                out_header, result = result[:end], result[end:]
+            send_message(wfile,
+                         {"op": "result", "id": message["id"],
+                          "header": len(out_header), "size": len(result)},
+                         out_header, result)
+            if receive_message(rfile) is None:
+                break
+    finally:
+        sock.close()
+    return nline
+
+def start_local_workers(address, n, metadata, worker_args="", header=False, cpu_sets=None):
+    '''
+    Start classify worker processes in this machine
+    each one pinned to its CPU set if there are CPU sets
+    '''
+    cmd = [sys.executable, "-m", "bicleaner_ai.bicleaner_ai_classifier",
+           "--coordinator", address, "-", "-", metadata]
+    if header:
+        cmd.append("--header")
+    cmd += shlex.split(worker_args)
+    logging.info(f"Starting {n} local workers: {' '.join(cmd)}")
+    workers = []
+    for i in range(n):
+        worker_cmd = cmd
+        if cpu_sets is not None:
+            worker_cmd = cmd + ["--cpu_affinity", format_cpulist(cpu_sets[i])]
+            logging.info(f"Worker {i} pinned to {describe(cpu_sets[i])}")
+        workers.append(subprocess.Popen(worker_cmd, stdin=subprocess.DEVNULL))
+    return workers
+
+def local_workers(value):
+    if value == "auto":
+        return value
+    return int(value)
+
+def argument_parser():
+    parser = argparse.ArgumentParser(prog="python -m bicleaner_ai.coordinator", formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Serve an input file to bicleaner-ai-classify workers and write their output in order")
+    parser.add_argument('input', help="Tab-separated file to be classified")
+    parser.add_argument('output', type=argparse.FileType('wb'), help="Output of the classification")
+
+    groupO = parser.add_argument_group('Optional')
+    groupO.add_argument('--listen', default="localhost:0", help="Address to listen for workers, host:port or unix:/path. Port 0 picks a free port")
+    groupO.add_argument('--chunk_bytes', type=int, default=16*1024*1024, help="Size in bytes of the input ranges served to workers")
+    groupO.add_argument('--header', action='store_true', help="Input file has a header, that is sent to the workers with each range")
+    groupO.add_argument('--steal_after', type=float, default=60.0, help="Seconds after which idle workers get a copy of a running range")
+    groupO.add_argument('--max_attempts', type=int, default=3, help="Times a range is assigned after worker failures before giving up")
+    groupO.add_argument('--local_workers', type=local_workers, default=0, help="Number of classify workers to start in this machine. 'auto' uses the number found by classify --autotune for --metadata")
+    groupO.add_argument('--tuning_file', default=default_tuning_file(), help="Tuning file of classify --autotune for '--local_workers auto'")
+    groupO.add_argument('--pin_workers', action='store_true', help="Pin each local worker and its TensorFlow threads to its own set of the available CPUs, within a NUMA node when possible")
+    groupO.add_argument('--metadata', default=None, help="Training metadata (YAML file) for the local workers")
+    groupO.add_argument('--worker_args', default="", help="Extra classify options for the local workers")
+    groupO.add_argument('--tmp_dir', default=gettempdir(), help="Directory for output received out of order")
+
+    groupL = parser.add_argument_group('Logging')
+    groupL.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    groupL.add_argument('--debug', action='store_true', help='Debug logging mode')
+    groupL.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    logging_setup(args)
+    if args.local_workers and args.metadata is None:
+        raise Exception("--local_workers needs --metadata")
+    if args.local_workers == "auto":
+        args.local_workers, threads = tuned_workers(args.tuning_file, args.metadata)
+        args.worker_args = f"{threads} {args.worker_args}"
+        logging.info(f"Starting {args.local_workers} tuned local workers")
+
+    time_start = default_timer()
+    coordinator = Coordinator(args.input, args.output, args.chunk_bytes,
+                              args.header, args.steal_after,
+                              args.max_attempts, args.tmp_dir)
+    logging.info(f"Serving {len(coordinator.ranges)} ranges of {args.input}")
+    server = start_server(coordinator, args.listen)
+    workers = []
+    placement = "unpinned"
+    if args.local_workers:
+        cpu_sets = None
+        if args.pin_workers:
+            cpu_sets = partition(args.local_workers)
+            placement = f"{args.local_workers} workers pinned to " \
+                        + ", ".join(format_cpulist(c) for c in cpu_sets)
+        workers = start_local_workers(server.address, args.local_workers,
+                                      args.metadata, args.worker_args,
+                                      args.header, cpu_sets)
+    try:
+        while not coordinator.done.wait(1.0):
+            if workers and all(w.poll() is not None for w in workers):
+                coordinator.fail("All local workers exited before finishing")
+    finally:
+        for w in workers:
+            try:
+                w.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                w.kill()
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, UnixServer):
+            os.remove(server.server_address)
+        args.output.close()
+
+    if coordinator.error is not None:
+        raise Exception(coordinator.error)
+    elapsed_time = default_timer() - time_start
+    logging.info("Elapsed time {0:.2f} s".format(elapsed_time))
+    logging.info(f"Throughput: {int(coordinator.lines / elapsed_time)} rows/s, {placement}")
+
+if __name__ == '__main__':
+    main()
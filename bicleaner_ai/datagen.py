@@ -1,23 +1,165 @@
-from tensorflow.keras.preprocessing.sequence import pad_sequences
+from collections import OrderedDict
+from itertools import chain
 import sentencepiece as sp
 import tensorflow as tf
 import numpy as np
+import hashlib
+import sys
+
+try:
+    from .perf import timers
+    from .encoded import EncodedDataset
+except (SystemError, ImportError):
+    from perf import timers
+    from encoded import EncodedDataset
+
+class EncodingCache(object):
+    '''
+    Bounded LRU cache from sentence to its encoded int32 ids
+    Memory is capped by the bytes taken by the entries, not by their count
+    '''
+    # Approximate per-entry cost of the OrderedDict node and array header
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry_size(self, key, ids):
+        return sys.getsizeof(key) + ids.nbytes + self.ENTRY_OVERHEAD
+
+    def get(self, key):
+        ids = self.entries.get(key)
+        if ids is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return ids
+
+    def put(self, key, ids):
+        if key in self.entries:
+            return
+        size = self.entry_size(key, ids)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = ids
+        self.nbytes += size
+        self.evict()
+
+    def evict(self):
+        '''Drop least recently used entries until under the byte cap'''
+        while self.nbytes > self.max_bytes and self.entries:
+            key, ids = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_size(key, ids)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        return (f"Encoding cache: {self.hit_rate()*100:.1f}% hit rate"
+                f" ({self.hits} hits, {self.misses} misses),"
+                f" {len(self)} entries, {self.nbytes/2**20:.1f} MiB")
+
+class IdBuffers(object):
+    '''
+    Reusable int32 matrices of padded ids, one per input and row length
+    Each matrix grows to the largest batch requested
+    and smaller batches get a view of its first rows
+    '''
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, rows, cols):
+        buf = self.buffers.get((name, cols))
+        if buf is None or len(buf) < rows:
+            buf = np.zeros((rows, cols), dtype=np.int32)
+            self.buffers[(name, cols)] = buf
+            timers.count("id_buffer_allocations")
+        else:
+            timers.count("id_buffer_reuses")
+        return buf[:rows]
+
+    def clear(self):
+        self.buffers.clear()
+
+def pad_ids(ids, maxlen, out=None):
+    '''
+    Write sequences of ids truncated and padded with zeros at the end
+    into an int32 matrix, same as pad_sequences with post padding and truncating
+    Ids are flattened and scattered at once with a mask of the valid positions
+    '''
+    n = len(ids)
+    if out is None:
+        out = np.zeros((n, maxlen), dtype=np.int32)
+    else:
+        out.fill(0)
+    if n == 0:
+        return out
+    lengths = np.fromiter(map(len, ids), dtype=np.int64, count=n)
+    if isinstance(ids[0], np.ndarray):
+        flat = np.concatenate(ids)
+    else:
+        flat = np.fromiter(chain.from_iterable(ids), dtype=np.int32, count=int(lengths.sum()))
+    if lengths.max() > maxlen:
+        # Drop the ids beyond maxlen of each sequence
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(flat)) - np.repeat(starts, lengths)
+        flat = flat[positions < maxlen]
+        lengths = np.minimum(lengths, maxlen)
+    out[np.arange(maxlen) < lengths[:, None]] = flat
+    return out
 
 class SentenceEncoder(object):
     '''
     Wrapper of a SentencePiece model
     Ensure that all the encode calls us the same special tokens config
+    Encoded ids are cached when sampling is disabled,
+    as the same sentence always produces the same ids
     '''
 
     def __init__(self, model_file, add_bos=False,
-                 add_eos=False, enable_sampling=False):
+                 add_eos=False, enable_sampling=False,
+                 cache_bytes=0):
         self.encoder = sp.SentencePieceProcessor(model_file=model_file)
         self.add_bos = add_bos
         self.add_eos = add_eos
         self.enable_sampling = enable_sampling
+        if cache_bytes and not enable_sampling:
+            self.cache = EncodingCache(cache_bytes)
+        else:
+            self.cache = None
 
     def encode(self, data, out_type=int):
         '''Wrapper function of the SentencePiece encode method'''
+        if self.cache is not None and out_type is int and isinstance(data, list):
+            return self.encode_cached(data)
+        return self.spm_encode(data, out_type)
+
+    def fingerprint(self):
+        '''Identifies the SentencePiece model and special tokens config'''
+        model = hashlib.sha1(self.encoder.serialized_model_proto()).hexdigest()
+        return f"{model}:bos={self.add_bos}:eos={self.add_eos}"
+
+    def spm_encode(self, data, out_type=int):
         return self.encoder.encode(data,
                         out_type=out_type,
                         add_bos=self.add_bos,
@@ -25,6 +167,29 @@ class SentenceEncoder(object):
                         enable_sampling=self.enable_sampling,
                         alpha=0.1)
 
+    def encode_cached(self, data):
+        '''
+        Encode a list of sentences looking up the cache first
+        Only the sentences not seen before are sent to SentencePiece
+        '''
+        ids = [None] * len(data)
+        pending = {}
+        for i, sentence in enumerate(data):
+            cached = self.cache.get(sentence)
+            if cached is None:
+                pending.setdefault(sentence, []).append(i)
+            else:
+                ids[i] = cached
+
+        if pending:
+            sentences = list(pending.keys())
+            for sentence, encoded in zip(sentences, self.spm_encode(sentences)):
+                encoded = np.array(encoded, dtype=np.int32)
+                self.cache.put(sentence, encoded)
+                for i in pending[sentence]:
+                    ids[i] = encoded
+        return ids
+
 class SentenceGenerator(tf.keras.utils.Sequence):
     '''
     Generates batches of sentences and its labels if they have
@@ -33,7 +198,7 @@ class SentenceGenerator(tf.keras.utils.Sequence):
 
     def __init__(self, encoder,
             batch_size=32, maxlen=100, shuffle=False,
-            separator=None):
+            separator=None, buffers=None):
         self.batch_size = batch_size
         self.maxlen = maxlen
         self.shuffle = shuffle
@@ -41,10 +206,14 @@ class SentenceGenerator(tf.keras.utils.Sequence):
         self.index = None
         self.text1 = None
         self.text2 = None
+        self.encoded = None
         self.weights = None
         self.y = None
         self.encoder = encoder
         self.separator = separator
+        # Reused between batches, only if the batch is consumed
+        # before encoding the next one, like in prediction
+        self.buffers = buffers
 
     def __len__(self):
         '''
@@ -64,9 +233,17 @@ class SentenceGenerator(tf.keras.utils.Sequence):
         start = index*self.batch_size
         indexes = self.index[start:end]
 
-        x = self.encode_batch(
-                    self.text1[indexes].tolist(),
-                    self.text2[indexes].tolist())
+        with timers.stage("encode"):
+            if self.encoded is not None:
+                x = self.encoded_batch(indexes)
+            elif self.shuffle:
+                x = self.encode_batch(self.text1[indexes].tolist(),
+                                      self.text2[indexes].tolist())
+            else:
+                # Index is not shuffled, slices avoid the copies of fancy indexing
+                x = self.encode_batch(self.text1[start:end].tolist(),
+                                      self.text2[start:end].tolist())
+        self.count_tokens(x)
 
         if self.weights is not None:
             w = self.weights[indexes]
@@ -80,8 +257,46 @@ class SentenceGenerator(tf.keras.utils.Sequence):
             np.random.shuffle(self.index)
 
     def encode_batch(self, text1, text2):
+        streams = self.encode_streams(text1, text2)
+        return self.from_streams({name: self.pad(ids, name)
+                                    for name, ids in streams.items()})
+
+    def encode_streams(self, text1, text2):
+        '''Ids of each model input, not padded'''
         raise NotImplementedError("Encoding must be defined by subclasses")
 
+    def from_streams(self, streams):
+        '''Model inputs from the padded ids of each input'''
+        raise NotImplementedError("Encoding must be defined by subclasses")
+
+    def encoding_key(self):
+        '''Describes how sentences are encoded, for pre-encoded datasets'''
+        if not isinstance(self.encoder, SentenceEncoder):
+            raise Exception("Only SentencePiece models can use pre-encoded datasets")
+        return {"generator": type(self).__name__,
+                "encoder": self.encoder.fingerprint(),
+                "separator": self.separator}
+
+    def encoded_batch(self, indexes):
+        '''Batch gathered from the pre-encoded dataset'''
+        return self.from_streams({name: self.encoded.batch(name, indexes, self.maxlen)
+                                    for name in self.encoded.ids})
+
+    def pad(self, ids, name):
+        '''Padded int32 matrix of ids, in a reused buffer if there are buffers'''
+        out = None
+        if self.buffers is not None:
+            out = self.buffers.get(name, len(ids), self.maxlen)
+        return pad_ids(ids, self.maxlen, out)
+
+    def count_tokens(self, x):
+        '''Count batches, tokens and padded positions, padding id is 0'''
+        timers.count("batches")
+        for ids in x:
+            if ids is not None:
+                timers.count("tokens", int(np.count_nonzero(ids)))
+                timers.count("padded_tokens", int(ids.size))
+
     def load(self, source):
         '''
         Load sentences and encode to index numbers
@@ -89,7 +304,20 @@ class SentenceGenerator(tf.keras.utils.Sequence):
         if it is a list is considered:
             [text1_sentences, text2_sentences, tags, weights]
         Sample weights are optional
+        An EncodedDataset is used without loading the sentences
         '''
+        if isinstance(source, EncodedDataset):
+            source.check(self)
+            self.encoded = source
+            self.num_samples = source.num_samples
+            self.index = np.arange(0, self.num_samples)
+            # Labels and weights are small, ids stay mapped
+            self.y = np.array(source.labels, dtype=int)
+            if source.weights is not None:
+                self.weights = np.array(source.weights, dtype=float)
+            if self.shuffle:
+                np.random.shuffle(self.index)
+            return
 
         # Read data from file if input is a filename
         if isinstance(source, str):
@@ -135,36 +363,33 @@ class TupleSentenceGenerator(SentenceGenerator):
     Generates batches of tuples of sentences
     '''
 
-    def encode_batch(self, text1, text2):
+    def encode_streams(self, text1, text2):
         # Vectorize sentences
-        x1 = pad_sequences(self.encoder.encode(text1),
-                           padding='post',
-                           truncating='post',
-                           maxlen=self.maxlen)
-        x2 = pad_sequences(self.encoder.encode(text2),
-                           padding='post',
-                           truncating='post',
-                           maxlen=self.maxlen)
+        return {"text1": self.encoder.encode(text1),
+                "text2": self.encoder.encode(text2)}
 
-        return x1, x2
+    def from_streams(self, streams):
+        return streams["text1"], streams["text2"]
 
 class ConcatSentenceGenerator(SentenceGenerator):
     '''
     Generates batches of concatenated sentences
     '''
 
+    def encode_streams(self, text1, text2):
+        # Concatenate sentences
+        text = []
+        for sent1, sent2 in zip(text1, text2):
+            text.append(sent1 + self.separator + sent2)
+        # Tokenize concatenated sentences with SentencePiece
+        return {"text": self.encoder.encode(text)}
+
+    def from_streams(self, streams):
+        return streams["text"], None
+
     def encode_batch(self, text1, text2):
         if isinstance(self.encoder, SentenceEncoder):
-            # Concatenate sentences
-            text = []
-            for sent1, sent2 in zip(text1, text2):
-                text.append(sent1 + self.separator + sent2)
-            # Tokenize concatenated sentences with SentencePiece
-            input_ids = pad_sequences(self.encoder.encode(text),
-                                      padding="post",
-                                      truncating="post",
-                                      maxlen=self.maxlen)
-            att_mask = None
+            return super(ConcatSentenceGenerator, self).encode_batch(text1, text2)
         else:
             # Tokenize with Transformers tokenizer that concatenates internally
             dataset = self.encoder(text1, text2,
@@ -178,3 +403,12 @@ class ConcatSentenceGenerator(SentenceGenerator):
             att_mask = dataset["attention_mask"]
 
         return input_ids, att_mask
+
+    def count_tokens(self, x):
+        input_ids, att_mask = x
+        if att_mask is None:
+            return super(ConcatSentenceGenerator, self).count_tokens(x)
+        # Transformers tokenizers use other padding ids
+        timers.count("batches")
+        timers.count("tokens", int(att_mask.sum()))
+        timers.count("padded_tokens", int(att_mask.size))
@@ -25,7 +25,6 @@ except (SystemError, ImportError):
 def build_model(vectors, settings, compile=True):
     max_length = settings["maxlen"]
     nr_hidden = settings["n_hidden"]
-    nr_class = settings["n_classes"]
 
     input1 = layers.Input(shape=(max_length,), dtype="int32", name="words1")
     input2 = layers.Input(shape=(max_length,), dtype="int32", name="words2")
@@ -39,11 +38,43 @@ def build_model(vectors, settings, compile=True):
     a = embed(input1)
     b = embed(input2)
 
+    out, loss = build_compare(a, b, settings)
+
+    model = Model([input1, input2], out)
+
+    if compile:
+        model.compile(optimizer=settings["optimizer"],
+                      loss=loss,
+                      metrics=settings["metrics"](), # Call get_metrics
+                      experimental_run_tf_function=False,)
+
+    return model
+
+
+def build_compare(a, b, settings, inference=False):
+    '''
+    Attend, compare and aggregate steps over the projected embeddings
+    of both sentences, returns the output tensor and the loss
+    The inference version has no Dropout and normalizes attention
+    with Softmax layers, that subtract the max before exp.
+    Both versions have the same weights in the same order
+    '''
+    nr_hidden = settings["n_hidden"]
+    nr_class = settings["n_classes"]
+
+    def feedforward(dropout):
+        return create_feedforward(nr_hidden, dropout=None if inference else dropout)
+
+    def normalize(axis):
+        if inference:
+            return layers.Softmax(axis=axis)
+        return layers.Lambda(normalizer(axis))
+
     # step 1: attend
     # self-attend
     if settings["self_attention"]:
-        S_a = create_feedforward(nr_hidden, dropout=settings["dropout"])
-        S_b = create_feedforward(nr_hidden, dropout=settings["dropout"])
+        S_a = feedforward(settings["dropout"])
+        S_b = feedforward(settings["dropout"])
         a_p = layers.Attention()([S_a(a), S_a(a)])
         b_p = layers.Attention()([S_b(b), S_b(b)])
         # self_att_a = layers.dot([S_a(a), S_a(a)], axes=-1)
@@ -57,14 +88,14 @@ def build_model(vectors, settings, compile=True):
         b_p = b
 
     # attend
-    F = create_feedforward(nr_hidden, dropout=settings["dropout"])
+    F = feedforward(settings["dropout"])
     att_weights = layers.dot([F(a_p), F(b_p)], axes=-1)
 
-    G = create_feedforward(nr_hidden)
+    G = feedforward(0.2)
 
     if settings["entail_dir"] == "both":
-        norm_weights_a = layers.Lambda(normalizer(1))(att_weights)
-        norm_weights_b = layers.Lambda(normalizer(2))(att_weights)
+        norm_weights_a = normalize(1)(att_weights)
+        norm_weights_b = normalize(2)(att_weights)
         alpha = layers.dot([norm_weights_a, a_p], axes=1)
         beta = layers.dot([norm_weights_b, b_p], axes=1)
 
@@ -80,7 +111,7 @@ def build_model(vectors, settings, compile=True):
         concat = layers.concatenate([v1_sum, v2_sum])
 
     elif settings["entail_dir"] == "left":
-        norm_weights_a = layers.Lambda(normalizer(1))(att_weights)
+        norm_weights_a = normalize(1)(att_weights)
         alpha = layers.dot([norm_weights_a, a], axes=1)
         comp2 = layers.concatenate([b, alpha])
         v2 = layers.TimeDistributed(G)(comp2)
@@ -88,14 +119,14 @@ def build_model(vectors, settings, compile=True):
         concat = v2_sum
 
     else:
-        norm_weights_b = layers.Lambda(normalizer(2))(att_weights)
+        norm_weights_b = normalize(2)(att_weights)
         beta = layers.dot([norm_weights_b, b], axes=1)
         comp1 = layers.concatenate([a, beta])
         v1 = layers.TimeDistributed(G)(comp1)
         v1_sum = layers.Lambda(sum_word)(v1)
         concat = v1_sum
 
-    H = create_feedforward(nr_hidden, dropout=settings["dropout"])
+    H = feedforward(settings["dropout"])
     out = H(concat)
     if settings['distilled']:
         out = layers.Dense(nr_class)(out)
@@ -105,15 +136,96 @@ def build_model(vectors, settings, compile=True):
         out = layers.Activation('sigmoid', dtype='float32')(out)
         loss = settings["loss"]
 
-    model = Model([input1, input2], out)
+    return out, loss
+
+
+def build_pair_model(settings):
+    '''
+    Model that scores a pair from the projected embeddings of each sentence
+    Allows to embed each sentence once when scoring many pairs
+    '''
+    shape = (settings["maxlen"], settings["n_hidden"])
+    a = layers.Input(shape=shape, dtype="float32", name="embedded1")
+    b = layers.Input(shape=shape, dtype="float32", name="embedded2")
+    out, _ = build_compare(a, b, settings)
+    return Model([a, b], out)
+
+
+def split_model(model, settings):
+    '''
+    Split a full model into the shared embedding model
+    and a pair model with the rest of the weights
+    '''
+    embed = next(l for l in model.layers
+                    if not isinstance(l, layers.InputLayer))
+    pair_model = build_pair_model(settings)
+
+    if not copy_compare_weights(model, embed, pair_model, None):
+        raise Exception("Could not split model, weights do not match the pair model")
+
+    return embed, pair_model
+
+
+def copy_compare_weights(model, embed, target, target_embed):
+    '''
+    Copy the weights of the attend, compare and aggregate layers
+    of model to target, both built by build_compare, layer by layer.
+    Model weights are not in build order, non-trainable ones like
+    the embedding tables come last, so they are not copied as a list.
+    Returns False if the layers do not match
+    '''
+    def compare_layers(m, skip):
+        return [l for l in m.layers
+                if l.weights and l is not skip
+                    and not isinstance(l, layers.InputLayer)]
+
+    source_layers = compare_layers(model, embed)
+    target_layers = compare_layers(target, target_embed)
+    if len(source_layers) != len(target_layers):
+        return False
+    for source, dest in zip(source_layers, target_layers):
+        weights = source.get_weights()
+        if [w.shape for w in weights] != [tuple(w.shape) for w in dest.weights]:
+            return False
+    for source, dest in zip(source_layers, target_layers):
+        dest.set_weights(source.get_weights())
+    return True
+
+
+def build_inference_model(model, settings):
+    '''
+    Rebuild a trained model for inference with the projection folded
+    into the embedding tables: the projection is linear and has no bias,
+    so (tok + pos)W = tok W + pos W can be computed once for the whole vocabulary
+    and positions instead of a matmul for every position of every sentence.
+    Dropout and Lambda normalizers are left out of the attend, compare
+    and aggregate steps, see build_compare
+    '''
+    max_length = settings["maxlen"]
+    nr_hidden = settings["n_hidden"]
+    embed = next(l for l in model.layers
+                    if not isinstance(l, layers.InputLayer))
+    # Tables may be constants bound to memory-mapped weights, not in get_weights
+    token_pos, projection = embed.layers
+    token_table = token_pos.token_emb.embeddings.numpy()
+    pos_table = token_pos.pos_emb.embeddings.numpy()
+    kernel = projection.layer.kernel.numpy()
 
-    if compile:
-        model.compile(optimizer=settings["optimizer"],
-                      loss=loss,
-                      metrics=settings["metrics"](), # Call get_metrics
-                      experimental_run_tf_function=False,)
+    input1 = layers.Input(shape=(max_length,), dtype="int32", name="words1")
+    input2 = layers.Input(shape=(max_length,), dtype="int32", name="words2")
+    folded = TokenAndPositionEmbedding(token_table.shape[0],
+                                       nr_hidden,
+                                       max_length,
+                                       name="folded_embedding")
+    out, _ = build_compare(folded(input1), folded(input2), settings, inference=True)
+    inference_model = Model([input1, input2], out)
 
-    return model
+    folded.token_emb.set_weights([token_table @ kernel])
+    folded.pos_emb.set_weights([pos_table @ kernel])
+    if not copy_compare_weights(model, embed, inference_model, folded):
+        raise Exception("Could not fold embeddings, weights do not match the inference model")
+
+    return inference_model
 
 
 def create_embedding(vectors, emb_dim, vocab_size, max_length, projected_dim, trainable=False):
@@ -141,14 +253,13 @@ def create_embedding(vectors, emb_dim, vocab_size, max_length, projected_dim, tr
 
 
 def create_feedforward(num_units=200, activation="relu", dropout=0.2):
-    return models.Sequential(
-        [
-            layers.Dense(num_units, activation=activation),
-            layers.Dropout(dropout),
-            layers.Dense(num_units, activation=activation),
-            layers.Dropout(dropout),
-        ]
-    )
+    '''Two dense layers, each one followed by Dropout unless dropout is None'''
+    ff = []
+    for _ in range(2):
+        ff.append(layers.Dense(num_units, activation=activation))
+        if dropout is not None:
+            ff.append(layers.Dropout(dropout))
+    return models.Sequential(ff)
 
 
 def normalizer(axis):
@@ -0,0 +1,161 @@
+'''
+Pre-encoded training datasets
+
+A training TSV (sentence1, sentence2, label and optional weights) is
+encoded once with the SentencePiece model of the classifier and saved
+in a directory as raw arrays described by a YAML index, like the
+memory-mapped weights: for each input stream of the generator
+the ids of all the sentences concatenated (<stream>.ids.bin, int32)
+and their start offsets (<stream>.offsets.bin, int64),
+and the labels and weights aligned with them.
+Generators gather the padded batches from the mapped arrays instead of
+tokenizing the sentences in every epoch, and several training runs can
+share a dataset through the page cache.
+'''
+from itertools import chain
+import numpy as np
+import logging
+import yaml
+import os
+
+FORMAT_VERSION = 1
+INDEX = "dataset.yaml"
+
+def encoded_dataset_exists(directory):
+    return os.path.isfile(os.path.join(directory, INDEX))
+
+def read_blocks(filename, block_size):
+    '''Blocks of sentence pairs, labels and weights of a training TSV'''
+    block = ([], [], [], [])
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('\t')
+            block[0].append(fields[0])
+            block[1].append(fields[1])
+            block[2].append(int(fields[2].strip()))
+            if len(fields) == 4:
+                block[3].append(float(fields[3].strip()))
+            elif len(fields) > 4:
+                block[3].append([float(i.strip()) for i in fields[3:]])
+            if len(block[0]) == block_size:
+                yield block
+                block = ([], [], [], [])
+    if block[0]:
+        yield block
+
+def write_encoded_dataset(generator, source, directory, block_size=10000):
+    '''Encode the training TSV source with the encoding of generator'''
+    if getattr(generator.encoder, "enable_sampling", False):
+        raise Exception("Datasets can not be pre-encoded with SentencePiece sampling enabled")
+    os.makedirs(directory, exist_ok=True)
+    # Index is written at the end, an interrupted encoding is not used
+    if encoded_dataset_exists(directory):
+        os.remove(os.path.join(directory, INDEX))
+
+    maxlen = generator.maxlen
+    lengths = {}
+    files = {}
+    labels, weights = [], []
+    try:
+        for text1, text2, block_labels, block_weights in read_blocks(source, block_size):
+            streams = generator.encode_streams(text1, text2)
+            for name, ids in streams.items():
+                if name not in files:
+                    files[name] = open(os.path.join(directory, f"{name}.ids.bin"), 'wb')
+                    lengths[name] = []
+                # Ids beyond maxlen are never used
+                block_lengths = [min(len(s), maxlen) for s in ids]
+                flat = np.fromiter(chain.from_iterable(s[:maxlen] for s in ids),
+                                   dtype=np.int32, count=sum(block_lengths))
+                files[name].write(flat.tobytes())
+                lengths[name].extend(block_lengths)
+            labels.extend(block_labels)
+            weights.extend(block_weights)
+    finally:
+        for f in files.values():
+            f.close()
+    if not labels:
+        raise Exception(f"Training set {source} is empty")
+    if weights and len(weights) != len(labels):
+        raise Exception("Some lines of the training set have weights and others do not")
+
+    for name, stream_lengths in lengths.items():
+        offsets = np.zeros(len(stream_lengths) + 1, dtype=np.int64)
+        np.cumsum(stream_lengths, out=offsets[1:])
+        offsets.tofile(os.path.join(directory, f"{name}.offsets.bin"))
+    np.array(labels, dtype=np.int32).tofile(os.path.join(directory, "labels.bin"))
+    weights_shape = None
+    if weights:
+        weights = np.array(weights, dtype=np.float32)
+        weights.tofile(os.path.join(directory, "weights.bin"))
+        weights_shape = list(weights.shape)
+
+    index = {"version": FORMAT_VERSION,
+             "num_samples": len(labels),
+             "maxlen": maxlen,
+             "streams": sorted(lengths),
+             "tokens": {name: int(sum(l)) for name, l in lengths.items()},
+             "encoding": generator.encoding_key(),
+             "weights_shape": weights_shape}
+    with open(os.path.join(directory, INDEX), 'w') as f:
+        yaml.dump(index, f)
+    logging.info(f"Encoded {len(labels)} samples of {source} into {directory}")
+
+class EncodedDataset(object):
+    '''Memory-mapped arrays of a pre-encoded dataset'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX)) as f:
+            self.index = yaml.safe_load(f)
+        if self.index["version"] != FORMAT_VERSION:
+            raise Exception(f"Encoded dataset {directory} has format version"
+                            f" {self.index['version']}, expected {FORMAT_VERSION}")
+        self.num_samples = self.index["num_samples"]
+        self.maxlen = self.index["maxlen"]
+        self.ids = {}
+        self.offsets = {}
+        for name in self.index["streams"]:
+            self.offsets[name] = self.map(f"{name}.offsets.bin", np.int64,
+                                          (self.num_samples + 1,))
+            tokens = self.index["tokens"][name]
+            # Files of zero bytes can not be mapped
+            self.ids[name] = self.map(f"{name}.ids.bin", np.int32, (tokens,)) \
+                                if tokens else np.zeros(0, dtype=np.int32)
+        self.labels = self.map("labels.bin", np.int32, (self.num_samples,))
+        self.weights = None
+        if self.index["weights_shape"] is not None:
+            self.weights = self.map("weights.bin", np.float32,
+                                    tuple(self.index["weights_shape"]))
+
+    def map(self, filename, dtype, shape):
+        return np.memmap(os.path.join(self.directory, filename),
+                         dtype=dtype, mode='r', shape=shape)
+
+    def check(self, generator):
+        '''Fail if the generator encodes differently from the dataset'''
+        if self.index["encoding"] != generator.encoding_key():
+            raise Exception(f"Encoded dataset {self.directory} was encoded with another"
+                            f" vocabulary or model type, remove it to encode it again")
+        if generator.maxlen > self.maxlen:
+            raise Exception(f"Encoded dataset {self.directory} has sentences truncated"
+                            f" to {self.maxlen} tokens, less than maxlen {generator.maxlen}")
+
+    def batch(self, name, rows, maxlen):
+        '''Padded int32 matrix of the ids of rows in a stream'''
+        ids, offsets = self.ids[name], self.offsets[name]
+        starts = offsets[rows]
+        lengths = np.minimum(offsets[rows + 1] - starts, maxlen)
+        positions = np.arange(maxlen)
+        mask = positions < lengths[:, None]
+        out = np.zeros((len(rows), maxlen), dtype=np.int32)
+        out[mask] = ids[(starts[:, None] + positions)[mask]]
+        return out
+
+# Encoded dataset in directory, encoding the training TSV source first if given
+def encoded_dataset(generator, source, directory):
+    if source is not None:
+        write_encoded_dataset(generator, source, directory)
+    dataset = EncodedDataset(directory)
+    dataset.check(generator)
+    return dataset
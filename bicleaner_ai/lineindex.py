@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+Persistent line offset index
+
+The index of <file> is stored in <file>.idx as a 32 bytes header
+(magic, file size, file mtime in ns and number of lines)
+followed by the uint64 offset where each line starts.
+It is built with a vectorized newline scan over memory-mapped chunks
+and discarded when the size or mtime of the file changes.
+'''
+import numpy as np
+import argparse
+import logging
+import struct
+import sys
+import os
+
+INDEX_SUFFIX = ".idx"
+MAGIC = b"BCLIDX01"
+HEADER = struct.Struct("<8sQQQ")
+
+# Offsets where each line of a file starts
+def scan_offsets(filename, chunk_bytes=64*1024*1024):
+    size = os.path.getsize(filename)
+    if size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    starts = [np.zeros(1, dtype=np.uint64)]
+    for begin in range(0, size, chunk_bytes):
+        newlines = np.flatnonzero(data[begin:begin+chunk_bytes] == ord("\n"))
+        starts.append((newlines + begin + 1).astype(np.uint64))
+    del data
+    offsets = np.concatenate(starts)
+    # A newline at the end of the file does not start a line
+    if offsets[-1] == size:
+        offsets = offsets[:-1]
+    return offsets
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class LineIndex(object):
+    '''Offsets of the lines of a file'''
+
+    def __init__(self, filename, offsets, size):
+        self.filename = filename
+        self.offsets = offsets
+        self.size = size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def index_file(filename):
+        return filename + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, filename, save=True):
+        '''Scan a file and save its index next to it if possible'''
+        size, mtime = file_signature(filename)
+        offsets = scan_offsets(filename)
+        index = cls(filename, offsets, size)
+        if save:
+            try:
+                with open(cls.index_file(filename), 'wb') as f:
+                    f.write(HEADER.pack(MAGIC, size, mtime, len(offsets)))
+                    f.write(offsets.astype("<u8").tobytes())
+            except OSError as e:
+                logging.warning(f"Could not save line index of {filename}: {e}")
+        logging.debug(f"Indexed {len(offsets)} lines of {filename}")
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        '''Load the index of a file, None if it does not exist or is outdated'''
+        index_file = cls.index_file(filename)
+        if not os.path.isfile(index_file):
+            return None
+        with open(index_file, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            return None
+        magic, size, mtime, count = HEADER.unpack(header)
+        if magic != MAGIC or (size, mtime) != file_signature(filename):
+            logging.debug(f"Line index {index_file} is outdated")
+            return None
+        if count == 0:
+            offsets = np.zeros(0, dtype=np.uint64)
+        else:
+            offsets = np.memmap(index_file, dtype="<u8", mode='r',
+                                offset=HEADER.size, shape=(count,))
+        return cls(filename, offsets, size)
+
+    @classmethod
+    def open(cls, filename, save=True):
+        '''Load the index of a file or build it if needed'''
+        index = cls.load(filename)
+        if index is None:
+            index = cls.build(filename, save)
+        return index
+
+    def line_range(self, i):
+        '''Byte range of line i, including its newline'''
+        end = self.offsets[i+1] if i + 1 < len(self.offsets) else self.size
+        return int(self.offsets[i]), int(end)
+
+    def read_lines(self, f, start, end=None):
+        '''Read lines from start to end (not included) from a binary file'''
+        if end is None:
+            end = start + 1
+        begin, _ = self.line_range(start)
+        _, stop = self.line_range(end - 1)
+        f.seek(begin)
+        data = f.read(stop - begin)
+        # Split at the indexed offsets, lines only end in b"\n"
+        bounds = [int(o) - begin for o in self.offsets[start:end]] + [stop - begin]
+        return [data[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def ranges(self, chunk_bytes, start=0):
+        '''Newline-aligned byte ranges of about chunk_bytes from start'''
+        bounds = [start]
+        while bounds[-1] < self.size:
+            i = int(np.searchsorted(self.offsets, bounds[-1] + chunk_bytes))
+            bounds.append(int(self.offsets[i]) if i < len(self.offsets) else self.size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+def main():
+    try:
+        from .util import logging_setup
+    except (ImportError, SystemError):
+        from util import logging_setup
+
+    parser = argparse.ArgumentParser(description="Build line offset indexes of text files, stored as <file>.idx")
+    parser.add_argument('files', nargs='+', help="Files to index")
+    parser.add_argument('--lines', default=None, help="Instead of indexing, print lines FROM:TO (starting in 1, TO included) of each file, using its index")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    args = parser.parse_args()
+    logging_setup(args)
+
+    for filename in args.files:
+        if args.lines is not None:
+            first, _, last = args.lines.partition(':')
+            index = LineIndex.open(filename)
+            first = max(1, int(first or 1))
+            last = min(len(index), int(last or len(index)))
+            if first > last:
+                continue
+            with open(filename, 'rb') as f:
+                sys.stdout.buffer.writelines(index.read_lines(f, first - 1, last))
+        else:
+            index = LineIndex.load(filename)
+            if index is None:
+                index = LineIndex.build(filename)
+            logging.info(f"{filename}: {len(index)} lines")
+
+if __name__ == '__main__':
+    main()
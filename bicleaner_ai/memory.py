@@ -0,0 +1,113 @@
+'''
+Memory tracking of classify
+
+RSS, allocated Python blocks and TensorFlow GPU memory are sampled after
+each block. The RSS peaks of consecutive windows of blocks are compared
+to detect steady growth, that is logged as a warning.
+With a memory cap, block size and encoding cache are halved when RSS
+gets close to it and block size is restored when there is room again.
+'''
+from collections import deque
+import tensorflow as tf
+import logging
+import psutil
+import sys
+import gc
+
+# Fractions of the memory cap where block size is reduced or restored
+HIGH_MEMORY = 0.9
+LOW_MEMORY = 0.6
+MIN_BLOCK_SIZE = 100
+MIN_CACHE_BYTES = 1024*1024
+
+class MemoryMonitor(object):
+    '''Memory samples of a classify run and the block size controller'''
+
+    def __init__(self, max_memory=None, window=50, growth_windows=5, min_growth=0.05):
+        self.process = psutil.Process()
+        self.max_memory = max_memory
+        self.window = window
+        self.min_growth = min_growth
+        self.peaks = deque(maxlen=growth_windows)
+        self.blocks = 0
+        self.window_peak = 0.0
+        self.start_rss = self.rss_mib()
+        self.peak_rss = self.start_rss
+        self.block_size = None
+        self.growing = False
+        self.gpu = bool(tf.config.list_logical_devices('GPU'))
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, "max_memory", None))
+
+    def rss_mib(self):
+        return self.process.memory_info().rss / 2**20
+
+    def tf_memory_mib(self):
+        '''Memory allocated by TensorFlow in the first GPU, None without GPU'''
+        if not self.gpu:
+            return None
+        try:
+            return tf.config.experimental.get_memory_info('GPU:0')['current'] / 2**20
+        except (AttributeError, ValueError):
+            # Not available in older TensorFlow versions
+            return None
+
+    def step(self, args):
+        '''Sample memory after a block and adapt the block size to the cap'''
+        rss = self.rss_mib()
+        self.blocks += 1
+        self.peak_rss = max(self.peak_rss, rss)
+        self.window_peak = max(self.window_peak, rss)
+        if self.block_size is None:
+            self.block_size = args.block_size
+        if self.max_memory and rss > self.max_memory * HIGH_MEMORY:
+            self.reduce(args, rss)
+        if self.blocks % self.window == 0:
+            self.close_window(args, rss)
+
+    def reduce(self, args, rss):
+        changes = []
+        if args.block_size > MIN_BLOCK_SIZE:
+            args.block_size = max(MIN_BLOCK_SIZE, args.block_size // 2)
+            changes.append(f"block size {args.block_size}")
+        cache = getattr(getattr(args.clf, "spm", None), "cache", None)
+        if cache is not None and cache.max_bytes > MIN_CACHE_BYTES:
+            cache.resize(cache.max_bytes // 2)
+            changes.append(f"encoding cache {cache.max_bytes/2**20:.0f} MiB")
+        gc.collect()
+        if changes:
+            logging.warning(f"RSS {rss:.0f} MiB close to --max_memory {self.max_memory} MiB,"
+                            f" reducing {', '.join(changes)}")
+
+    def close_window(self, args, rss):
+        self.peaks.append(self.window_peak)
+        text = (f"Memory after {self.blocks} blocks: RSS {rss:.0f} MiB"
+                f" (start {self.start_rss:.0f}, peak {self.peak_rss:.0f}),"
+                f" Python blocks {sys.getallocatedblocks()}")
+        tf_memory = self.tf_memory_mib()
+        if tf_memory is not None:
+            text += f", TensorFlow GPU {tf_memory:.0f} MiB"
+        logging.debug(text)
+
+        # Warn once each time the peaks of all the last windows increase
+        peaks = list(self.peaks)
+        growing = len(peaks) == self.peaks.maxlen \
+                and all(a < b for a, b in zip(peaks, peaks[1:])) \
+                and peaks[-1] > peaks[0] * (1 + self.min_growth)
+        if growing and not self.growing:
+            logging.warning(f"Memory keeps growing: RSS peak {peaks[0]:.0f} -> {peaks[-1]:.0f} MiB"
+                            f" in the last {len(peaks) * self.window} blocks")
+        self.growing = growing
+
+        # Restore block size after a window with room under the cap
+        if self.max_memory and args.block_size < self.block_size \
+                and self.window_peak < self.max_memory * LOW_MEMORY:
+            args.block_size = min(self.block_size, args.block_size * 2)
+            logging.info(f"RSS under {LOW_MEMORY:.0%} of --max_memory, block size {args.block_size}")
+        self.window_peak = 0.0
+
+    def report(self):
+        return (f"Memory: RSS start {self.start_rss:.0f} MiB, peak {self.peak_rss:.0f} MiB,"
+                f" end {self.rss_mib():.0f} MiB after {self.blocks} blocks")
@@ -1,4 +1,4 @@
-from transformers import TFXLMRobertaForSequenceClassification, XLMRobertaTokenizerFast
+from transformers import TFXLMRobertaForSequenceClassification, XLMRobertaTokenizerFast, XLMRobertaConfig
 from transformers.modeling_tf_outputs import TFSequenceClassifierOutput
 from transformers.optimization_tf import create_optimizer
 from tensorflow.keras.optimizers.schedules import InverseTimeDecay
@@ -11,6 +11,7 @@ from tensorflow.keras.models import load_model
 from tensorflow.keras import layers
 from glove import Corpus, Glove
 from abc import ABC, abstractmethod
+from timeit import default_timer
 import tensorflow.keras.backend as K
 import sentencepiece as sp
 import tensorflow as tf
@@ -19,22 +20,28 @@ import logging
 
 try:
     from . import decomposable_attention
+    from .weights import load_mmap_weights, open_mmap_weights, mmap_weights_exist, rss_mib
+    from .perf import timers
     from .metrics import FScore, MatthewsCorrCoef
     from .datagen import (
             TupleSentenceGenerator,
             ConcatSentenceGenerator,
-            SentenceEncoder)
+            SentenceEncoder,
+            IdBuffers)
     from .layers import (
             TransformerBlock,
             TokenAndPositionEmbedding,
             BCClassificationHead)
 except (SystemError, ImportError):
     import decomposable_attention
+    from weights import load_mmap_weights, open_mmap_weights, mmap_weights_exist, rss_mib
+    from perf import timers
     from metrics import FScore, MatthewsCorrCoef
     from datagen import (
             TupleSentenceGenerator,
             ConcatSentenceGenerator,
-            SentenceEncoder)
+            SentenceEncoder,
+            IdBuffers)
     from layers import (
             TransformerBlock,
             TokenAndPositionEmbedding,
@@ -133,6 +140,8 @@ class ModelInterface(ABC):
 
 class BaseModel(ModelInterface):
     '''Abstract Model class that gathers most of the training logic'''
+    # Sentences SentencePiece trains with, sampled from the monolingual corpus
+    spm_input_sentences = 5000000
 
     def __init__(self, directory, settings, distilled=False):
         self.dir = directory
@@ -141,7 +150,12 @@ class BaseModel(ModelInterface):
         self.vocab = None
         self.model = None
         self.wv = None
+        self.predict_fn = None
+        self.predict_model = None
+        self.id_buffers = IdBuffers()
         self.spm_prefix = 'spm'
+        # Extra Keras callbacks for training, like the profiler
+        self.callbacks = []
 
         # Override with user defined settings in derived classes, not here
         self.settings = {
@@ -149,6 +163,7 @@ class BaseModel(ModelInterface):
             "vocab_file": self.spm_prefix + ".vocab",
             "model_file": "model.h5",
             "wv_file": "glove.vectors",
+            "mmap_weights": None,
             "separator": '',
             "bos_id": -1,
             "eos_id": -1,
@@ -157,6 +172,7 @@ class BaseModel(ModelInterface):
             "add_bos": False,
             "add_eos": False,
             "sampling": False,
+            "encode_cache_bytes": 128*1024*1024,
             "emb_dim": 300,
             "emb_trainable": True,
             "emb_epochs": 10,
@@ -211,16 +227,21 @@ class BaseModel(ModelInterface):
         if batch_size is None:
             batch_size = self.settings["batch_size"]
         generator = self.get_generator(batch_size, shuffle=False)
+        # Each batch is predicted before encoding the next one
+        generator.buffers = self.id_buffers
         generator.load((x1, x2, None))
 
-        y_pred = self.model.predict(generator)
-        # Obtain logits if model returns HF output
-        if isinstance(y_pred, TFSequenceClassifierOutput):
-            y_pred = y_pred.logits
+        # Includes encoding of the batches, also timed apart
+        with timers.stage("model"):
+            y_pred = self.predict_generator(generator)
+        timers.count("pairs", len(x1))
 
         if raw:
             return y_pred
+        return self.output_probs(y_pred, calibrated)
 
+    def output_probs(self, y_pred, calibrated=False):
+        '''Returns positive class probabilities from the model output'''
         if self.settings["n_classes"] == 1:
             y_pred_probs = y_pred
         else:
@@ -232,13 +253,73 @@ class BaseModel(ModelInterface):
         else:
             return y_pred_probs
 
+    def softmax_pos_prob(self, x):
+        # Compute softmax probability of the second (positive) class
+        e_x = np.exp(x - np.max(x))
+        # Need transpose to compute for each sample in the batch
+        # then slice to return class probability
+        return (e_x.T / (np.sum(e_x, axis=1).T)).T[:,1:]
+
+    def predict_matrix(self, src, trg, batch_size=None, calibrated=False):
+        '''
+        Scores every source sentence against every target sentence
+        Returns a len(src) x len(trg) matrix of probabilities
+        '''
+        if batch_size is None:
+            batch_size = self.settings["batch_size"]
+        matrix = np.zeros((len(src), len(trg)), dtype=np.float32)
+        if not src or not trg:
+            return matrix
+
+        # Build the pairs of a few source rows at a time to bound memory
+        rows = max(1, 16 * batch_size // len(trg))
+        for start in range(0, len(src), rows):
+            block = src[start:start+rows]
+            x1 = [s for s in block for _ in trg]
+            x2 = trg * len(block)
+            y_pred = self.predict(x1, x2, batch_size, calibrated)
+            matrix[start:start+len(block)] = np.reshape(y_pred, (len(block), len(trg)))
+        return matrix
+
+    def predict_function(self):
+        '''
+        Forward pass of the model as a tf.function, traced once and reused
+        model.predict builds a data adapter and its iterators in each call,
+        that leaked memory over long runs
+        '''
+        if self.predict_fn is None or self.predict_model is not self.model:
+            model = self.model
+
+            @tf.function(experimental_relax_shapes=True)
+            def predict_fn(x):
+                y_pred = model(x, training=False)
+                # Obtain logits if model returns HF output
+                if isinstance(y_pred, TFSequenceClassifierOutput):
+                    y_pred = y_pred.logits
+                return y_pred
+
+            self.predict_fn = predict_fn
+            self.predict_model = model
+        return self.predict_fn
+
+    def predict_generator(self, generator):
+        '''Returns the model output for all the batches of a generator'''
+        predict_fn = self.predict_function()
+        y_pred = []
+        for i in range(len(generator)):
+            x, _ = generator[i]
+            # Generators without attention mask return None in its place
+            x = tuple(tf.convert_to_tensor(v) for v in x if v is not None)
+            y_pred.append(predict_fn(x[0] if len(x) == 1 else x).numpy())
+        return np.concatenate(y_pred)
 
     def load_spm(self):
         '''Loads SentencePiece model and vocabulary from model directory'''
         self.spm = SentenceEncoder(self.dir+'/'+self.settings["spm_file"],
                                    add_bos=self.settings["add_bos"],
                                    add_eos=self.settings["add_eos"],
-                                   enable_sampling=self.settings["sampling"])
+                                   enable_sampling=self.settings["sampling"],
+                                   cache_bytes=self.settings["encode_cache_bytes"])
         self.vocab = {}
         with open(self.dir + '/' + self.settings["vocab_file"]) as vocab_file:
             for i, line in enumerate(vocab_file):
@@ -248,39 +329,59 @@ class BaseModel(ModelInterface):
 
     def load_embed(self):
         '''Loads embeddings from model directory'''
-        glove = Glove().load(self.dir+'/'+self.settings["wv_file"])
-        self.wv = glove.word_vectors
+        # Use the memory-mapped export if there is one
+        if mmap_weights_exist(self.dir, "glove"):
+            self.wv = open_mmap_weights(self.dir, "glove")[0][1]
+        else:
+            glove = Glove().load(self.dir+'/'+self.settings["wv_file"])
+            self.wv = glove.word_vectors
         logging.info("Loaded SentenePiece Glove vectors")
 
     def load(self):
         '''Loads the whole model'''
         self.load_spm()
         logging.info("Loading neural classifier")
+        start, start_rss = default_timer(), rss_mib()
         deps = {'FScore': FScore,
                 'MatthewsCorrCoef': MatthewsCorrCoef,
                 'TokenAndPositionEmbedding': TokenAndPositionEmbedding,
                 'K': tf.keras.backend,
         }
 
-        # Try loading the whole model
-        # If it fails due to bad marshal (saved with different Python version)
-        # build a new model and load weights
-        try:
-            self.model = load_model(self.dir+'/'+self.settings["model_file"],
-                                    custom_objects=deps, compile=False)
-        except ValueError:
+        if self.settings["mmap_weights"]:
             self.model = self.build_model(compile=False)
-            self.model.load_weights(self.dir+'/'+self.settings["model_file"])
-
-    def train_vocab(self, monolingual, threads):
-        '''Trains SentencePiece model and embeddings with Glove'''
+            load_mmap_weights(self.model, self.dir, self.settings["mmap_weights"])
+        else:
+            # Try loading the whole model
+            # If it fails due to bad marshal (saved with different Python version)
+            # build a new model and load weights
+            try:
+                self.model = load_model(self.dir+'/'+self.settings["model_file"],
+                                        custom_objects=deps, compile=False)
+            except ValueError:
+                self.model = self.build_model(compile=False)
+                self.model.load_weights(self.dir+'/'+self.settings["model_file"])
+        self.log_load(start, start_rss)
+
+    def log_load(self, start, start_rss):
+        source = self.settings["mmap_weights"] or self.settings["model_file"]
+        logging.info(f"Loaded classifier from {source}"
+                     f" in {default_timer()-start:.2f}s,"
+                     f" RSS {start_rss:.0f} -> {rss_mib():.0f} MiB")
+
+    def train_vocab(self, monolingual, threads, spm_sentences=None):
+        '''
+        Trains SentencePiece model and embeddings with Glove
+        SentencePiece is trained with spm_sentences if given,
+        like a sample of monolingual, and Glove with all of monolingual
+        '''
 
         logging.info("Training SentencePiece joint vocabulary")
         trainer = sp.SentencePieceTrainer
-        trainer.train(sentence_iterator=monolingual,
+        trainer.train(sentence_iterator=monolingual if spm_sentences is None else spm_sentences,
                       model_prefix=self.dir+'/'+self.spm_prefix,
                       vocab_size=self.settings["vocab_size"],
-                      input_sentence_size=5000000,
+                      input_sentence_size=self.spm_input_sentences,
                       shuffle_input_sentence=True,
                       pad_id=self.settings["pad_id"],
                       unk_id=self.settings["unk_id"],
@@ -352,9 +453,11 @@ class BaseModel(ModelInterface):
                        epochs=settings["epochs"],
                        steps_per_epoch=steps_per_epoch,
                        validation_data=dev_generator,
-                       callbacks=[earlystop, LRReport()],
+                       callbacks=[earlystop, LRReport(), *self.callbacks],
                        verbose=1)
         self.model.save(model_filename)
+        if self.spm.cache is not None:
+            logging.debug(self.spm.cache.report())
 
         y_true = dev_generator.y
         y_pred_probs = self.model.predict(dev_generator)
@@ -380,6 +483,8 @@ class DecomposableAttention(BaseModel):
             "self_attention": False,
             **settings, # Override default settings with user-defined
         }
+        self.embed_model = None
+        self.pair_model = None
 
     def get_generator(self, batch_size, shuffle):
         return TupleSentenceGenerator(
@@ -390,6 +495,78 @@ class DecomposableAttention(BaseModel):
     def build_model(self, compile=True):
         return decomposable_attention.build_model(self.wv, self.settings, compile)
 
+    def predict_matrix(self, src, trg, batch_size=None, calibrated=False):
+        '''
+        Scores every source sentence against every target sentence
+        Each sentence is embedded and projected once,
+        then only the attend, compare and aggregate steps run per pair
+        '''
+        if batch_size is None:
+            batch_size = self.settings["batch_size"]
+        matrix = np.zeros((len(src), len(trg)), dtype=np.float32)
+        if not src or not trg:
+            return matrix
+        if self.pair_model is None:
+            self.embed_model, self.pair_model = \
+                decomposable_attention.split_model(self.model, self.settings)
+
+        generator = self.get_generator(batch_size, shuffle=False)
+        x1, x2 = generator.encode_batch(src, trg)
+        a = self.embed_model.predict(x1, batch_size=batch_size)
+        b = self.embed_model.predict(x2, batch_size=batch_size)
+
+        # Pair indexes in row-major order, scored in batches
+        n_pairs = len(src) * len(trg)
+        for start in range(0, n_pairs, batch_size):
+            idx = np.arange(start, min(start + batch_size, n_pairs))
+            rows, cols = np.divmod(idx, len(trg))
+            y_pred = self.pair_model.predict_on_batch([a[rows], b[cols]])
+            y_pred = self.output_probs(np.asarray(y_pred), calibrated)
+            matrix[rows, cols] = np.reshape(y_pred, -1)
+        return matrix
+
+    def fold_embeddings(self, samples=256, repeats=5, tolerance=1e-4):
+        '''
+        Replace the model with the inference model of folded embeddings
+        The outputs of both models are compared on random sentences,
+        the original model is kept if they differ more than tolerance
+        '''
+        folded = decomposable_attention.build_inference_model(self.model, self.settings)
+
+        # Random ids with random lengths, padded with zeros
+        rng = np.random.default_rng(1)
+        maxlen = self.settings["maxlen"]
+        x = []
+        for _ in range(2):
+            ids = rng.integers(1, self.settings["vocab_size"], (samples, maxlen), dtype=np.int32)
+            lengths = rng.integers(1, maxlen + 1, samples)
+            ids[np.arange(maxlen) >= lengths[:, None]] = 0
+            x.append(tf.convert_to_tensor(ids))
+        x = tuple(x)
+
+        def run(model):
+            predict_fn = tf.function(lambda x: model(x, training=False))
+            y_pred = predict_fn(x).numpy() # Trace before timing
+            best = float("inf")
+            for _ in range(repeats):
+                start = default_timer()
+                predict_fn(x).numpy()
+                best = min(best, default_timer() - start)
+            return y_pred, best
+
+        y_orig, time_orig = run(self.model)
+        y_folded, time_folded = run(folded)
+        max_diff = float(np.max(np.abs(y_orig - y_folded)))
+        if max_diff > tolerance:
+            logging.warning(f"Folded embeddings model differs from the original"
+                            f" by {max_diff:.2e} > {tolerance:.0e}, keeping the original model")
+            return False
+        logging.info(f"Folded embeddings: max difference {max_diff:.2e},"
+                     f" {1000*time_orig/samples:.3f} -> {1000*time_folded/samples:.3f} ms per pair,"
+                     f" speedup {time_orig/time_folded:.2f}x")
+        self.model = folded
+        return True
+
 class Transformer(BaseModel):
     '''Basic Transformer model'''
 
@@ -418,8 +595,8 @@ class Transformer(BaseModel):
                          decay_steps=self.settings["steps_per_epoch"]//4,
                          decay_rate=0.2)
         self.settings["scheduler"] = scheduler
-        self.settings["optimizer"] = Adam(learning_rate=settings["scheduler"],
-                                          clipnorm=settings["clipnorm"])
+        self.settings["optimizer"] = Adam(learning_rate=scheduler,
+                                          clipnorm=self.settings["clipnorm"])
 
     def get_generator(self, batch_size, shuffle):
         return ConcatSentenceGenerator(
@@ -431,8 +608,10 @@ class Transformer(BaseModel):
     def build_model(self, compile=True):
         settings = self.settings
         inputs = layers.Input(shape=(settings["maxlen"],), dtype='int32')
-        embedding = TokenAndPositionEmbedding(self.wv,
+        embedding = TokenAndPositionEmbedding(settings["vocab_size"],
+                                              settings["emb_dim"],
                                               settings["maxlen"],
+                                              self.wv,
                                               trainable=True)
         transformer_block = TransformerBlock(
                                 settings["emb_dim"],
@@ -465,6 +644,11 @@ class BCXLMRoberta(BaseModel):
     def __init__(self, directory, settings, **kwargs):
         self.dir = directory
         self.model = None
+        self.predict_fn = None
+        self.predict_model = None
+        self.id_buffers = IdBuffers()
+        # Extra Keras callbacks for training, like the profiler
+        self.callbacks = []
         self.tokenizer = None
 
         self.settings = {
@@ -485,8 +669,15 @@ class BCXLMRoberta(BaseModel):
             "decay_rate": 0.1,
             "warmup_steps": 1000,
             "clipnorm": 1.0,
+            "mmap_weights": None,
+            "early_exit_layers": None,
+            "early_exit_threshold": None,
+            "exit_hidden_size": 256,
+            "exit_epochs": 1,
+            "exit_lr": 1e-4,
             **settings,
         }
+        self.exit_depths = None
         scheduler = InverseTimeDecay(self.settings["lr"],
                                      decay_steps=32.0,
                                      decay_rate=0.1)
@@ -513,22 +704,164 @@ class BCXLMRoberta(BaseModel):
                         num_labels=settings["n_classes"],
                         head_hidden_size=settings["n_hidden"],
                         head_dropout=settings["dropout"],
-                        head_activation=settings["activation"])
+                        head_activation=settings["activation"],
+                        exit_layers=settings["early_exit_layers"],
+                        exit_hidden_size=settings["exit_hidden_size"])
 
         return tf_model
 
+    def early_exit_enabled(self):
+        return bool(self.settings["early_exit_layers"]) \
+                and self.settings["early_exit_threshold"] is not None
+
+    def predict_generator(self, generator):
+        '''
+        Returns the logits for all the batches of a generator
+        With early exit enabled, the layer where each sample exited
+        is stored in exit_depths
+        '''
+        if not self.early_exit_enabled():
+            self.exit_depths = None
+            return super(BCXLMRoberta, self).predict_generator(generator)
+
+        logits = []
+        depths = []
+        for i in range(len(generator)):
+            (input_ids, att_mask), _ = generator[i]
+            batch_logits, batch_depths = self.model.early_exit_predict(
+                    input_ids, att_mask,
+                    self.settings["early_exit_threshold"])
+            logits.append(batch_logits)
+            depths.append(batch_depths)
+        self.exit_depths = np.concatenate(depths)
+        return np.concatenate(logits)
+
+    def train_exit_heads(self, train_generator, steps_per_epoch, strategy):
+        '''
+        Train the early exit heads on top of the frozen fine-tuned encoder
+        Each head learns from the hidden states of its layer
+        '''
+        model = self.model
+        with strategy.scope():
+            optimizer = Adam(learning_rate=self.settings["exit_lr"])
+        loss_fn = SparseCategoricalCrossentropy(from_logits=True,
+                        reduction=tf.keras.losses.Reduction.SUM)
+        variables = [v for head in model.exit_heads
+                        for v in head.trainable_variables]
+        batch_size = self.settings["batch_size"]
+
+        # Batches are ((input_ids, att_mask), y) or ((input_ids, att_mask), y, weights)
+        # if the training set has sample weights
+        def batches():
+            for step in range(steps_per_epoch):
+                yield train_generator[step % len(train_generator)]
+        sample = tf.nest.map_structure(np.asarray, train_generator[0])
+        dataset = tf.data.Dataset.from_generator(batches,
+                output_types=tf.nest.map_structure(lambda v: tf.as_dtype(v.dtype), sample),
+                output_shapes=tf.nest.map_structure(lambda v: tf.TensorShape([None] * v.ndim), sample))
+        # Split each batch across the replicas
+        dataset = strategy.experimental_distribute_dataset(dataset)
+
+        def train_step(batch):
+            (input_ids, att_mask), y = batch[:2]
+            weights = batch[2] if len(batch) == 3 else None
+            outputs = model.roberta(input_ids=input_ids,
+                                    attention_mask=att_mask,
+                                    output_hidden_states=True,
+                                    training=False)
+            with tf.GradientTape() as tape:
+                losses = [loss_fn(y, head(outputs.hidden_states[l], training=True),
+                                  sample_weight=weights)
+                            for l, head in zip(model.exit_layers, model.exit_heads)]
+                # Per replica loss is divided by the global batch size
+                loss = tf.add_n(losses) / batch_size
+            grads = tape.gradient(loss, variables)
+            optimizer.apply_gradients(zip(grads, variables))
+            return loss
+
+        @tf.function
+        def distributed_step(batch):
+            loss = strategy.run(train_step, args=(batch,))
+            return strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+
+        logging.info(f"Training early exit heads at layers {model.exit_layers}")
+        for epoch in range(self.settings["exit_epochs"]):
+            total = 0.0
+            for batch in dataset:
+                total += float(distributed_step(batch))
+            train_generator.on_epoch_end()
+            logging.info(f"Early exit epoch {epoch+1}"
+                         f" - loss: {total/steps_per_epoch:.4f}")
+
+    def early_exit_curve(self, dev_generator,
+            thresholds=(0.6, 0.7, 0.8, 0.9, 0.95, 0.99)):
+        '''
+        Compute speed/quality trade-off of early exit on the dev set
+        early_exit_predict is timed on the dev set with each threshold
+        and the speedup is measured against the full model
+        Returns a list of (threshold, avg layers, speedup, f1, mcc)
+        '''
+        model = self.model
+        y_true = dev_generator.y
+        batches = []
+        for i in range(len(dev_generator)):
+            x = dev_generator[i][0]
+            batches.append(tuple(tf.convert_to_tensor(v) for v in x))
+
+        def timed(predict):
+            start = default_timer()
+            outputs = [predict(x) for x in batches]
+            return default_timer() - start, outputs
+
+        predict_fn = self.predict_function()
+        full_predict = lambda x: predict_fn(x).numpy()
+        # Trace the tf.functions before timing them
+        for x in batches[:2]:
+            full_predict(x)
+            model.early_exit_predict(*x, float("inf"))
+        full_time, _ = timed(full_predict)
+
+        curve = []
+        for threshold in thresholds:
+            elapsed, outputs = timed(
+                    lambda x: model.early_exit_predict(*x, threshold))
+            y_pred = np.argmax(np.concatenate([o[0] for o in outputs]), axis=-1)
+            depths = np.concatenate([o[1] for o in outputs])
+            curve.append((threshold, depths.mean(), full_time/elapsed,
+                          f1_score(y_true, y_pred),
+                          matthews_corrcoef(y_true, y_pred)))
+
+        logging.info("Early exit dev curve (threshold, avg layers, speedup, f1, mcc):")
+        with open(self.dir + '/early_exit_curve.tsv', 'w') as curve_file:
+            curve_file.write("threshold\tavg_layers\tspeedup\tf1\tmcc\n")
+            for row in curve:
+                line = "{:.2f}\t{:.2f}\t{:.2f}\t{:.3f}\t{:.3f}".format(*row)
+                logging.info(line)
+                curve_file.write(line + "\n")
+        return curve
+
     def load(self):
         ''' Load fine-tuned model '''
-        vocab_file = self.dir + '/' + self.settings["vocab_file"]
+        settings = self.settings
+        vocab_file = self.dir + '/' + settings["vocab_file"]
         self.tokenizer = XLMRobertaTokenizerFast.from_pretrained(vocab_file)
-        self.model = self.load_model(self.dir+'/'+self.settings["model_file"])
-
-    def softmax_pos_prob(self, x):
-        # Compute softmax probability of the second (positive) class
-        e_x = np.exp(x - np.max(x))
-        # Need transpose to compute for each sample in the batch
-        # then slice to return class probability
-        return (e_x.T / (np.sum(e_x, axis=1).T)).T[:,1:]
+        start, start_rss = default_timer(), rss_mib()
+        model_file = self.dir+'/'+settings["model_file"]
+        if settings["mmap_weights"]:
+            # Build the model from its config without reading weights
+            config = XLMRobertaConfig.from_pretrained(model_file,
+                                        num_labels=settings["n_classes"])
+            self.model = BCXLMRobertaForSequenceClassification(config,
+                                head_hidden_size=settings["n_hidden"],
+                                head_dropout=settings["dropout"],
+                                head_activation=settings["activation"],
+                                exit_layers=settings["early_exit_layers"],
+                                exit_hidden_size=settings["exit_hidden_size"])
+            self.model(self.model.dummy_inputs, training=False)
+            load_mmap_weights(self.model, self.dir, settings["mmap_weights"])
+        else:
+            self.model = self.load_model(model_file)
+        self.log_load(start, start_rss)
 
     def build_dataset(self, filename):
         ''' Read a file into a TFDataset '''
@@ -594,8 +927,11 @@ class BCXLMRoberta(BaseModel):
                        steps_per_epoch=steps_per_epoch,
                        validation_data=dev_generator,
                        batch_size=self.settings["batch_size"],
-                       callbacks=[earlystop],
+                       callbacks=[earlystop, *self.callbacks],
                        verbose=1)
+        if self.model.exit_layers:
+            self.train_exit_heads(train_generator, steps_per_epoch, strategy)
+            self.early_exit_curve(dev_generator)
         self.model.save_pretrained(model_filename)
         self.tokenizer.save_pretrained(vocab_filename)
 
@@ -616,10 +952,103 @@ class BCXLMRoberta(BaseModel):
 class BCXLMRobertaForSequenceClassification(TFXLMRobertaForSequenceClassification):
     """Model for sentence-level classification tasks."""
 
-    def __init__(self, config, head_hidden_size, head_dropout, head_activation):
+    def __init__(self, config, head_hidden_size, head_dropout, head_activation,
+                 exit_layers=None, exit_hidden_size=256):
         super().__init__(config)
         self.classifier = BCClassificationHead(config,
                                                head_hidden_size,
                                                head_dropout,
                                                head_activation,
                                                name='bc_classification_head')
+
+        # Lightweight heads on intermediate layers for early exit
+        # layers are counted from 1, the last one is the full model
+        if exit_layers:
+            self.exit_layers = sorted(int(l) for l in exit_layers
+                                        if 0 < int(l) < config.num_hidden_layers)
+        else:
+            self.exit_layers = []
+        self.exit_heads = []
+        for l in self.exit_layers:
+            head = BCClassificationHead(config,
+                                        exit_hidden_size,
+                                        head_dropout,
+                                        head_activation,
+                                        name=f'exit_head_{l}')
+            # Build weights now, they are not used in the regular call
+            # so they would not be built before loading weights
+            head(tf.zeros((1, 1, config.hidden_size)))
+            self.exit_heads.append(head)
+        self.exit_segments = None
+
+    def exit_segment_functions(self):
+        '''
+        Compiled encoder segments between exit layers
+        Each one runs the layers up to the next exit on the remaining samples
+        and returns the hidden states, the mask and the logits of the head there,
+        the first one also computes the embeddings and the last one has the classifier
+        '''
+        if self.exit_segments is not None:
+            return self.exit_segments
+        encoder_layers = self.roberta.encoder.layer
+        ends = [*self.exit_layers, len(encoder_layers)]
+        heads = [*self.exit_heads, self.classifier]
+
+        def run_layers(layers, head, hidden, mask):
+            for layer in layers:
+                hidden = layer(hidden_states=hidden,
+                               attention_mask=mask,
+                               head_mask=None,
+                               output_attentions=False,
+                               training=False)[0]
+            return hidden, mask, head(hidden)
+
+        segments = []
+        start = 0
+        for end, head in zip(ends, heads):
+            layers = encoder_layers[start:end]
+            if start == 0:
+                def segment(input_ids, attention_mask, layers=layers, head=head):
+                    hidden = self.roberta.embeddings(input_ids=input_ids, training=False)
+                    mask = tf.cast(attention_mask, hidden.dtype)[:, tf.newaxis, tf.newaxis, :]
+                    mask = (1.0 - mask) * -10000.0
+                    return run_layers(layers, head, hidden, mask)
+            else:
+                def segment(hidden, mask, remaining, layers=layers, head=head):
+                    return run_layers(layers, head,
+                                      tf.gather(hidden, remaining),
+                                      tf.gather(mask, remaining))
+            segments.append(tf.function(segment, experimental_relax_shapes=True))
+            start = end
+        self.exit_segments = segments
+        return segments
+
+    def early_exit_predict(self, input_ids, attention_mask, threshold):
+        '''
+        Run the encoder layer by layer, the samples whose exit head
+        confidence passes the threshold skip the remaining layers
+        Returns the logits and the layer where each sample exited
+        '''
+        segments = self.exit_segment_functions()
+        n = input_ids.shape[0]
+        logits = np.zeros((n, self.num_labels), dtype=np.float32)
+        depths = np.full(n, len(self.roberta.encoder.layer), dtype=np.int32)
+        active = np.arange(n)
+
+        hidden, mask, exit_logits = segments[0](input_ids, attention_mask)
+        for depth, segment in zip(self.exit_layers, segments[1:]):
+            # Only sync the logits of the head, confidence is computed in numpy
+            exit_logits = exit_logits.numpy()
+            confidence = 1.0 / np.exp(exit_logits
+                    - exit_logits.max(axis=-1, keepdims=True)).sum(axis=-1)
+            done = confidence >= threshold
+            logits[active[done]] = exit_logits[done]
+            depths[active[done]] = depth
+            remaining = np.flatnonzero(~done).astype(np.int32)
+            if len(remaining) == 0:
+                return logits, depths
+            active = active[remaining]
+            hidden, mask, exit_logits = segment(hidden, mask, remaining)
+
+        logits[active] = exit_logits.numpy()
+        return logits, depths
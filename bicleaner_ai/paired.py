@@ -0,0 +1,114 @@
+'''
+Paired-file input
+
+Corpora in Moses format have one file per language with a sentence
+per line. PairedReader reads both files in lockstep as tab-separated
+'source<TAB>target' lines, so they can be classified and used for
+training without pasting them first.
+Files can be compressed with gzip, bzip2 or xz, according to their extension.
+'''
+from itertools import zip_longest
+import logging
+import gzip
+import lzma
+import bz2
+import sys
+import os
+
+COMPRESSED = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+# Open a file, compressed according to its extension
+def open_compressed(filename, mode='rb'):
+    if filename == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return stream if 't' in mode else stream.buffer
+    opener = COMPRESSED.get(os.path.splitext(filename)[1], open)
+    return opener(filename, mode)
+
+class PairedReader(object):
+    '''
+    Reads aligned source and target files in lockstep
+    as 'source<TAB>target' lines, bytes or text
+    Fails if one of the files has more lines than the other
+    '''
+
+    def __init__(self, source, target, binary=True):
+        self.source = source
+        self.target = target
+        self.binary = binary
+        self.name = source
+        self.src = None
+        self.trg = None
+        self.open()
+
+    def open(self):
+        self.src = open_compressed(self.source)
+        self.trg = open_compressed(self.target)
+
+    def __iter__(self):
+        nline = 0
+        for src, trg in zip_longest(self.src, self.trg):
+            if src is None or trg is None:
+                shorter = self.source if src is None else self.target
+                raise Exception(f"Paired files have different number of lines,"
+                                f" {shorter} ends after line {nline}")
+            nline += 1
+            # Tabs would shift the columns
+            line = src.rstrip(b"\r\n").replace(b"\t", b" ") + b"\t" \
+                    + trg.rstrip(b"\r\n").replace(b"\t", b" ") + b"\n"
+            yield line if self.binary else line.decode("utf-8")
+
+    def seek(self, offset):
+        '''Only rewinding is supported'''
+        if offset != 0:
+            raise Exception("Paired files can only be read from the start")
+        self.close()
+        self.open()
+
+    def close(self):
+        for f in (self.src, self.trg):
+            if f is not None and f not in (sys.stdin.buffer, sys.stdout.buffer):
+                f.close()
+
+
+class PairedWriter(object):
+    '''Writes the source and target columns of lines to two files'''
+
+    def __init__(self, source, target, columns=(1, 2)):
+        self.src = open_compressed(source, 'wb')
+        self.trg = open_compressed(target, 'wb')
+        self.columns = columns
+
+    def write(self, line):
+        scol, tcol = self.columns
+        parts = line.rstrip(b"\r\n").split(b"\t", max(scol, tcol))
+        self.src.write(parts[scol-1] + b"\n")
+        self.trg.write(parts[tcol-1] + b"\n")
+
+    def close(self):
+        self.src.close()
+        self.trg.close()
+
+# Input of classify --paired, the positional input is the source file
+def paired_input(args):
+    if args.header:
+        raise Exception("--paired files can not have a header")
+    if args.coordinator is not None or args.estimate is not None:
+        raise Exception("--paired is not compatible with --coordinator or --estimate")
+    logging.info(f"Reading paired files {args.input.name} and {args.paired}")
+    args.input.close()
+    args.scol, args.tcol = 1, 2
+    source = '-' if args.input.name == '<stdin>' else args.input.name
+    return PairedReader(source, args.paired)
+
+# Parallel input of training, a TSV file or source and target files
+def parallel_input(filenames):
+    if len(filenames) == 1:
+        return open_compressed(filenames[0], 'rt')
+    elif len(filenames) == 2:
+        return PairedReader(*filenames, binary=False)
+    raise Exception("Parallel input has to be a TSV file or a source and a target file")
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+'''
+Score parity and speed of the inference engines of a model pack
+
+The same sample is scored by each engine available for the pack
+and compared with the first one, the reference:
+max and mean absolute score difference, decisions flipped at a threshold,
+rows/s, load time and memory of each engine.
+Without an input file a synthetic corpus is scored and with --synthetic_pack
+a tiny randomly initialized pack is built, so it runs offline in CI:
+    python -m bicleaner_ai.parity --synthetic_pack dec_attention --max_abs_diff 1e-4
+Exits with error if an engine exceeds --max_abs_diff or --max_flips.
+'''
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+import tensorflow as tf
+import numpy as np
+import argparse
+import logging
+import json
+import yaml
+import sys
+import gc
+import os
+
+try:
+    from .util import get_model, logging_setup, check_positive, check_positive_between_zero_and_one
+    from .weights import rss_mib, mmap_weights_exist
+    from .benchmark import generate_corpus, read_corpus, build_pack, METADATA
+    from .serving import export_serving, import_tensorflow_text
+except (ImportError, SystemError):
+    from util import get_model, logging_setup, check_positive, check_positive_between_zero_and_one
+    from weights import rss_mib, mmap_weights_exist
+    from benchmark import generate_corpus, read_corpus, build_pack, METADATA
+    from serving import export_serving, import_tensorflow_text
+
+def load_classifier(directory, metadata, **settings):
+    clf = get_model(metadata["classifier_type"])(directory,
+                        {**metadata["classifier_settings"], **settings})
+    clf.load()
+    return clf
+
+def classifier_predict(clf, args):
+    return lambda src, trg: clf.predict(src, trg, args.batch_size, args.calibrated)
+
+# Engines return a function that scores lists of source and target sentences
+# or None if they are not available for the pack
+
+def keras_engine(directory, metadata, args):
+    '''Keras model loaded from the model file'''
+    return classifier_predict(load_classifier(directory, metadata, mmap_weights=None), args)
+
+def mmap_engine(directory, metadata, args):
+    '''Keras model with memory-mapped weights'''
+    prefix = metadata["classifier_settings"].get("mmap_weights") or "weights"
+    if metadata["classifier_type"] == "xlmr" or not mmap_weights_exist(directory, prefix):
+        logging.info("No memory-mapped weights, export them with 'python -m bicleaner_ai.weights'")
+        return None
+    return classifier_predict(load_classifier(directory, metadata, mmap_weights=prefix), args)
+
+def folded_engine(directory, metadata, args):
+    '''Lite model with folded embeddings, see --fold_embeddings'''
+    if metadata["classifier_type"] != "dec_attention":
+        logging.info("Folded embeddings are only available for lite models")
+        return None
+    clf = load_classifier(directory, metadata)
+    # Always use it, the difference is what is measured here
+    clf.fold_embeddings(tolerance=float("inf"))
+    return classifier_predict(clf, args)
+
+def bfloat16_engine(directory, metadata, args):
+    '''Keras model built with mixed bfloat16 precision'''
+    if metadata["classifier_type"] == "xlmr":
+        logging.info("Reduced precision is not available for XLMR models")
+        return None
+    policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+    try:
+        clf = get_model(metadata["classifier_type"])(directory,
+                            {**metadata["classifier_settings"], "mmap_weights": None})
+        clf.load_spm()
+        model = clf.build_model(compile=False)
+        model.load_weights(os.path.join(directory, clf.settings["model_file"]))
+    finally:
+        tf.keras.mixed_precision.set_global_policy(policy)
+    # Scores are converted to float32 like the other engines
+    output = tf.keras.layers.Activation('linear', dtype='float32')(model.output)
+    clf.model = tf.keras.Model(model.inputs, output)
+    return classifier_predict(clf, args)
+
+def serving_engine(directory, metadata, args):
+    '''SavedModel with in-graph tokenization, see bicleaner_ai.serving'''
+    if metadata["classifier_type"] == "xlmr":
+        logging.info("Serving models are not available for XLMR models")
+        return None
+    try:
+        import_tensorflow_text()
+    except Exception as e:
+        logging.info(str(e))
+        return None
+    clf = load_classifier(directory, metadata)
+    with TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        export_serving(clf, tmp_dir, args.calibrated)
+        loaded = tf.saved_model.load(tmp_dir)
+
+    def predict(src, trg):
+        # Keep a reference to the loaded model, signatures do not own its variables
+        score = loaded.signatures["serving_default"]
+        scores = []
+        for i in range(0, len(src), args.batch_size):
+            scores.append(score(source=tf.constant(src[i:i+args.batch_size]),
+                                target=tf.constant(trg[i:i+args.batch_size]))["score"].numpy())
+        return np.concatenate(scores)
+    return predict
+
+ENGINES = {
+    "keras": keras_engine,
+    "mmap": mmap_engine,
+    "folded": folded_engine,
+    "bfloat16": bfloat16_engine,
+    "serving": serving_engine,
+}
+
+def read_sample(args):
+    if args.input is None:
+        return None
+    src, trg = [], []
+    for line in args.input:
+        parts = line.rstrip("\r\n").split("\t")
+        src.append(parts[args.scol-1].strip())
+        trg.append(parts[args.tcol-1].strip())
+        if len(src) == args.lines:
+            break
+    return src, trg
+
+def run_engine(name, directory, metadata, src, trg, args):
+    '''Load an engine and score the sample in blocks, None if not available'''
+    start, start_rss = default_timer(), rss_mib()
+    predict = ENGINES[name](directory, metadata, args)
+    if predict is None:
+        return None, None
+    load_seconds = default_timer() - start
+    load_rss = rss_mib() - start_rss
+
+    # Trace before timing
+    predict(src[:args.batch_size], trg[:args.batch_size])
+    scores = []
+    peak_rss = rss_mib()
+    start = default_timer()
+    for i in range(0, len(src), args.block_size):
+        scores.append(np.reshape(predict(src[i:i+args.block_size],
+                                         trg[i:i+args.block_size]), -1))
+        peak_rss = max(peak_rss, rss_mib())
+    elapsed = default_timer() - start
+
+    result = {"engine": name,
+              "rows_per_second": round(len(src) / elapsed, 1),
+              "load_seconds": round(load_seconds, 3),
+              "load_rss_mib": round(load_rss, 1),
+              "peak_rss_mib": round(peak_rss, 1)}
+    return result, np.concatenate(scores).astype(np.float32)
+
+# Score differences of an engine with the reference
+def compare_scores(reference, scores, threshold):
+    diff = np.abs(scores - reference)
+    flipped = int(np.count_nonzero((reference >= threshold) != (scores >= threshold)))
+    return {"max_abs_diff": float(diff.max()) if len(diff) else 0.0,
+            "mean_abs_diff": float(diff.mean()) if len(diff) else 0.0,
+            "flipped": flipped,
+            "flipped_rate": round(flipped / len(diff), 6) if len(diff) else 0.0}
+
+def synthetic_sample(args, work_dir):
+    corpus_file = os.path.join(work_dir, "corpus.tsv")
+    if not os.path.isfile(corpus_file):
+        generate_corpus(corpus_file, args.lines, seed=args.seed)
+    return read_corpus(corpus_file)
+
+def parity(args, metadata_file, work_dir):
+    with open(metadata_file) as f:
+        metadata = yaml.safe_load(f)
+    directory = os.path.dirname(os.path.abspath(metadata_file))
+    src, trg = read_sample(args) or synthetic_sample(args, work_dir)
+    if not src:
+        raise Exception("Sample has no lines")
+    logging.info(f"Scoring {len(src)} pairs with {metadata['classifier_type']} engines {', '.join(args.engines)}")
+
+    results = {"classifier_type": metadata["classifier_type"],
+               "rows": len(src),
+               "threshold": args.threshold,
+               "calibrated": args.calibrated,
+               "engines": []}
+    reference = None
+    for name in args.engines:
+        result, scores = run_engine(name, directory, metadata, src, trg, args)
+        if result is None:
+            if reference is None:
+                raise Exception(f"Reference engine {name} is not available")
+            logging.info(f"Skipping engine {name}")
+            continue
+        if reference is None:
+            reference = scores
+            result["reference"] = True
+        result.update(compare_scores(reference, scores, args.threshold))
+        logging.info(f"{name}: {result['rows_per_second']} rows/s,"
+                     f" load {result['load_seconds']}s {result['load_rss_mib']} MiB,"
+                     f" peak RSS {result['peak_rss_mib']} MiB,"
+                     f" max diff {result['max_abs_diff']:.2e},"
+                     f" mean diff {result['mean_abs_diff']:.2e},"
+                     f" {result['flipped']} flipped at {args.threshold}")
+        results["engines"].append(result)
+
+        # Free the engine before loading the next one
+        del scores
+        gc.collect()
+        tf.keras.backend.clear_session()
+    return results
+
+# Engines over the maximum difference or flips
+def failures(results, max_abs_diff, max_flips):
+    failed = []
+    for r in results["engines"]:
+        if (max_abs_diff is not None and r["max_abs_diff"] > max_abs_diff) \
+                or (max_flips is not None and r["flipped"] > max_flips):
+            failed.append(r["engine"])
+    return failed
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Score parity and speed of the inference engines of a model pack")
+    parser.add_argument('metadata', nargs='?', default=None, help="Model pack metadata (YAML file)")
+    parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=None, help="Tab-separated sample to score, a synthetic corpus by default")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Results in JSON")
+    parser.add_argument('--synthetic_pack', choices=("dec_attention", "transformer", "xlmr"), default=None, help="Build a tiny randomly initialized pack of this type instead of using metadata")
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES), help="Engines to run, the first one is the reference. Not available engines are skipped")
+    parser.add_argument('--scol', default=3, type=check_positive, help="Source sentence column (starting in 1)")
+    parser.add_argument('--tcol', default=4, type=check_positive, help="Target sentence column (starting in 1)")
+    parser.add_argument('--lines', type=check_positive, default=5000, help="Lines of the sample")
+    parser.add_argument('-b', '--block_size', type=check_positive, default=1000, help="Sentence pairs per block")
+    parser.add_argument('--batch_size', type=check_positive, default=32, help="Sentence pairs per batch")
+    parser.add_argument('--threshold', type=check_positive_between_zero_and_one, default=0.5, help="Threshold of the flipped decisions")
+    parser.add_argument('--calibrated', action='store_true', help="Compare calibrated scores")
+    parser.add_argument('--max_abs_diff', type=float, default=None, help="Exit with error if the score difference of an engine is larger")
+    parser.add_argument('--max_flips', type=int, default=None, help="Exit with error if an engine flips more decisions")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the synthetic corpus and pack")
+    parser.add_argument('--tmp_dir', default=None, help="Temporary directory")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    return parser
+
+def main():
+    parser = argument_parser()
+    args = parser.parse_args()
+    logging_setup(args)
+    if (args.metadata is None) == (args.synthetic_pack is None):
+        parser.error("Either metadata or --synthetic_pack is required")
+
+    with TemporaryDirectory(dir=args.tmp_dir) as work_dir:
+        metadata_file = args.metadata
+        if args.synthetic_pack is not None:
+            directory = os.path.join(work_dir, args.synthetic_pack)
+            src, trg = synthetic_sample(args, work_dir)
+            build_pack(args.synthetic_pack, directory, src + trg, args.seed)
+            metadata_file = os.path.join(directory, METADATA)
+        results = parity(args, metadata_file, work_dir)
+
+    failed = failures(results, args.max_abs_diff, args.max_flips)
+    results["failed"] = failed
+    json.dump(results, args.output, indent=1)
+    args.output.write("\n")
+    if failed:
+        logging.error(f"Engines over the parity limits: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Cumulative timers and counters of the classification stages
+
+Stages add their wall time once per block or batch, so the overhead
+is negligible. The shared instance 'timers' is used by classify,
+the models and the sentence generators.
+'''
+from contextlib import contextmanager
+from time import perf_counter
+import logging
+import signal
+import json
+
+class StageTimers(object):
+    '''Wall time and calls of each stage and event counters'''
+
+    def __init__(self):
+        self.reset()
+        self.interval = 0
+        # Descriptions of the run, like the CPU placement
+        self.labels = {}
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.start = perf_counter()
+        self.last_log = self.start
+
+    def add(self, name, seconds, calls=1):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def snapshot(self):
+        elapsed = perf_counter() - self.start
+        stages = {name: {"seconds": round(s, 4),
+                         "calls": self.calls[name],
+                         "share": round(s / elapsed, 4) if elapsed else 0.0}
+                    for name, s in self.seconds.items()}
+        derived = {}
+        if elapsed:
+            derived["lines_per_second"] = round(self.counters.get("lines", 0) / elapsed, 1)
+        if self.counters.get("padded_tokens"):
+            derived["padding_ratio"] = round(1 - self.counters.get("tokens", 0)
+                                             / self.counters["padded_tokens"], 4)
+        if self.counters.get("batches") and "encode" in self.seconds:
+            derived["encode_ms_per_batch"] = round(1000 * self.seconds["encode"]
+                                                   / self.counters["batches"], 3)
+        if self.counters.get("pairs"):
+            derived["tokens_per_pair"] = round(self.counters.get("tokens", 0)
+                                               / self.counters["pairs"], 1)
+        return {"elapsed_seconds": round(elapsed, 4),
+                **({"labels": dict(self.labels)} if self.labels else {}),
+                "stages": stages,
+                "counters": dict(self.counters),
+                **derived}
+
+    def report(self):
+        snap = self.snapshot()
+        stages = ", ".join(f"{name} {s['seconds']:.2f}s ({s['share']:.0%})"
+                            for name, s in snap["stages"].items())
+        counters = ", ".join(f"{name} {value}" for name, value in snap["counters"].items())
+        text = f"Stages after {snap['elapsed_seconds']:.1f}s: {stages}. Counters: {counters}"
+        if "padding_ratio" in snap:
+            text += f", padding {snap['padding_ratio']:.1%}"
+        return text
+
+    def to_prometheus(self):
+        lines = ["# TYPE bicleaner_ai_stage_seconds_total counter"]
+        for name, s in self.seconds.items():
+            lines.append(f'bicleaner_ai_stage_seconds_total{{stage="{name}"}} {s}')
+        lines.append("# TYPE bicleaner_ai_stage_calls_total counter")
+        for name, c in self.calls.items():
+            lines.append(f'bicleaner_ai_stage_calls_total{{stage="{name}"}} {c}')
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE bicleaner_ai_{name}_total counter")
+            lines.append(f"bicleaner_ai_{name}_total {value}")
+        lines.append("# TYPE bicleaner_ai_elapsed_seconds gauge")
+        lines.append(f"bicleaner_ai_elapsed_seconds {perf_counter() - self.start}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        '''Write as Prometheus text if filename ends in .prom, JSON otherwise'''
+        with open(filename, 'w') as f:
+            if filename.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.snapshot(), f, indent=1)
+
+    def maybe_log(self):
+        '''Log the report if the interval has passed since the last one'''
+        if self.interval and perf_counter() - self.last_log >= self.interval:
+            self.last_log = perf_counter()
+            logging.info(self.report())
+
+    def install_signal_handler(self, signum=getattr(signal, "SIGUSR1", None)):
+        '''Log the report when the process receives SIGUSR1'''
+        if signum is None:
+            return
+        try:
+            signal.signal(signum, lambda *_: logging.info(self.report()))
+        except ValueError:
+            # Not in the main thread
+            pass
+
+timers = StageTimers()
@@ -0,0 +1,95 @@
+'''
+Profiling of classify and train runs
+
+The Python side of the whole run is profiled with cProfile (python.prof,
+readable with pstats or snakeviz) and a TensorFlow profiler trace
+of a window of blocks or training steps is written to tf/
+(open it with the TensorBoard profile plugin).
+summary.txt lists the top Python hotspots and the stage timers.
+'''
+from tensorflow.keras.callbacks import Callback
+import tensorflow as tf
+import cProfile
+import logging
+import pstats
+import io
+import os
+
+try:
+    from .perf import timers
+except (SystemError, ImportError):
+    from perf import timers
+
+class Profiler(object):
+    '''
+    cProfile of the run and TensorFlow trace from step start
+    during the following steps, a step is a classify block or a training batch
+    '''
+
+    def __init__(self, directory, start=2, steps=5, top=25):
+        self.directory = directory
+        self.start_step = start
+        self.steps = steps
+        self.top = top
+        self.current = 0
+        self.tracing = False
+        self.profile = cProfile.Profile()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_args(cls, args):
+        '''Create a profiler from the arguments, None if --profile is not set'''
+        if getattr(args, "profile", None) is None:
+            return None
+        return cls(args.profile, args.profile_start, args.profile_steps)
+
+    def start(self):
+        logging.info(f"Profiling to {self.directory}")
+        self.profile.enable()
+        self.step(advance=False)
+
+    def step(self, advance=True):
+        '''Mark the end of a step, starts or stops the trace window'''
+        if advance:
+            self.current += 1
+        if not self.tracing and self.current == self.start_step:
+            tf.profiler.experimental.start(os.path.join(self.directory, "tf"))
+            self.tracing = True
+            logging.debug(f"TensorFlow trace started at step {self.current}")
+        elif self.tracing and self.current >= self.start_step + self.steps:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+            logging.debug(f"TensorFlow trace stopped at step {self.current}")
+
+    def stop(self):
+        '''Stop profiling and write the profiles and the summary'''
+        self.profile.disable()
+        self.stop_trace()
+        self.profile.dump_stats(os.path.join(self.directory, "python.prof"))
+
+        summary = io.StringIO()
+        summary.write(f"Steps: {self.current}, TensorFlow trace of steps"
+                      f" {self.start_step} to {self.start_step + self.steps - 1}"
+                      f" in {os.path.join(self.directory, 'tf')}\n\n")
+        summary.write(timers.report() + "\n\n")
+        stats = pstats.Stats(self.profile, stream=summary)
+        for sort in ("tottime", "cumulative"):
+            summary.write(f"Top {self.top} functions by {sort}\n")
+            stats.sort_stats(sort).print_stats(self.top)
+        with open(os.path.join(self.directory, "summary.txt"), 'w') as f:
+            f.write(summary.getvalue())
+        logging.info(f"Profile summary written to {os.path.join(self.directory, 'summary.txt')}")
+
+    def keras_callback(self):
+        '''Callback that advances a step at the end of each training batch'''
+        profiler = self
+
+        class ProfilerCallback(Callback):
+            def on_train_batch_end(self, batch, logs=None):
+                profiler.step()
+
+        return ProfilerCallback()
@@ -0,0 +1,108 @@
+import logging
+import os
+import re
+
+try:
+    from .paired import PairedWriter
+except (ImportError, SystemError):
+    from paired import PairedWriter
+
+# Discard reasons for lines that cannot be scored
+WRONG_COLUMNS = "wrong_columns"
+INVALID_UTF8 = "invalid_utf8"
+LINE_TOO_LONG = "line_too_long"
+EMPTY_SENTENCE = "empty_sentence"
+
+# Normalize Hardrules wrong_tu result to a list of rule names
+# it can be a rule name, several names joined by '+' or a list of them
+def hardrules_reasons(result):
+    if isinstance(result, str):
+        return result.split('+')
+    elif isinstance(result, (list, tuple)):
+        return [str(r) for r in result]
+    else:
+        return ["hardrules"]
+
+class OutputRouter(object):
+    '''
+    Routes classified lines in the same pass to a kept file,
+    a discarded file and a file per discard reason
+    Lines with score above or equal to threshold are kept,
+    lines discarded by hard rules go to their reason file(s) too
+    Source and target sentences of kept lines can be written
+    to a pair of files too
+    '''
+
+    def __init__(self, threshold=0.5, kept=None, discarded=None,
+                 reasons_dir=None, buffer_size=1<<20,
+                 kept_paired=None, columns=(1, 2)):
+        self.threshold = threshold
+        self.buffer_size = buffer_size
+        self.kept = self.open(kept)
+        self.discarded = self.open(discarded)
+        self.kept_paired = None
+        if kept_paired is not None:
+            self.kept_paired = PairedWriter(*kept_paired, columns)
+        self.reasons_dir = reasons_dir
+        self.reasons = {}
+        self.header = None
+        if reasons_dir is not None:
+            os.makedirs(reasons_dir, exist_ok=True)
+
+    @classmethod
+    def from_args(cls, args):
+        '''Create a router from classify arguments, None if no sink is set'''
+        if args.kept_tus is None and args.discarded_tus is None \
+                and args.discarded_reasons_dir is None \
+                and args.paired_output is None:
+            return None
+        return cls(args.threshold, args.kept_tus, args.discarded_tus,
+                   args.discarded_reasons_dir,
+                   kept_paired=args.paired_output,
+                   columns=(args.scol, args.tcol))
+
+    def open(self, filename):
+        if filename is None:
+            return None
+        return open(filename, 'wb', buffering=self.buffer_size)
+
+    def reason_file(self, reason):
+        if reason not in self.reasons:
+            name = re.sub(r'[^\w.-]', '_', reason)
+            filename = os.path.join(self.reasons_dir, name + ".tsv")
+            logging.debug(f"Writing '{reason}' discarded lines to {filename}")
+            self.reasons[reason] = self.open(filename)
+            if self.header is not None:
+                self.reasons[reason].write(self.header)
+        return self.reasons[reason]
+
+    def write_header(self, header):
+        '''Write header line to every sink, including the ones opened later'''
+        self.header = header
+        for f in [self.kept, self.discarded, *self.reasons.values()]:
+            if f is not None:
+                f.write(header)
+
+    def route(self, line, score, reasons=None):
+        '''
+        Write an output line (with trailing newline) to its sinks
+        reasons is the list of discard reasons if it was not scored
+        '''
+        if reasons:
+            if self.discarded is not None:
+                self.discarded.write(line)
+            if self.reasons_dir is not None:
+                for reason in reasons:
+                    self.reason_file(reason).write(line)
+        elif score >= self.threshold:
+            if self.kept is not None:
+                self.kept.write(line)
+            if self.kept_paired is not None:
+                self.kept_paired.write(line)
+        elif self.discarded is not None:
+            self.discarded.write(line)
+
+    def close(self):
+        for f in [self.kept, self.discarded, self.kept_paired, *self.reasons.values()]:
+            if f is not None:
+                f.close()
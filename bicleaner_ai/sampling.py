@@ -0,0 +1,210 @@
+'''
+Corpus quality estimate from a random sample of lines
+
+Lines are sampled seeking to random byte offsets and moving back to the
+start of the line that contains them, so only the sampled lines are read.
+A line is sampled with probability proportional to its length in bytes,
+estimates weight each line by the inverse of its length to be unbiased.
+If the file has a line index (python -m bicleaner_ai.lineindex),
+line numbers are sampled uniformly instead.
+Confidence intervals are computed with the bootstrap.
+'''
+from hardrules.hardrules import Hardrules
+from timeit import default_timer
+import numpy as np
+import logging
+import random
+import json
+import os
+
+try:
+    from .classify import discard_reasons
+    from .router import WRONG_COLUMNS, INVALID_UTF8, LINE_TOO_LONG
+    from .lineindex import LineIndex
+except (ImportError, SystemError):
+    from classify import discard_reasons
+    from router import WRONG_COLUMNS, INVALID_UTF8, LINE_TOO_LONG
+    from lineindex import LineIndex
+
+QUANTILES = (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95)
+
+# Offset of the start of the line containing offset
+def line_start(f, offset, chunk_size=4096):
+    pos = offset
+    while pos > 0:
+        begin = max(0, pos - chunk_size)
+        f.seek(begin)
+        i = f.read(pos - begin).rfind(b"\n")
+        if i >= 0:
+            return begin + i + 1
+        pos = begin
+    return 0
+
+# Sample n lines at random byte offsets, lines before start are never sampled
+# returns a list of lines
+def sample_lines(f, n, start=0, seed=None):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size <= start:
+        return []
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n):
+        f.seek(line_start(f, rng.randrange(start, size)))
+        lines.append(f.readline())
+    return lines
+
+# Sample n lines uniformly with a line index, skipping the first skip lines
+def sample_indexed_lines(f, index, n, skip=0, seed=None):
+    if len(index) <= skip:
+        return []
+    rng = random.Random(seed)
+    return [index.read_lines(f, rng.randrange(skip, len(index)))[0]
+                for _ in range(n)]
+
+# Quantiles of values weighted by weights
+# values and weights can have a leading dimension of bootstrap resamples
+def weighted_quantiles(values, weights, qs):
+    order = np.argsort(values, axis=-1)
+    values = np.take_along_axis(values, order, axis=-1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=-1), axis=-1)
+    cumulative /= cumulative[..., -1:]
+    result = []
+    for q in qs:
+        idx = (cumulative < q).sum(axis=-1)
+        idx = np.minimum(idx, values.shape[-1] - 1)
+        result.append(np.take_along_axis(values, idx[..., None], axis=-1)[..., 0])
+    return result
+
+def weighted_mean(values, weights):
+    return (values * weights).sum(axis=-1) / weights.sum(axis=-1)
+
+# Apply a statistic to bootstrap resamples of n items
+# in chunks of resamples to bound memory
+def bootstrap(statistic, n, resamples, rng, max_items=10_000_000):
+    chunk = max(1, max_items // n)
+    results = []
+    for start in range(0, resamples, chunk):
+        idx = rng.integers(0, n, size=(min(chunk, resamples - start), n))
+        results.append(statistic(idx))
+    return np.concatenate(results, axis=-1)
+
+def interval(estimate, resamples, confidence):
+    alpha = (1 - confidence) / 2
+    lo, hi = np.quantile(resamples, [alpha, 1 - alpha])
+    return {"estimate": round(float(estimate), 4),
+            "ci": [round(float(lo), 4), round(float(hi), 4)]}
+
+# Parse and score sampled lines like classify does, returns output scores
+# lines that cannot be parsed or are discarded by hard rules score 0
+def score_lines(args, lines, scol, tcol):
+    hardrules = Hardrules(args)
+    scores = np.zeros(len(lines), dtype=np.float64)
+    discarded = np.zeros(len(lines), dtype=bool)
+    idx = []
+    buf_sent_sl = []
+    buf_sent_tl = []
+    for i, line in enumerate(lines):
+        reason = None
+        parts = line.rstrip(b"\r\n").split(b"\t")
+        if args.max_line_bytes and len(line) > args.max_line_bytes:
+            reason = [LINE_TOO_LONG]
+        elif len(parts) < max(scol, tcol):
+            reason = [WRONG_COLUMNS]
+        else:
+            try:
+                sl_sentence = parts[scol-1].decode("utf-8").strip()
+                tl_sentence = parts[tcol-1].decode("utf-8").strip()
+                reason = discard_reasons(args, hardrules, sl_sentence, tl_sentence)
+            except UnicodeDecodeError:
+                reason = [INVALID_UTF8]
+        if reason is None:
+            idx.append(i)
+            buf_sent_sl.append(sl_sentence)
+            buf_sent_tl.append(tl_sentence)
+        else:
+            discarded[i] = True
+
+    for start in range(0, len(idx), args.block_size):
+        predictions = args.clf.predict(buf_sent_sl[start:start+args.block_size],
+                                       buf_sent_tl[start:start+args.block_size],
+                                       args.batch_size,
+                                       args.calibrated)
+        scores[idx[start:start+args.block_size]] = np.reshape(predictions, -1)
+    return scores, discarded
+
+# Estimate the score distribution of the input from a sample of args.estimate lines
+# and write a JSON report to output
+def estimate(args, input, output, resamples=1000, confidence=0.95):
+    time_start = default_timer()
+    if input.name in ("<stdin>", "-"):
+        raise Exception("--estimate needs a seekable input file, not stdin")
+    if args.raw_output:
+        raise Exception("--estimate is not compatible with --raw_output")
+    f = open(input.name, 'rb')
+
+    start = 0
+    scol, tcol = args.scol, args.tcol
+    if args.header:
+        header = f.readline().rstrip(b"\r\n").decode("utf-8").split("\t")
+        start = f.tell()
+        for col in (scol, tcol):
+            if col not in header:
+                raise Exception(f"The provided column '{col}' is not in the input header")
+        scol = header.index(scol) + 1
+        tcol = header.index(tcol) + 1
+    size = os.path.getsize(input.name)
+
+    index = LineIndex.load(input.name)
+    if index is not None:
+        lines = sample_indexed_lines(f, index, args.estimate,
+                                     1 if start else 0, args.estimate_seed)
+    else:
+        lines = sample_lines(f, args.estimate, start, args.estimate_seed)
+    f.close()
+    if not lines:
+        raise Exception("Input file has no lines to sample")
+    logging.info(f"Sampled {len(lines)} lines in {default_timer()-time_start:.2f}s")
+    scores, discarded = score_lines(args, lines, scol, tcol)
+    if index is not None:
+        weights = np.ones(len(lines), dtype=np.float64)
+    else:
+        weights = 1.0 / np.array([len(l) for l in lines], dtype=np.float64)
+
+    kept = (scores >= args.threshold).astype(np.float64)
+
+    # Estimated number of lines, kept and discarded fractions and quantiles
+    # mean inverse length under length-biased sampling is lines/bytes
+    def statistic(idx):
+        w = weights[idx]
+        if index is not None:
+            n_lines = np.full(w.shape[:-1], len(index) - (1 if start else 0))
+        else:
+            n_lines = (size - start) * w.mean(axis=-1)
+        return np.stack([n_lines,
+                         weighted_mean(kept[idx], w),
+                         weighted_mean(discarded[idx], w),
+                         *weighted_quantiles(scores[idx], w, QUANTILES)])
+
+    point = statistic(np.arange(len(lines)))
+    rng = np.random.default_rng(args.estimate_seed)
+    boot = bootstrap(statistic, len(lines), resamples, rng)
+    names = ["estimated_lines", "kept_fraction", "discarded_fraction"]
+    report = {
+        "input": input.name,
+        "input_bytes": size,
+        "samples": len(lines),
+        "confidence": confidence,
+        "threshold": args.threshold,
+    }
+    for i, name in enumerate(names):
+        report[name] = interval(point[i], boot[i], confidence)
+    report["quantiles"] = {str(q): interval(point[len(names)+i], boot[len(names)+i], confidence)
+                                for i, q in enumerate(QUANTILES)}
+    report["elapsed_seconds"] = round(default_timer() - time_start, 2)
+
+    output.write(json.dumps(report, indent=1) + "\n")
+    logging.info(f"Estimated kept fraction at {args.threshold}:"
+                 f" {report['kept_fraction']['estimate']}"
+                 f" {report['kept_fraction']['ci']}")
+    return len(lines)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Export of a serving model that takes raw sentences
+
+The exported SavedModel has a serving_default signature with 'source'
+and 'target' string inputs and a 'score' output. Its graph strips the
+sentences, encodes them with the SentencePiece op of tensorflow-text,
+truncates and pads them like classify does and runs the classifier,
+the positive class probability and the optional calibration.
+The model can be loaded with tf.saved_model.load after importing
+tensorflow_text or served with TensorFlow Serving built with its ops.
+XLMR models use a Transformers tokenizer and are not supported.
+'''
+import tensorflow as tf
+import argparse
+import logging
+import yaml
+import sys
+import os
+
+try:
+    from .util import get_model, logging_setup
+    from .models import Transformer, DecomposableAttention
+except (ImportError, SystemError):
+    from util import get_model, logging_setup
+    from models import Transformer, DecomposableAttention
+
+def import_tensorflow_text():
+    try:
+        import tensorflow_text
+    except ImportError:
+        raise Exception("Serving models need tensorflow-text, install the version matching TensorFlow with 'pip install tensorflow-text'")
+    return tensorflow_text
+
+class ServingModel(tf.Module):
+    '''Tokenization, classifier and output probabilities in one graph'''
+
+    def __init__(self, clf, calibrated=False):
+        super(ServingModel, self).__init__()
+        if not isinstance(clf, (Transformer, DecomposableAttention)):
+            raise Exception("Only models with SentencePiece vocabularies can be exported for serving")
+        text = import_tensorflow_text()
+        settings = clf.settings
+        with open(os.path.join(clf.dir, settings["spm_file"]), 'rb') as f:
+            self.tokenizer = text.SentencepieceTokenizer(model=f.read(),
+                                                         out_type=tf.int32,
+                                                         add_bos=settings["add_bos"],
+                                                         add_eos=settings["add_eos"])
+        self.model = clf.model
+        self.maxlen = settings["maxlen"]
+        self.concat = isinstance(clf, Transformer)
+        self.separator = settings["separator"]
+        self.softmax = settings["n_classes"] != 1
+        self.calibration = None
+        if calibrated:
+            if "calibration_params" not in settings:
+                raise Exception("Model has no calibration parameters")
+            self.calibration = [float(p) for p in settings["calibration_params"]]
+
+    def encode(self, sentences):
+        '''Ids truncated and padded with zeros at the end, like pad_sequences'''
+        ids = self.tokenizer.tokenize(sentences)[:, :self.maxlen]
+        return ids.to_tensor(default_value=0, shape=[None, self.maxlen])
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string, name="source"),
+                                  tf.TensorSpec([None], tf.string, name="target")])
+    def score(self, source, target):
+        source = tf.strings.strip(source)
+        target = tf.strings.strip(target)
+        if self.concat:
+            x = self.encode(tf.strings.join([source, target], separator=self.separator))
+        else:
+            x = (self.encode(source), self.encode(target))
+        y_pred = self.model(x, training=False)
+
+        # Same as BaseModel.output_probs
+        if self.softmax:
+            prob = tf.nn.softmax(y_pred, axis=-1)[:, 1]
+        else:
+            prob = y_pred[:, 0]
+        if self.calibration is not None:
+            prob = tf.sigmoid(self.calibration[0] * prob + self.calibration[1])
+        return {"score": prob}
+
+def export_serving(clf, directory, calibrated=False):
+    module = ServingModel(clf, calibrated)
+    tf.saved_model.save(module, directory,
+                        signatures={"serving_default": module.score})
+    logging.info(f"Serving model exported to {directory}")
+    return module
+
+# Export the serving model of a model pack
+def main():
+    parser = argparse.ArgumentParser(description="Export a model pack to a SavedModel that takes raw source and target sentences")
+    parser.add_argument('metadata', help="Model pack metadata (YAML file)")
+    parser.add_argument('output', help="Directory of the SavedModel")
+    parser.add_argument('--calibrated', action='store_true', help="Output calibrated scores")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    args = parser.parse_args()
+    logging_setup(args)
+
+    with open(args.metadata) as f:
+        metadata = yaml.safe_load(f)
+    directory = os.path.dirname(os.path.abspath(args.metadata))
+    clf = get_model(metadata["classifier_type"])(directory, metadata["classifier_settings"])
+    clf.load()
+    export_serving(clf, args.output, args.calibrated)
+
+if __name__ == '__main__':
+    main()
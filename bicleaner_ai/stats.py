@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+'''
+Streaming statistics of classification scores
+
+Quantiles are estimated with a KLL sketch (Karnin, Lang and Liberty 2016)
+that uses constant memory and can be merged across shards.
+Statistics are written as a JSON sidecar of the classify output,
+shards can be merged with:
+    python -m bicleaner_ai.stats -o merged.json shard1.json shard2.json
+'''
+from collections import Counter
+import numpy as np
+import argparse
+import logging
+import random
+import json
+import math
+import sys
+
+QUANTILES = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+
+class KLLSketch(object):
+    '''
+    Mergeable quantile sketch
+    Items at level h of the compactor stack have weight 2**h,
+    full levels are sorted and half of their items, the odd or even ones
+    at random, are promoted to the next level
+    '''
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.n = 0
+        self.compactors = [[]]
+        self.min = math.inf
+        self.max = -math.inf
+        self.random = random.Random(seed)
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2/3) ** depth)))
+
+    def size(self):
+        return sum(len(c) for c in self.compactors)
+
+    def max_size(self):
+        return sum(self.capacity(h) for h in range(len(self.compactors)))
+
+    def update(self, values):
+        '''Add a sequence of values'''
+        values = [float(v) for v in values]
+        if not values:
+            return
+        self.n += len(values)
+        self.min = min(self.min, min(values))
+        self.max = max(self.max, max(values))
+        self.compactors[0].extend(values)
+        self.compress()
+
+    def compress(self):
+        while self.size() > self.max_size():
+            for h in range(len(self.compactors)):
+                if len(self.compactors[h]) >= self.capacity(h):
+                    if h + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    items = sorted(self.compactors[h])
+                    # An odd item out stays in its level
+                    keep = [items.pop()] if len(items) % 2 else []
+                    offset = self.random.randint(0, 1)
+                    self.compactors[h + 1].extend(items[offset::2])
+                    self.compactors[h] = keep
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+
+    def quantiles(self, qs):
+        '''Estimated values at each of the ranks qs (between 0 and 1)'''
+        if self.n == 0:
+            return [None for _ in qs]
+        items = []
+        weights = []
+        for h, c in enumerate(self.compactors):
+            items.extend(c)
+            weights.extend([2 ** h] * len(c))
+        order = np.argsort(items, kind='stable')
+        items = np.asarray(items)[order]
+        cumulative = np.cumsum(np.asarray(weights)[order])
+        result = []
+        for q in qs:
+            i = int(np.searchsorted(cumulative, q * cumulative[-1]))
+            result.append(float(items[min(i, len(items) - 1)]))
+        # Extremes are kept exactly
+        return [self.min if q <= 0 else self.max if q >= 1 else v
+                    for q, v in zip(qs, result)]
+
+    def to_dict(self):
+        return {"k": self.k, "n": self.n,
+                "min": self.min if self.n else None,
+                "max": self.max if self.n else None,
+                "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d["k"])
+        sketch.n = d["n"]
+        sketch.compactors = [list(c) for c in d["compactors"]]
+        if sketch.n:
+            sketch.min = d["min"]
+            sketch.max = d["max"]
+        return sketch
+
+
+class ScoreStats(object):
+    '''
+    Statistics of the scores of a classify run:
+    quantile sketch and fixed-bin histogram of the scored lines,
+    counters of lines discarded by reason
+    and the mean score of every window of lines, unless window is None
+    '''
+
+    def __init__(self, bins=100, window=100000, k=200):
+        self.sketch = KLLSketch(k)
+        self.bins = bins
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.reasons = Counter()
+        self.lines = 0
+        self.scored = 0
+        self.window = window
+        self.windows = []
+        self.window_lines = 0
+        self.window_scored = 0
+        self.window_sum = 0.0
+
+    @classmethod
+    def from_args(cls, args):
+        '''Create the statistics of a classify run, None if --stats is not set'''
+        if getattr(args, "stats", None) is None:
+            return None
+        return cls(args.stats_bins, args.stats_window)
+
+    def update(self, values, reasons):
+        '''
+        Add a block of output lines, with the score of each line
+        and the list of discard reasons of the lines that were not scored
+        '''
+        scores = [v for v, r in zip(values, reasons) if r is None]
+        for r in reasons:
+            if r is not None:
+                self.reasons.update(r)
+
+        self.sketch.update(scores)
+        if scores:
+            # Scores outside [0, 1] go to the extreme bins
+            idx = np.clip((np.asarray(scores) * self.bins).astype(np.int64),
+                          0, self.bins - 1)
+            self.histogram += np.bincount(idx, minlength=self.bins)
+
+        # Rolling means, a block can close several windows
+        if self.window is not None:
+            for v, r in zip(values, reasons):
+                self.window_lines += 1
+                if r is None:
+                    self.window_scored += 1
+                    self.window_sum += v
+                if self.window_lines == self.window:
+                    self.close_window()
+        self.lines += len(values)
+        self.scored += len(scores)
+
+    def close_window(self):
+        if self.window_lines == 0:
+            return
+        mean = self.window_sum / self.window_scored if self.window_scored else None
+        self.windows.append({"lines": self.window_lines,
+                             "scored": self.window_scored,
+                             "mean": mean})
+        self.window_lines = 0
+        self.window_scored = 0
+        self.window_sum = 0.0
+
+    def merge(self, other):
+        '''Merge the statistics of the next shard'''
+        if self.bins != other.bins:
+            raise Exception(f"Cannot merge histograms of {self.bins} and {other.bins} bins")
+        self.close_window()
+        other.close_window()
+        self.sketch.merge(other.sketch)
+        self.histogram += other.histogram
+        self.reasons.update(other.reasons)
+        self.lines += other.lines
+        self.scored += other.scored
+        if self.window is not None:
+            self.windows.extend(other.windows)
+
+    def to_dict(self):
+        self.close_window()
+        return {
+            "lines": self.lines,
+            "scored": self.scored,
+            "discarded_by_reason": dict(self.reasons.most_common()),
+            "quantiles": dict(zip([str(q) for q in QUANTILES],
+                                  self.sketch.quantiles(QUANTILES))),
+            "histogram": {"bins": self.bins, "counts": self.histogram.tolist()},
+            "window": self.window,
+            "rolling_mean": self.windows,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d["histogram"]["bins"], d["window"], d["sketch"]["k"])
+        stats.sketch = KLLSketch.from_dict(d["sketch"])
+        stats.histogram = np.asarray(d["histogram"]["counts"], dtype=np.int64)
+        stats.reasons = Counter(d["discarded_by_reason"])
+        stats.lines = d["lines"]
+        stats.scored = d["scored"]
+        stats.windows = list(d["rolling_mean"])
+        return stats
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+    def report(self):
+        quantiles = self.sketch.quantiles(QUANTILES)
+        text = f"Scored {self.scored} of {self.lines} lines"
+        if self.scored:
+            text += ", quantiles: " + " ".join(f"p{int(q*100)}={v:.3f}"
+                                               for q, v in zip(QUANTILES, quantiles))
+        return text
+
+# Merge the statistics of several shards, in order
+def main():
+    try:
+        from .util import logging_setup
+    except (ImportError, SystemError):
+        from util import logging_setup
+
+    parser = argparse.ArgumentParser(description="Merge score statistics of classify shards")
+    parser.add_argument('inputs', nargs='+', help="Statistics JSON files written by classify --stats")
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Merged statistics")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    args = parser.parse_args()
+    logging_setup(args)
+
+    stats = ScoreStats.load(args.inputs[0])
+    for filename in args.inputs[1:]:
+        stats.merge(ScoreStats.load(filename))
+    json.dump(stats.to_dict(), args.output, indent=1)
+    logging.info(stats.report())
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 from sacremoses import MosesTokenizer, MosesDetokenizer
-from toolwrapper import ToolWrapper
-from subprocess import run, PIPE
+from subprocess import Popen, PIPE
+from threading import Thread
+from time import monotonic
 import logging
-import sys
 import os
 
 try:
@@ -11,11 +11,148 @@ except (SystemError, ImportError):
     from util import  no_escaping
 
 
+class TokenizerProcess:
+    '''
+    Long-lived external tokenizer process
+    Batches are streamed with a writer and a reader thread
+    so neither side blocks on a full pipe,
+    a process that does not answer in timeout seconds is killed
+    '''
+    def __init__(self, cmd, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.proc = None
+        self.output = None
+        self.threads = None
+        self.nlines = 0
+        self.start()
+
+    def start(self):
+        logging.debug(f'Opening subprocess: {self.cmd!r}')
+        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE,
+                          env=os.environ, encoding='utf-8')
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def _write(self, lines):
+        try:
+            for line in lines:
+                self.proc.stdin.write(line + '\n')
+            self.proc.stdin.flush()
+        except OSError as e:
+            logging.debug(f'Error writing to tokenizer: {e}')
+
+    def _read(self, nlines):
+        for _ in range(nlines):
+            line = self.proc.stdout.readline()
+            if not line:
+                break
+            self.output.append(line.rstrip('\n'))
+
+    def send(self, lines):
+        '''Start streaming a batch, call receive to obtain the output'''
+        # Embedded newlines would break the line count alignment
+        lines = [l.replace('\n', ' ') for l in lines]
+        self.nlines = len(lines)
+        self.output = []
+        self.threads = [Thread(target=self._write, args=(lines,), daemon=True),
+                        Thread(target=self._read, args=(self.nlines,), daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def receive(self):
+        '''Wait for the batch sent and return the tokenized lines'''
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        for t in self.threads:
+            t.join(None if deadline is None else max(0, deadline - monotonic()))
+        timed_out = any(t.is_alive() for t in self.threads)
+        if timed_out:
+            # Killing the process unblocks both threads
+            self.proc.kill()
+            for t in self.threads:
+                t.join()
+        self.threads = None
+        if timed_out:
+            raise RuntimeError(f"Tokenizer {self.cmd!r} did not answer in {self.timeout} seconds")
+        if len(self.output) != self.nlines:
+            raise RuntimeError(f"Tokenizer {self.cmd!r} returned {len(self.output)}"
+                               f" lines, expected {self.nlines}"
+                               f" (exit code {self.proc.poll()})")
+        return self.output
+
+
+class TokenizerPool:
+    '''
+    Pool of long-lived external tokenizer processes
+    Each batch is split in contiguous chunks, one per process,
+    processes that crash are restarted and their chunk retried
+    '''
+    def __init__(self, cmd, size=1, max_retries=3, timeout=None):
+        self.cmd = cmd
+        self.size = max(1, size)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.procs = []
+
+    def start(self):
+        if not self.procs:
+            self.procs = [TokenizerProcess(self.cmd, self.timeout) for _ in range(self.size)]
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def close(self):
+        for p in self.procs:
+            p.close()
+        self.procs = []
+
+    def tokenize_lines(self, lines):
+        '''Tokenize a list of lines returning a list of tokenized lines'''
+        self.start()
+        chunk_size = -(-len(lines) // len(self.procs)) or 1
+        chunks = [lines[i:i+chunk_size] for i in range(0, len(lines), chunk_size)]
+
+        for proc, chunk in zip(self.procs, chunks):
+            proc.send(chunk)
+
+        output = []
+        for proc, chunk in zip(self.procs, chunks):
+            output.extend(self._receive(proc, chunk))
+        return output
+
+    def _receive(self, proc, chunk):
+        for retry in range(self.max_retries + 1):
+            try:
+                return proc.receive()
+            except RuntimeError as e:
+                if retry == self.max_retries:
+                    raise
+                logging.warning(f"{e}, restarting tokenizer")
+                proc.restart()
+                proc.send(chunk)
+
+
 class Tokenizer:
-    def __init__(self, command=None,  l="en"):
+    def __init__(self, command=None,  l="en", processes=1, timeout=None):
         if command:
             self.cmd = command.split(' ')
-            self.tokenizer = ToolWrapper(self.cmd)
+            self.tokenizer = TokenizerPool(self.cmd, processes, timeout=timeout)
+            self.tokenizer.start()
             self.detokenizer = None
             self.external =  True
             self.spm = command.find('spm_encode') > -1
@@ -29,10 +166,11 @@ class Tokenizer:
     def tokenize(self, text):
         if self.external:
             if isinstance(text, list):
-                return self.tokenize_block('\n'.join(text) + '\n').split('\n')
+                lines = self.tokenizer.tokenize_lines([t.rstrip('\n') for t in text])
+                return [[no_escaping(t) for t in line.split()] for line in lines]
             else:
-                self.tokenizer.writeline(text.rstrip('\n'))
-                return ([no_escaping(t) for t in self.tokenizer.readline().rstrip('\n').split()])
+                line = self.tokenizer.tokenize_lines([text.rstrip('\n')])[0]
+                return [no_escaping(t) for t in line.split()]
         else:
             if isinstance(text, list):
                 return [self.tokenizer.tokenize(line, escape=False) for line in text]
@@ -61,14 +199,3 @@ class Tokenizer:
     def restart(self):
         if self.external:
             self.tokenizer.restart()
-
-    def tokenize_block(self, text):
-        logging.debug(f'Opening subprocess: {self.cmd!r}')
-        output = run(self.cmd, input=text, stdout=PIPE, stderr=PIPE, env=os.environ, encoding='utf-8')
-        if output.returncode != 0:
-            logging.error(output.stderr)
-            sys.exit(1)
-        else:
-            logging.debug(f'Succesfully subprocess: {self.cmd!r}')
-            logging.debug(f'Errors: {output.stderr}')
-            return output.stdout
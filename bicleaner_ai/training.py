@@ -3,6 +3,7 @@ from heapq import heappush, heappop
 from sklearn.metrics import f1_score, precision_score, recall_score, matthews_corrcoef
 from tempfile import TemporaryFile, NamedTemporaryFile
 from fuzzywuzzy import process, fuzz
+from timeit import default_timer
 import logging
 import os
 import random
@@ -10,8 +11,10 @@ import fasttext
 
 try:
     from .tokenizer import Tokenizer
+    from .affinity import partition, pin, format_cpulist
 except (SystemError, ImportError):
     from tokenizer import Tokenizer
+    from affinity import partition, pin, format_cpulist
 
 # Porn removal classifier
 # training, compressing, run tests and save model file
@@ -42,7 +45,8 @@ def train_porn_removal(args):
     model.save_model(args.porn_removal_file)
 
 # Generate negative and positive samples for a sentence pair
-def sentence_noise(i, src, trg, args):
+# trg_toks are the tokens of trg[i], only needed for word level noise
+def sentence_noise(i, src, trg, args, tokenizer=None, trg_toks=None):
     size = len(src)
     sts = []
     src_strip = src[i].strip()
@@ -57,18 +61,14 @@ def sentence_noise(i, src, trg, args):
         sts.append(src[random.randrange(1,size)].strip() + "\t" + trg_strip + "\t0")
 
     # Frequence based noise
-    tokenizer = Tokenizer(args.target_tokenizer_command, args.target_lang)
     for j in range(args.freq_ratio):
-        t_toks = tokenizer.tokenize(trg[i])
-        replaced = replace_freq_words(t_toks, args.tl_word_freqs)
+        replaced = replace_freq_words(list(trg_toks), args.tl_word_freqs)
         if replaced is not None:
             sts.append(src_strip + "\t" + tokenizer.detokenize(replaced) + "\t0")
 
     # Randomly omit words
-    tokenizer = Tokenizer(args.target_tokenizer_command, args.target_lang)
     for j in range(args.womit_ratio):
-        t_toks = tokenizer.tokenize(trg[i])
-        omitted = omit_words(t_toks)
+        omitted = omit_words(list(trg_toks))
         if omitted != []:
             sts.append(src_strip + "\t" + tokenizer.detokenize(omitted) + "\t0")
 
@@ -90,19 +90,33 @@ def sentence_noise(i, src, trg, args):
     return sts
 
 # Take block number from the queue and generate noise for that block
-def worker_process(num, src, trg, jobs_queue, output_queue, args):
+def worker_process(num, src, trg, jobs_queue, output_queue, args, cpus=None):
+    if cpus is not None:
+        pin(cpus)
     nlines = len(src)
+    # Keep a single tokenizer (and its external processes) per worker
+    tokenizer = Tokenizer(args.target_tokenizer_command, args.target_lang,
+                          args.tokenizer_processes, args.tokenizer_timeout)
+    word_noise = args.freq_ratio > 0 or args.womit_ratio > 0
 
     while True:
         job = jobs_queue.get()
 
         if job is not None:
             logging.debug("Job {0}".format(job.__repr__()))
+            end = min(job+args.block_size, nlines)
+
+            # Tokenize the whole block at once
+            if word_noise:
+                block_toks = tokenizer.tokenize([trg[i] for i in range(job, end)])
+            else:
+                block_toks = [None] * (end - job)
 
             # Generate noise for each sentence in the block
             output = []
-            for i in range(job, min(job+args.block_size, nlines)):
-                output.extend(sentence_noise(i, src, trg, args))
+            for i in range(job, end):
+                output.extend(sentence_noise(i, src, trg, args,
+                                             tokenizer, block_toks[i-job]))
 
             output_file = NamedTemporaryFile('w+', delete=False)
             for j in output:
@@ -111,6 +125,7 @@ def worker_process(num, src, trg, jobs_queue, output_queue, args):
             output_queue.put((job,output_file.name))
         else:
             logging.debug(f"Exiting worker {num}")
+            tokenizer.close()
             break
 
 # Merges all the temporary files from the workers
@@ -167,6 +182,7 @@ def build_noise(input, args):
     size = len(src)
 
     logging.debug("Running {0} workers at {1} rows per block".format(args.processes, args.block_size))
+    time_start = default_timer()
     process_count = max(1, args.processes)
     maxsize = 1000 * process_count
     output_queue = Queue(maxsize = maxsize)
@@ -180,10 +196,15 @@ def build_noise(input, args):
 
     # Start workers
     jobs_queue = Queue(maxsize = maxsize)
+    cpu_sets = [None] * worker_count
+    placement = "unpinned"
+    if getattr(args, "pin_workers", False):
+        cpu_sets = partition(worker_count)
+        placement = "pinned to " + ", ".join(format_cpulist(c) for c in cpu_sets)
     workers = []
     for i in range(worker_count):
         worker = Process(target = worker_process,
-                         args   = (i, src, trg, jobs_queue, output_queue, args))
+                         args   = (i, src, trg, jobs_queue, output_queue, args, cpu_sets[i]))
         worker.daemon = True # dies with the parent process
         worker.start()
         workers.append(worker)
@@ -203,6 +224,10 @@ def build_noise(input, args):
     output_queue.put(None)
     reduce.join()
 
+    elapsed_time = default_timer() - time_start
+    logging.info(f"Noise generation: {int(size / elapsed_time)} rows/s"
+                 f" with {worker_count} workers {placement}")
+
     return output_file.name
 
 # Randomly replace words with other words of same frequency
@@ -10,13 +10,17 @@ from os import path
 import typing
 import random
 
-from tempfile import TemporaryFile
+from tempfile import NamedTemporaryFile
 from toolwrapper import ToolWrapper
+import numpy as np
+import shutil
 
 try:
     from .models import DecomposableAttention, Transformer, BCXLMRoberta
+    from .lineindex import LineIndex
 except (SystemError, ImportError):
     from models import DecomposableAttention, Transformer, BCXLMRoberta
+    from lineindex import LineIndex
 
 # variables used by the no_escaping function
 replacements = {"&amp;":  "&",
@@ -114,18 +118,35 @@ def logging_setup(args = None):
         import tensorflow as tf
         tf.get_logger().setLevel('ERROR')
 
+# Shuffle lines of a file using its line index
+# input that is not a regular file is copied to a temporary file first
 def shuffle_file(input: typing.TextIO, output: typing.TextIO):
-    offsets=[]
-    with TemporaryFile("w+") as temp:
-        count = 0
-        for line in input:
-            offsets.append(count)
-            count += len(bytearray(line, "UTF-8"))
-            temp.write(line)
-        temp.flush()
-        
-        random.shuffle(offsets)
-        
-        for offset in offsets:
-            temp.seek(offset)
-            output.write(temp.readline())
+    name = getattr(input, "name", None)
+    if isinstance(name, str) and path.isfile(name):
+        shuffle_indexed(name, LineIndex.open(name), output)
+    else:
+        with NamedTemporaryFile("w+") as temp:
+            shutil.copyfileobj(input, temp)
+            temp.flush()
+            shuffle_indexed(temp.name, LineIndex.build(temp.name, save=False), output)
+
+def shuffle_indexed(filename, index, output):
+    with open(filename, 'rb') as f:
+        for i in np.random.permutation(len(index)):
+            line = index.read_lines(f, i)[0].decode("utf-8")
+            # Last line may not have a newline
+            output.write(line if line.endswith('\n') else line + '\n')
+
+# Uniform sample of n lines of a file without reading the rest, using its line index
+# all the lines if the file has n lines or less or is not a regular file
+def sample_file_lines(input: typing.TextIO, n: int):
+    name = getattr(input, "name", None)
+    index = None
+    if isinstance(name, str) and path.isfile(name):
+        index = LineIndex.open(name)
+    if index is None or len(index) <= n:
+        yield from input
+        return
+    with open(name, 'rb') as f:
+        for i in sorted(random.sample(range(len(index)), n)):
+            yield index.read_lines(f, i)[0].decode("utf-8")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+Memory-mapped model weights
+
+Weights are exported as raw arrays aligned to 64 bytes in a single
+file (<prefix>.bin) described by a YAML index (<prefix>.yaml).
+Loading maps the file read-only, so the page cache is shared by all
+the processes that load the same pack.
+
+TensorFlow variables own their buffers, so assigned weights are copied
+into process memory. Embedding tables, that hold most of the parameters,
+are instead bound as constant tensors that point to the mapped pages.
+'''
+import tensorflow as tf
+import numpy as np
+import argparse
+import logging
+import psutil
+import yaml
+import sys
+import os
+import re
+
+ALIGNMENT = 64
+
+# Resident set size of the current process in MiB
+def rss_mib():
+    return psutil.Process().memory_info().rss / 2**20
+
+# Write a list of (name, array) into an aligned binary file and its index
+def save_mmap_weights(weights, directory, prefix="weights"):
+    index = []
+    offset = 0
+    with open(os.path.join(directory, prefix + ".bin"), 'wb') as data:
+        for name, array in weights:
+            array = np.ascontiguousarray(array)
+            padding = -offset % ALIGNMENT
+            data.write(b'\0' * padding)
+            offset += padding
+            data.write(array.tobytes())
+            index.append({
+                "name": name,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            })
+            offset += array.nbytes
+
+    with open(os.path.join(directory, prefix + ".yaml"), 'w') as index_file:
+        yaml.safe_dump({"alignment": ALIGNMENT, "weights": index}, index_file)
+
+# Map the arrays of an exported weights file, read-only
+# returns a list of (name, array)
+def open_mmap_weights(directory, prefix="weights"):
+    with open(os.path.join(directory, prefix + ".yaml")) as index_file:
+        index = yaml.safe_load(index_file)["weights"]
+    data = np.memmap(os.path.join(directory, prefix + ".bin"),
+                     dtype=np.uint8, mode='r')
+    weights = []
+    for w in index:
+        dtype = np.dtype(w["dtype"])
+        size = int(np.prod(w["shape"], dtype=np.int64)) * dtype.itemsize
+        array = data[w["offset"]:w["offset"]+size].view(dtype).reshape(w["shape"])
+        weights.append((w["name"], array))
+    return weights
+
+def mmap_weights_exist(directory, prefix="weights"):
+    return os.path.isfile(os.path.join(directory, prefix + ".yaml")) \
+            and os.path.isfile(os.path.join(directory, prefix + ".bin"))
+
+def export_mmap_weights(model, directory, prefix="weights"):
+    '''Export the weights of a Keras model'''
+    save_mmap_weights([(w.name, w.numpy()) for w in model.weights],
+                      directory, prefix)
+
+# Embedding layers and the attribute holding their table
+def _embedding_tables(model):
+    for layer in model.submodules:
+        for attr in ("embeddings", "weight"):
+            value = layer.__dict__.get(attr)
+            if isinstance(value, tf.Variable):
+                yield layer, attr, value
+
+def _bind_constant(layer, attr, variable, array):
+    '''
+    Replace a layer variable by a constant tensor pointing to the mapped array
+    Aligned numpy arrays are not copied when converted to tensors
+    '''
+    for weights in (layer._trainable_weights, layer._non_trainable_weights):
+        for i, w in enumerate(weights):
+            if w is variable:
+                del weights[i]
+                break
+    object.__setattr__(layer, attr, tf.convert_to_tensor(array))
+
+# Weight name without the output index and the counters Keras appends
+# to make layer names unique in the process, that change between builds
+def _weight_name(name):
+    name = name.split(':')[0]
+    return [re.sub(r'(?<!_\.)_\d+$', '', part) for part in name.split('/')]
+
+# Names match if one is the other with a scope prefix
+def weight_names_match(a, b):
+    a, b = _weight_name(a), _weight_name(b)
+    n = min(len(a), len(b))
+    return a[len(a)-n:] == b[len(b)-n:]
+
+def load_mmap_weights(model, directory, prefix="weights", share=True):
+    '''
+    Load exported weights into a built Keras model
+    If share is enabled, embedding tables are bound to the mapped file
+    '''
+    arrays = open_mmap_weights(directory, prefix)
+    variables = model.weights
+    if len(arrays) != len(variables):
+        raise Exception(f"Model has {len(variables)} weights,"
+                        f" {prefix}.bin has {len(arrays)}")
+    for v, (name, a) in zip(variables, arrays):
+        if not weight_names_match(v.name, name):
+            raise Exception(f"Weight {v.name} of the model does not match"
+                            f" weight {name} of {prefix}.bin")
+        if tuple(v.shape) != a.shape:
+            raise Exception(f"Shape mismatch for weight {name}:"
+                            f" {tuple(v.shape)} != {a.shape}")
+
+    by_variable = {id(v): a for v, (_, a) in zip(variables, arrays)}
+    shared = []
+    if share:
+        shared = [t for t in _embedding_tables(model) if id(t[2]) in by_variable]
+    shared_ids = set(id(t[2]) for t in shared)
+
+    for v, (_, a) in zip(variables, arrays):
+        if id(v) not in shared_ids:
+            v.assign(a)
+    for layer, attr, variable in shared:
+        _bind_constant(layer, attr, variable, by_variable[id(variable)])
+    if shared:
+        logging.debug(f"Bound {len(shared)} embedding tables to {prefix}.bin")
+
+# Set mmap_weights in the classifier settings of a metadata file
+# the rest of the lines are kept as training.write_metadata wrote them
+def set_metadata_mmap_weights(filename, prefix):
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    try:
+        start = lines.index("classifier_settings:") + 1
+    except ValueError:
+        raise Exception(f"No classifier_settings in {filename}")
+    end = start
+    while end < len(lines) and lines[end].startswith(" "):
+        end += 1
+    block = lines[start:end]
+    indent = re.match(r' *', block[0]).group() if block else "    "
+
+    def key(line):
+        if not line.startswith(indent) or line[len(indent):len(indent)+1] in ("", " ") \
+                or ':' not in line:
+            return None
+        return line.split(':')[0].strip()
+
+    # Remove the current value and insert the new one keeping the keys sorted
+    block = [l for l in block if key(l) != "mmap_weights"]
+    pos = next((i for i, l in enumerate(block)
+                    if key(l) is not None and key(l) > "mmap_weights"), len(block))
+    block.insert(pos, f"{indent}mmap_weights: {prefix}")
+    lines[start:end] = block
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+# Export the weights of a model pack and enable them in its metadata
+def main():
+    try:
+        from .util import get_model, logging_setup
+        from .models import BaseModel
+    except (ImportError, SystemError):
+        from util import get_model, logging_setup
+        from models import BaseModel
+
+    parser = argparse.ArgumentParser(description="Export model pack weights to a memory-mappable format")
+    parser.add_argument('metadata', help="Model pack metadata (YAML file)")
+    parser.add_argument('--prefix', default="weights", help="File prefix of the exported weights")
+    parser.add_argument('-q', '--quiet', action='store_true', help='Silent logging mode')
+    parser.add_argument('--debug', action='store_true', help='Debug logging mode')
+    parser.add_argument('--logfile', type=argparse.FileType('a'), default=sys.stderr, help="Store log to a file")
+    args = parser.parse_args()
+    logging_setup(args)
+
+    with open(args.metadata) as f:
+        metadata = yaml.safe_load(f)
+    directory = os.path.dirname(os.path.abspath(args.metadata))
+    settings = metadata["classifier_settings"]
+    settings.pop("mmap_weights", None)
+    clf = get_model(metadata["classifier_type"])(directory, settings)
+    clf.load()
+
+    logging.info(f"Exporting weights to {directory}/{args.prefix}.bin")
+    export_mmap_weights(clf.model, directory, args.prefix)
+    # Embeddings are only present in the model dir of trained SentencePiece packs
+    if isinstance(clf, BaseModel) and "wv_file" in clf.settings \
+            and os.path.isfile(os.path.join(directory, clf.settings["wv_file"])):
+        clf.load_embed()
+        save_mmap_weights([("word_vectors", clf.wv)], directory, "glove")
+        logging.info(f"Exported GloVe vectors to {directory}/glove.bin")
+
+    # Measure load of both formats in this process
+    # the second load benefits from the warm page cache
+    for prefix in (None, args.prefix):
+        settings["mmap_weights"] = prefix
+        clf = get_model(metadata["classifier_type"])(directory, settings)
+        clf.load()
+
+    set_metadata_mmap_weights(args.metadata, args.prefix)
+
+if __name__ == '__main__':
+    main()
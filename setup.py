@@ -38,6 +38,7 @@ setuptools.setup(
         "Paracrawl": "https://paracrawl.eu/"
     },
     scripts=[
+         "scripts/bicleaner-ai-align",
          "scripts/bicleaner-ai-classify",
          "scripts/bicleaner-ai-train",
      ]
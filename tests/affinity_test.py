@@ -0,0 +1,43 @@
+import argparse
+import pytest
+
+from bicleaner_ai.affinity import parse_cpulist, cpulist, format_cpulist, split, apportion, partition
+
+NODES = {0: list(range(0, 8)), 1: list(range(8, 16))}
+
+def test_cpulist():
+    assert parse_cpulist("0-3,8,10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpulist([11, 0, 1, 2, 3, 8, 10]) == "0-3,8,10-11"
+    with pytest.raises(argparse.ArgumentTypeError):
+        cpulist(",")
+
+def test_split():
+    assert split(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    # More parts than items share them
+    assert split([0, 1], 3) == [[0], [1], [0]]
+
+def test_apportion():
+    assert apportion(4, [8, 8]) == [2, 2]
+    assert apportion(4, [12, 4]) == [3, 1]
+    assert apportion(2, [12, 4]) == [1, 1]
+
+def test_partition_within_nodes():
+    parts = partition(4, cpus=list(range(16)), nodes=NODES)
+    assert parts == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12, 13, 14, 15]]
+    # Odd number of workers, none spans two nodes
+    for part in partition(3, cpus=list(range(16)), nodes=NODES):
+        assert set(part) <= set(NODES[0]) or set(part) <= set(NODES[1])
+
+def test_partition_fewer_workers_than_nodes():
+    assert partition(1, cpus=list(range(16)), nodes=NODES) == [list(range(16))]
+
+def test_partition_allowed_cpus():
+    # Only the allowed CPUs are used, CPUs missing from the nodes make their own group
+    parts = partition(3, cpus=[2, 3, 9, 10, 20], nodes=NODES)
+    assert parts == [[2, 3], [9, 10], [20]]
+
+def test_partition_more_workers_than_cpus():
+    parts = partition(6, cpus=[0, 1, 8, 9], nodes=NODES)
+    assert len(parts) == 6
+    assert all(len(p) == 1 for p in parts)
+    assert sorted(set(c for p in parts for c in p)) == [0, 1, 8, 9]
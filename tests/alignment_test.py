@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from bicleaner_ai.alignment import top_k, BandedAligner
+
+class SameWordsClassifier(object):
+    '''Scores 0.9 the pairs with the same words and 0.1 the rest'''
+
+    def __init__(self):
+        self.pairs = 0
+
+    def predict(self, x1, x2, batch_size=None, calibrated=False):
+        self.pairs += len(x1)
+        return np.array([[0.9 if a.split() == b.upper().split() else 0.1]
+                            for a, b in zip(x1, x2)], dtype=np.float32)
+
+def test_top_k():
+    matrix = np.array([[0.1, 0.9, 0.5, 0.7],
+                       [0.3, 0.2, 0.8, 0.0]], dtype=np.float32)
+    best = top_k(matrix, 2)
+    assert [[j for j, _ in row] for row in best] == [[1, 3], [2, 0]]
+    assert best[0][0][1] == pytest.approx(0.9)
+
+def test_top_k_larger_than_columns():
+    matrix = np.random.default_rng(1).random((5, 3))
+    for row, scores in zip(top_k(matrix, 10), matrix):
+        assert [j for j, _ in row] == np.argsort(-scores).tolist()
+
+def test_top_k_empty():
+    assert top_k(np.zeros((2, 0)), 3) == [[], []]
+
+def test_aligner_one_to_one():
+    src = ["A", "B", "C", "D"]
+    trg = ["a", "x", "b", "c", "d"]
+    aligner = BandedAligner(SameWordsClassifier(), band=2)
+    alignments = aligner.align(src, trg)
+    assert [(i, j) for i, j, _ in alignments] == [([0], [0]), ([1], [2]), ([2], [3]), ([3], [4])]
+    assert all(score == pytest.approx(0.9) for _, _, score in alignments)
+
+def test_aligner_many_to_one():
+    src = ["A B", "C", "D E"]
+    trg = ["a", "b", "c", "d e"]
+    alignments = BandedAligner(SameWordsClassifier(), band=2, many_to_one=True).align(src, trg)
+    assert [(i, j) for i, j, _ in alignments] == [([0], [0, 1]), ([1], [2]), ([2], [3])]
+    # Without 1-2 alignments the first sentence is not aligned
+    alignments = BandedAligner(SameWordsClassifier(), band=2).align(src, trg)
+    assert [(i, j) for i, j, _ in alignments] == [([1], [2]), ([2], [3])]
+
+def test_aligner_band():
+    clf = SameWordsClassifier()
+    n = 200
+    src = [f"S{i}" for i in range(n)]
+    trg = [f"s{i}" for i in range(n)]
+    alignments = BandedAligner(clf, band=3, block_size=100).align(src, trg)
+    assert [(i, j) for i, j, _ in alignments] == [([k], [k]) for k in range(n)]
+    # Only pairs near the diagonal are scored
+    assert clf.pairs < n * 10
+
+def test_aligner_empty():
+    assert BandedAligner(SameWordsClassifier()).align([], ["a"]) == []
@@ -0,0 +1,49 @@
+from argparse import Namespace
+import numpy as np
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("hardrules")
+pytest.importorskip("tensorflow")
+
+from bicleaner_ai.arrow_io import classify_arrow, classify_block
+
+class FakeClassifier(object):
+    '''Scores pairs by source length and records what it was given'''
+    settings = {"n_classes": 2}
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, src, trg, batch_size, calibrated, raw_output):
+        self.calls.append((src, trg))
+        ncols = 2 if raw_output else 1
+        return np.array([[len(s) / 10] * ncols for s in src], dtype=np.float32)
+
+def block_args(raw_output):
+    return Namespace(raw_output=raw_output, disable_hardrules=True,
+                     clf=FakeClassifier(), batch_size=32, calibrated=False,
+                     early_exit_threshold=None)
+
+BLOCK = pa.RecordBatch.from_arrays(
+            [pa.array(["hello", None, " ", "world "]),
+             pa.array(["hallo", "welt", None, None])],
+            names=["src", "trg"])
+
+def test_null_cells_discarded():
+    args = block_args(raw_output=False)
+    columns = classify_block(args, None, BLOCK, 0, 1)
+    assert args.clf.calls == [(["hello"], ["hallo"])]
+    assert columns["bicleaner_ai_score"].to_pylist() == pytest.approx([0.5, 0, 0, 0])
+
+def test_null_cells_raw_output():
+    args = block_args(raw_output=True)
+    columns = classify_block(args, None, BLOCK, 0, 1)
+    # Every row is scored, null cells as empty sentences
+    assert args.clf.calls == [(["hello", "", "", "world"], ["hallo", "welt", "", ""])]
+    assert set(columns) == {"bicleaner_ai_score", "bicleaner_ai_score_1"}
+
+def test_routing_not_supported():
+    args = Namespace(kept_tus="kept.tsv", discarded_tus=None, discarded_reasons_dir=None, paired_output=None)
+    with pytest.raises(Exception, match="columnar"):
+        classify_arrow(args)
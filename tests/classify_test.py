@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("hardrules")
+pytest.importorskip("fasttext")
+pytest.importorskip("tensorflow")
+
+from bicleaner_ai.classify import strip_line
+
+@pytest.mark.parametrize("line", [
+    "source\ttarget\n",
+    "  source\ttarget \r\n",
+    "source\ttarget\t\n",
+    "\x1csource\ttarget \n",
+    " source\ttarget 　\n",
+    "source\ttargét\n",
+    "\n",
+])
+def test_strip_line(line):
+    assert strip_line(line.encode("utf-8")) == line.strip().encode("utf-8")
+
+def test_strip_line_invalid_utf8():
+    assert strip_line(b" source\ttarget\xff \n") == b"source\ttarget\xff"
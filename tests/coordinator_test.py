@@ -0,0 +1,96 @@
+from argparse import Namespace
+import threading
+import io
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from bicleaner_ai.coordinator import Coordinator, newline_ranges, start_server, run_worker
+
+LINES = [f"source {i}\ttarget {i}\n".encode() for i in range(100)]
+
+@pytest.fixture
+def corpus(tmp_path):
+    filename = str(tmp_path / "corpus.tsv")
+    with open(filename, 'wb') as f:
+        f.write(b"src\ttrg\n" + b"".join(LINES))
+    return filename
+
+def test_newline_ranges(corpus):
+    with open(corpus, 'rb') as f:
+        data = f.read()
+    ranges = newline_ranges(corpus, 100, start=8)
+    assert ranges[0][0] == 8
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert data[end-1:end] == b"\n"
+
+def test_output_in_order(corpus):
+    output = io.BytesIO()
+    coordinator = Coordinator(corpus, output, chunk_bytes=300, header=True)
+    assert coordinator.input_header == b"src\ttrg\n"
+    ids = []
+    while True:
+        i = coordinator.assign()
+        if i is None or i < 0:
+            break
+        ids.append(i)
+    assert len(ids) == len(coordinator.ranges) > 2
+
+    # Complete in reverse order, nothing is written until the first range
+    for i in reversed(ids):
+        assert output.getvalue() == b""
+        coordinator.complete(i, b"header\n", coordinator.read_range(i).upper())
+    assert coordinator.done.is_set()
+    assert output.getvalue() == b"header\n" + b"".join(LINES).upper()
+    assert coordinator.lines == len(LINES)
+
+def test_release_and_steal(corpus):
+    output = io.BytesIO()
+    coordinator = Coordinator(corpus, output, chunk_bytes=10000, steal_after=0.0, max_attempts=2)
+    assert len(coordinator.ranges) == 1
+    assert coordinator.assign() == 0
+    # A failed worker queues the range again
+    coordinator.release(0)
+    assert coordinator.assign() == 0
+    # Running for longer than steal_after, an idle worker gets a copy
+    assert coordinator.assign() == 0
+    assert coordinator.assign() == -1
+    coordinator.complete(0, b"", b"first\n")
+    # Output of the copy that finishes later is ignored
+    coordinator.complete(0, b"", b"second\n")
+    assert output.getvalue() == b"first\n"
+    assert coordinator.assign() is None
+
+def test_max_attempts(corpus):
+    coordinator = Coordinator(corpus, io.BytesIO(), chunk_bytes=10000, max_attempts=1)
+    assert coordinator.assign() == 0
+    coordinator.release(0)
+    assert coordinator.assign() is None
+    assert coordinator.error is not None
+
+def test_workers(corpus, tmp_path):
+    output = io.BytesIO()
+    coordinator = Coordinator(corpus, output, chunk_bytes=200, header=True)
+    server = start_server(coordinator, "unix:" + str(tmp_path / "coordinator.sock"))
+
+    def classify(args, input, output):
+        lines = input.read().splitlines(keepends=True)
+        output.writelines(line.rstrip(b"\n") + b"\tscore\n" for line in lines)
+        return len(lines) - 1
+
+    args = Namespace(coordinator=server.address, header=True)
+    counts = []
+    workers = [threading.Thread(target=lambda: counts.append(run_worker(args, classify)))
+                for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(timeout=60)
+    server.shutdown()
+
+    assert coordinator.done.is_set() and coordinator.error is None
+    assert sum(counts) == len(LINES)
+    expected = b"src\ttrg\tscore\n" + b"".join(l.rstrip(b"\n") + b"\tscore\n" for l in LINES)
+    assert output.getvalue() == expected
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("sentencepiece")
+
+from bicleaner_ai.datagen import EncodingCache, SentenceEncoder, IdBuffers, pad_ids
+from bicleaner_ai.datagen import TupleSentenceGenerator, ConcatSentenceGenerator
+from bicleaner_ai.encoded import encoded_dataset
+
+class WordLengthEncoder(SentenceEncoder):
+    '''Encodes each word as its length and records the sentences it encodes'''
+
+    def __init__(self, cache_bytes):
+        self.cache = EncodingCache(cache_bytes)
+        self.calls = []
+
+    def spm_encode(self, data, out_type=int):
+        self.calls.append(list(data))
+        return [[len(w) for w in s.split()] for s in data]
+
+    def fingerprint(self):
+        return "word-length"
+
+def test_cache_lru_eviction():
+    ids = np.arange(4, dtype=np.int32)
+    cache = EncodingCache(0)
+    size = cache.entry_size("aa", ids)
+    cache.resize(2 * size)
+    cache.put("aa", ids)
+    cache.put("bb", ids)
+    assert cache.get("aa") is ids
+    # "bb" is the least recently used
+    cache.put("cc", ids)
+    assert cache.get("bb") is None
+    assert len(cache) == 2
+    assert cache.nbytes <= cache.max_bytes
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_cache_entry_larger_than_cap():
+    cache = EncodingCache(10)
+    cache.put("sentence", np.arange(100, dtype=np.int32))
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+def test_cache_resize():
+    cache = EncodingCache(2**20)
+    for i in range(10):
+        cache.put(f"sentence {i}", np.arange(i, dtype=np.int32))
+    cache.resize(cache.nbytes // 2)
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.get("sentence 9") is not None
+    assert cache.get("sentence 0") is None
+
+def test_encode_cached():
+    encoder = WordLengthEncoder(2**20)
+    first = encoder.encode(["a bb", "ccc", "a bb"])
+    # Repeated sentences are encoded once
+    assert encoder.calls == [["a bb", "ccc"]]
+    assert [x.tolist() for x in first] == [[1, 2], [3], [1, 2]]
+    assert all(x.dtype == np.int32 for x in first)
+
+    second = encoder.encode(["ccc", "dddd"])
+    assert encoder.calls[-1] == ["dddd"]
+    assert [x.tolist() for x in second] == [[3], [4]]
+    assert encoder.cache.hits == 1
+
+def reference_pad(ids, maxlen):
+    out = np.zeros((len(ids), maxlen), dtype=np.int32)
+    for i, seq in enumerate(ids):
+        seq = list(seq)[:maxlen]
+        out[i, :len(seq)] = seq
+    return out
+
+@pytest.mark.parametrize("as_array", [False, True])
+def test_pad_ids(as_array):
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        maxlen = int(rng.integers(1, 20))
+        ids = [rng.integers(1, 1000, int(rng.integers(0, 30))).tolist()
+                for _ in range(int(rng.integers(1, 10)))]
+        if as_array:
+            ids = [np.array(x, dtype=np.int32) for x in ids]
+        padded = pad_ids(ids, maxlen)
+        assert padded.dtype == np.int32
+        np.testing.assert_array_equal(padded, reference_pad(ids, maxlen))
+
+def test_pad_ids_empty():
+    assert pad_ids([], 5).shape == (0, 5)
+    np.testing.assert_array_equal(pad_ids([[], []], 3), np.zeros((2, 3)))
+
+def test_pad_ids_reused_buffer():
+    out = np.full((2, 4), 7, dtype=np.int32)
+    # Previous contents are cleared
+    assert pad_ids([[1, 2], [3]], 4, out) is out
+    np.testing.assert_array_equal(out, [[1, 2, 0, 0], [3, 0, 0, 0]])
+
+def test_id_buffers():
+    buffers = IdBuffers()
+    big = buffers.get("x", 8, 5)
+    assert big.shape == (8, 5) and big.dtype == np.int32
+    # Smaller batches are views of the same buffer
+    small = buffers.get("x", 3, 5)
+    assert small.shape == (3, 5)
+    assert np.shares_memory(small, big)
+    # Other inputs and lengths have their own buffer
+    assert not np.shares_memory(buffers.get("y", 3, 5), big)
+    assert buffers.get("x", 3, 6).shape == (3, 6)
+    # Larger batches grow it
+    assert not np.shares_memory(buffers.get("x", 9, 5), big)
+
+@pytest.mark.parametrize("generator_type", [TupleSentenceGenerator, ConcatSentenceGenerator])
+def test_encoded_dataset_batches(generator_type, tmp_path):
+    filename = str(tmp_path / "train.tsv")
+    with open(filename, 'w') as f:
+        for i in range(30):
+            f.write(f"{'a ' * (i % 7)}bbb\t{'cc ' * (i % 5)}d\t{i % 2}\n")
+
+    def generator():
+        return generator_type(WordLengthEncoder(2**20), batch_size=8, maxlen=6, separator=" | ")
+
+    from_text = generator()
+    from_text.load(filename)
+    from_encoded = generator()
+    from_encoded.load(encoded_dataset(generator(), filename, str(tmp_path / "encoded")))
+    assert len(from_encoded) == len(from_text) == 4
+    for i in range(len(from_text)):
+        x_text, y_text = from_text[i]
+        x_encoded, y_encoded = from_encoded[i]
+        for a, b in zip(x_text, x_encoded):
+            np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_equal(y_text, y_encoded)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from bicleaner_ai import decomposable_attention
+
+SETTINGS = {
+    "maxlen": 12,
+    "n_hidden": 8,
+    "n_classes": 1,
+    "emb_dim": 6,
+    "vocab_size": 50,
+    "emb_trainable": False,
+    "self_attention": False,
+    "dropout": 0.2,
+    "entail_dir": "both",
+    "distilled": False,
+    "loss": "binary_crossentropy",
+    "batch_size": 4,
+}
+
+def random_ids(rows=16, seed=1):
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(1, SETTINGS["vocab_size"], (rows, SETTINGS["maxlen"]), dtype=np.int32)
+    lengths = rng.integers(1, SETTINGS["maxlen"] + 1, rows)
+    ids[np.arange(SETTINGS["maxlen"]) >= lengths[:, None]] = 0
+    return ids
+
+@pytest.mark.parametrize("emb_trainable", [False, True])
+@pytest.mark.parametrize("entail_dir", ["both", "left", "right"])
+def test_folded_model_matches(emb_trainable, entail_dir):
+    settings = {**SETTINGS, "emb_trainable": emb_trainable, "entail_dir": entail_dir}
+    model = decomposable_attention.build_model(None, settings, compile=False)
+    folded = decomposable_attention.build_inference_model(model, settings)
+
+    x = [random_ids(seed=1), random_ids(seed=2)]
+    expected = model.predict(x, verbose=0)
+    np.testing.assert_allclose(folded.predict(x, verbose=0), expected, atol=1e-5)
+
+def test_split_model_matches():
+    model = decomposable_attention.build_model(None, SETTINGS, compile=False)
+    embed, pair_model = decomposable_attention.split_model(model, SETTINGS)
+
+    x = [random_ids(seed=3), random_ids(seed=4)]
+    expected = model.predict(x, verbose=0)
+    pair = [embed.predict(x[0], verbose=0), embed.predict(x[1], verbose=0)]
+    np.testing.assert_allclose(pair_model.predict(pair, verbose=0), expected, atol=1e-5)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from bicleaner_ai.encoded import (
+        EncodedDataset,
+        encoded_dataset,
+        encoded_dataset_exists,
+        write_encoded_dataset)
+
+class Encoder(object):
+    enable_sampling = False
+
+class WordLengthGenerator(object):
+    '''Encodes each word as its length, in a stream per sentence'''
+
+    def __init__(self, maxlen, key="words"):
+        self.maxlen = maxlen
+        self.encoder = Encoder()
+        self.key = key
+
+    def encode_streams(self, text1, text2):
+        return {"text1": [[len(w) for w in s.split()] for s in text1],
+                "text2": [[len(w) for w in s.split()] for s in text2]}
+
+    def encoding_key(self):
+        return {"encoder": self.key}
+
+def reference_batch(sentences, rows, maxlen):
+    out = np.zeros((len(rows), maxlen), dtype=np.int32)
+    for i, row in enumerate(rows):
+        ids = [len(w) for w in sentences[row].split()][:maxlen]
+        out[i, :len(ids)] = ids
+    return out
+
+@pytest.fixture
+def training_set(tmp_path):
+    rng = np.random.default_rng(1)
+    text1, text2, lines = [], [], []
+    for i in range(50):
+        words = ["x" * int(l) for l in rng.integers(1, 9, int(rng.integers(0, 12)))]
+        text1.append(" ".join(words))
+        text2.append(" ".join(reversed(words)))
+        lines.append(f"{text1[-1]}\t{text2[-1]}\t{i % 2}\t{i / 10}\n")
+    filename = str(tmp_path / "train.tsv")
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    return filename, text1, text2
+
+def test_encoded_batches(training_set, tmp_path):
+    filename, text1, text2 = training_set
+    directory = str(tmp_path / "encoded")
+    write_encoded_dataset(WordLengthGenerator(8), filename, directory, block_size=7)
+    assert encoded_dataset_exists(directory)
+
+    dataset = EncodedDataset(directory)
+    assert dataset.num_samples == 50
+    assert dataset.labels.tolist() == [i % 2 for i in range(50)]
+    np.testing.assert_allclose(dataset.weights, [i / 10 for i in range(50)])
+
+    rows = np.array([0, 49, 3, 3, 17])
+    for maxlen in (3, 8):
+        np.testing.assert_array_equal(dataset.batch("text1", rows, maxlen),
+                                      reference_batch(text1, rows, maxlen))
+        np.testing.assert_array_equal(dataset.batch("text2", rows, maxlen),
+                                      reference_batch(text2, rows, maxlen))
+
+def test_encoded_dataset_check(training_set, tmp_path):
+    filename, _, _ = training_set
+    directory = str(tmp_path / "encoded")
+    encoded_dataset(WordLengthGenerator(8), filename, directory)
+    # Reused without the source
+    assert encoded_dataset(WordLengthGenerator(4), None, directory).num_samples == 50
+    with pytest.raises(Exception, match="another vocabulary"):
+        encoded_dataset(WordLengthGenerator(8, key="other"), None, directory)
+    with pytest.raises(Exception, match="truncated"):
+        encoded_dataset(WordLengthGenerator(16), None, directory)
+
+def test_empty_sentences(tmp_path):
+    filename = str(tmp_path / "train.tsv")
+    with open(filename, 'w') as f:
+        f.write("\t\t1\n\t\t0\n")
+    directory = str(tmp_path / "encoded")
+    write_encoded_dataset(WordLengthGenerator(8), filename, directory)
+    dataset = EncodedDataset(directory)
+    assert dataset.weights is None
+    np.testing.assert_array_equal(dataset.batch("text1", np.array([0, 1]), 8), np.zeros((2, 8)))
+
+def test_sampling_rejected(training_set, tmp_path):
+    generator = WordLengthGenerator(8)
+    generator.encoder.enable_sampling = True
+    with pytest.raises(Exception):
+        write_encoded_dataset(generator, training_set[0], str(tmp_path / "encoded"))
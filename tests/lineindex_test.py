@@ -0,0 +1,81 @@
+import pytest
+
+from bicleaner_ai.lineindex import LineIndex, scan_offsets
+from bicleaner_ai.util import shuffle_file, sample_file_lines
+
+LINES = [b"first\tline\n", b"with\rcarriage\treturn\n", b"\n", b"form\x0cfeed \xe2\x80\xa8 separator\n", b"last"]
+
+@pytest.fixture
+def corpus(tmp_path):
+    filename = str(tmp_path / "corpus.tsv")
+    with open(filename, 'wb') as f:
+        f.write(b"".join(LINES))
+    return filename
+
+def test_offsets(corpus):
+    offsets = scan_offsets(corpus, chunk_bytes=7)
+    assert offsets.tolist() == [0, 11, 32, 33, 57]
+
+def test_read_lines_only_split_newlines(corpus):
+    index = LineIndex.build(corpus, save=False)
+    assert len(index) == len(LINES)
+    with open(corpus, 'rb') as f:
+        assert index.read_lines(f, 0, len(LINES)) == LINES
+        for i, line in enumerate(LINES):
+            assert index.read_lines(f, i) == [line]
+        assert index.read_lines(f, 1, 3) == LINES[1:3]
+
+def test_saved_index(corpus):
+    built = LineIndex.open(corpus)
+    loaded = LineIndex.load(corpus)
+    assert loaded is not None
+    assert loaded.offsets.tolist() == built.offsets.tolist()
+
+    # Changes in the file invalidate the index
+    with open(corpus, 'ab') as f:
+        f.write(b"\nmore")
+    assert LineIndex.load(corpus) is None
+    assert len(LineIndex.open(corpus)) == len(LINES) + 1
+
+def test_empty_file(tmp_path):
+    filename = str(tmp_path / "empty")
+    open(filename, 'wb').close()
+    assert len(LineIndex.open(filename)) == 0
+    assert len(LineIndex.load(filename)) == 0
+
+def test_ranges(corpus):
+    index = LineIndex.build(corpus, save=False)
+    ranges = index.ranges(20)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == index.size
+    for (_, end), (begin, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == begin
+        assert end in index.offsets.tolist()
+
+@pytest.fixture
+def text_corpus(tmp_path):
+    filename = str(tmp_path / "text.tsv")
+    with open(filename, 'w') as f:
+        f.write("".join(f"source {i}\ttarget {i}\n" for i in range(20)) + "last\tline")
+    return filename
+
+def test_shuffle_file(text_corpus, tmp_path):
+    output = str(tmp_path / "shuffled.tsv")
+    with open(text_corpus) as input, open(output, 'w') as out:
+        shuffle_file(input, out)
+    with open(text_corpus) as f:
+        lines = f.read().splitlines()
+    with open(output) as f:
+        shuffled = f.read().splitlines()
+    assert sorted(shuffled) == sorted(lines)
+
+def test_sample_file_lines(text_corpus):
+    with open(text_corpus) as f:
+        lines = f.readlines()
+    with open(text_corpus) as input:
+        sample = list(sample_file_lines(input, 5))
+    assert len(sample) == len(set(sample)) == 5
+    assert set(sample) <= set(lines)
+    # Small files are read whole
+    with open(text_corpus) as input:
+        assert list(sample_file_lines(input, 30)) == lines
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("transformers")
+pytest.importorskip("glove")
+
+from bicleaner_ai.models import DecomposableAttention, Transformer, BCXLMRoberta
+
+@pytest.mark.parametrize("model_type", [DecomposableAttention, Transformer, BCXLMRoberta])
+def test_common_attributes(model_type, tmp_path):
+    # Attributes used by train and classify for every model type
+    clf = model_type(str(tmp_path), {})
+    assert clf.callbacks == []
+    assert clf.predict_fn is None
+    assert clf.predict_model is None
+    assert clf.id_buffers is not None
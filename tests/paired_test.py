@@ -0,0 +1,49 @@
+import bz2
+import gzip
+import pytest
+
+from bicleaner_ai.paired import PairedReader, parallel_input
+
+def write(filename, text, opener=open):
+    with opener(filename, 'wb') as f:
+        f.write(text)
+    return str(filename)
+
+def test_paired_lines(tmp_path):
+    src = write(tmp_path / "corpus.en.gz", b"hello\nwith\ttab\r\n", gzip.open)
+    trg = write(tmp_path / "corpus.de.bz2", b"hallo\nmit tab", bz2.open)
+    reader = PairedReader(src, trg)
+    assert list(reader) == [b"hello\thallo\n", b"with tab\tmit tab\n"]
+    # Rewinding reads the files again
+    reader.seek(0)
+    assert len(list(reader)) == 2
+    with pytest.raises(Exception):
+        reader.seek(10)
+    reader.close()
+
+def test_paired_text(tmp_path):
+    src = write(tmp_path / "corpus.en", "café\n".encode("utf-8"))
+    trg = write(tmp_path / "corpus.fr", b"coffee\n")
+    reader = parallel_input([src, trg])
+    assert list(reader) == ["café\tcoffee\n"]
+    reader.close()
+
+@pytest.mark.parametrize("src_text,trg_text,shorter", [
+    (b"a\nb\nc\n", b"a\nb\n", "corpus.de"),
+    (b"a\n", b"a\nb\n", "corpus.en"),
+])
+def test_length_mismatch(tmp_path, src_text, trg_text, shorter):
+    src = write(tmp_path / "corpus.en", src_text)
+    trg = write(tmp_path / "corpus.de", trg_text)
+    reader = PairedReader(src, trg)
+    lines = []
+    with pytest.raises(Exception, match=f"{shorter} ends after line"):
+        for line in reader:
+            lines.append(line)
+    # Lines before the end of the shorter file are read
+    assert len(lines) == min(src_text.count(b"\n"), trg_text.count(b"\n"))
+    reader.close()
+
+def test_parallel_input_files(tmp_path):
+    with pytest.raises(Exception):
+        parallel_input(["a", "b", "c"])
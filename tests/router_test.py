@@ -0,0 +1,51 @@
+import gzip
+
+from bicleaner_ai.router import OutputRouter, hardrules_reasons
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_hardrules_reasons():
+    assert hardrules_reasons("c_no_alpha+c_identical") == ["c_no_alpha", "c_identical"]
+    assert hardrules_reasons(["a", "b"]) == ["a", "b"]
+    assert hardrules_reasons(True) == ["hardrules"]
+
+def test_route(tmp_path):
+    kept = str(tmp_path / "kept.tsv")
+    discarded = str(tmp_path / "discarded.tsv")
+    reasons_dir = str(tmp_path / "reasons")
+    router = OutputRouter(0.5, kept, discarded, reasons_dir)
+    router.write_header(b"src\ttrg\tscore\n")
+    router.route(b"a\tb\t0.9\n", 0.9)
+    router.route(b"c\td\t0.5\n", 0.5)
+    router.route(b"e\tf\t0.1\n", 0.1)
+    router.route(b"g\th\t0\n", 0, ["c_no_alpha", "wrong/lang"])
+    router.close()
+
+    assert read(kept) == b"src\ttrg\tscore\na\tb\t0.9\nc\td\t0.5\n"
+    assert read(discarded) == b"src\ttrg\tscore\ne\tf\t0.1\ng\th\t0\n"
+    # Reason files are opened when needed, with the header and safe names
+    assert read(str(tmp_path / "reasons" / "c_no_alpha.tsv")) == b"src\ttrg\tscore\ng\th\t0\n"
+    assert read(str(tmp_path / "reasons" / "wrong_lang.tsv")) == b"src\ttrg\tscore\ng\th\t0\n"
+
+def test_route_only_kept(tmp_path):
+    kept = str(tmp_path / "kept.tsv")
+    router = OutputRouter(0.5, kept=kept)
+    router.route(b"a\tb\t0.9\n", 0.9)
+    router.route(b"c\td\t0.1\n", 0.1)
+    router.route(b"e\tf\t0\n", 0, ["empty_sentence"])
+    router.close()
+    assert read(kept) == b"a\tb\t0.9\n"
+
+def test_route_kept_paired(tmp_path):
+    src, trg = str(tmp_path / "kept.en.gz"), str(tmp_path / "kept.de.gz")
+    router = OutputRouter(0.5, kept_paired=(src, trg), columns=(2, 3))
+    router.route(b"url\thello\thallo\t0.9\n", 0.9)
+    router.route(b"url\tbye\ttschuss\t0.2\n", 0.2)
+    router.close()
+
+    with gzip.open(src) as f:
+        assert f.read() == b"hello\n"
+    with gzip.open(trg) as f:
+        assert f.read() == b"hallo\n"
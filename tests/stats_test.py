@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from bicleaner_ai.stats import KLLSketch, ScoreStats, QUANTILES
+
+def rank_error(sketch, values):
+    '''Largest difference between the estimated and the true rank of QUANTILES'''
+    values = np.sort(values)
+    errors = []
+    for q, v in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+        errors.append(abs(np.searchsorted(values, v, side='right') / len(values) - q))
+    return max(errors)
+
+def test_sketch_small_is_exact():
+    sketch = KLLSketch(k=200, seed=1)
+    sketch.update(range(100))
+    assert sketch.n == 100
+    assert sketch.quantiles([0, 0.5, 1]) == [0.0, 49.0, 99.0]
+
+def test_sketch_empty():
+    sketch = KLLSketch()
+    assert sketch.quantiles([0.5]) == [None]
+
+def test_sketch_rank():
+    values = np.random.default_rng(1).random(100000)
+    sketch = KLLSketch(k=200, seed=1)
+    for i in range(0, len(values), 1000):
+        sketch.update(values[i:i+1000])
+    assert sketch.size() <= sketch.max_size()
+    assert sketch.size() < 2000
+    assert rank_error(sketch, values) < 0.02
+    assert sketch.quantiles([0, 1]) == [values.min(), values.max()]
+
+def test_sketch_merge():
+    rng = np.random.default_rng(2)
+    shards = [rng.normal(i, 1, 20000) for i in range(4)]
+    merged = KLLSketch(k=200, seed=1)
+    for i, shard in enumerate(shards):
+        sketch = KLLSketch(k=200, seed=i)
+        sketch.update(shard)
+        merged.merge(sketch)
+    values = np.concatenate(shards)
+    assert merged.n == len(values)
+    assert rank_error(merged, values) < 0.02
+
+def test_sketch_dict_roundtrip():
+    sketch = KLLSketch(k=50, seed=1)
+    sketch.update(np.random.default_rng(3).random(5000))
+    loaded = KLLSketch.from_dict(sketch.to_dict())
+    assert loaded.quantiles(QUANTILES) == sketch.quantiles(QUANTILES)
+
+VALUES = [0.1, 0.9, 0.5, 0.7]
+REASONS = [None, None, ["no_alpha"], None]
+
+def merge_shards(merged):
+    for i in range(0, 4, 2):
+        stats = ScoreStats(bins=10, window=2)
+        stats.update(VALUES[i:i+2], REASONS[i:i+2])
+        merged.merge(stats)
+    return merged.to_dict()
+
+def test_stats_merge_shards():
+    d = merge_shards(ScoreStats(bins=10, window=2))
+    assert d["lines"] == 4
+    assert d["scored"] == 3
+    assert d["discarded_by_reason"] == {"no_alpha": 1}
+    assert sum(d["histogram"]["counts"]) == 3
+    assert [w["mean"] for w in d["rolling_mean"]] == [pytest.approx(0.5), pytest.approx(0.7)]
+
+def test_stats_merge_ranges():
+    # Ranges merged into one process-wide statistics, as coordinator workers do
+    # they come out of order, so there are no rolling means
+    d = merge_shards(ScoreStats(bins=10, window=None))
+    assert d["lines"] == 4
+    assert d["scored"] == 3
+    assert d["window"] is None
+    assert d["rolling_mean"] == []
+
+def test_stats_merge_bins():
+    with pytest.raises(Exception):
+        ScoreStats(bins=10).merge(ScoreStats(bins=20))
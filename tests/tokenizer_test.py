@@ -0,0 +1,28 @@
+import shutil
+import pytest
+
+pytest.importorskip("sacremoses")
+
+from bicleaner_ai.tokenizer import TokenizerPool
+
+pytestmark = pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat")
+
+def test_pool_keeps_order():
+    pool = TokenizerPool(["cat"], size=3)
+    lines = [f"line {i}" for i in range(100)] + ["with\nnewline"]
+    try:
+        assert pool.tokenize_lines(lines) == lines[:-1] + ["with newline"]
+        assert len(pool.procs) == 3
+        # Fewer lines than processes
+        assert pool.tokenize_lines(["one"]) == ["one"]
+    finally:
+        pool.close()
+
+def test_pool_timeout():
+    # Reads its input and never answers
+    pool = TokenizerPool(["sh", "-c", "cat > /dev/null"], max_retries=1, timeout=0.5)
+    try:
+        with pytest.raises(RuntimeError, match="did not answer"):
+            pool.tokenize_lines(["hello"])
+    finally:
+        pool.close()
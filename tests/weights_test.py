@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import yaml
+
+pytest.importorskip("tensorflow")
+
+from bicleaner_ai.weights import save_mmap_weights, open_mmap_weights
+from bicleaner_ai.weights import weight_names_match, set_metadata_mmap_weights
+
+METADATA = """f1_score: 0.900
+classifier_type: dec_attention
+classifier_settings:
+    batch_size: 1024
+    model_file: model.h5
+    vocab_size: 32000
+calibration_params: [1.0, 2.0]
+"""
+
+def test_roundtrip(tmp_path):
+    weights = [("a/kernel:0", np.arange(6, dtype=np.float32).reshape(2, 3)),
+               ("b/bias:0", np.arange(5, dtype=np.int64))]
+    save_mmap_weights(weights, str(tmp_path))
+    for (name, expected), (loaded_name, array) in zip(weights, open_mmap_weights(str(tmp_path))):
+        assert loaded_name == name
+        assert array.ctypes.data % 64 == 0
+        np.testing.assert_array_equal(array, expected)
+
+def test_weight_names_match():
+    assert weight_names_match("dense_3/kernel:0", "dense/kernel:0")
+    assert weight_names_match("model_1/roberta/encoder/layer_._0/query/kernel:0",
+                              "roberta/encoder/layer_._0/query/kernel:0")
+    assert not weight_names_match("dense/kernel:0", "dense/bias:0")
+    assert not weight_names_match("roberta/encoder/layer_._0/query/kernel:0",
+                                  "roberta/encoder/layer_._1/query/kernel:0")
+
+def test_set_metadata_mmap_weights(tmp_path):
+    filename = str(tmp_path / "metadata.yaml")
+    with open(filename, 'w') as f:
+        f.write(METADATA)
+    set_metadata_mmap_weights(filename, "weights")
+    # Replaced, not added twice
+    set_metadata_mmap_weights(filename, "packed")
+    with open(filename) as f:
+        written = f.read()
+    assert written == METADATA.replace("    model_file:", "    mmap_weights: packed\n    model_file:")
+    assert yaml.safe_load(written)["classifier_settings"]["mmap_weights"] == "packed"